@@ -0,0 +1,101 @@
+'''
+Memory per idle keep-alive connection and per request.
+
+    python benchmarks/bench_connections.py --connections 2000
+
+The server runs in a thread of this process and is traced with
+`tracemalloc`, the clients run in a child process. Each client sends one
+request and then keeps its connection idle. CPython does not count
+allocations, so the cost of a request is shown as the memory blocks it
+leaves behind and the peak memory while requests are served.
+'''
+import gc
+import os
+import sys
+import time
+import socket
+import argparse
+import resource
+import tempfile
+import tracemalloc
+import multiprocessing
+from common import serve_in_thread
+
+REQUEST = b'GET /small.css HTTP/1.1\r\nHost: bench\r\n\r\n'
+
+def request(sock):
+    sock.sendall(REQUEST)
+    data = b''
+    while b'\r\n\r\n' not in data:
+        data += sock.recv(65536)
+    head, _, body = data.partition(b'\r\n\r\n')
+    length = int(head.lower().split(b'content-length:', 1)[1].split(b'\r\n', 1)[0])
+    while len(body) < length:
+        body += sock.recv(65536)
+
+def run_clients(port, connections, requests, conn):
+    socks = []
+    for _ in range(connections):
+        sock = socket.create_connection(('127.0.0.1', port))
+        request(sock)
+        socks.append(sock)
+    conn.send('idle')
+    sock = socks[0]
+    # time requests on one connection, then count what they leave behind
+    for phase in ('timed', 'traced'):
+        conn.recv()
+        start = time.perf_counter()
+        for _ in range(requests):
+            request(sock)
+        conn.send(requests / (time.perf_counter() - start))
+    conn.recv()
+
+def raise_fd_limit(count):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = count * 2 + 100
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--connections', type=int, default=2000)
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args()
+    raise_fd_limit(args.connections)
+    with tempfile.TemporaryDirectory() as root:
+        with open(os.path.join(root, 'small.css'), 'w') as fp:
+            fp.write('body { color: #333; }\n' * 50)
+        port = serve_in_thread({'handler': ['file'], 'options': {'root': root}})
+        conn, child_conn = multiprocessing.get_context('fork').Pipe()
+        process = multiprocessing.get_context('fork').Process(
+            target=run_clients, args=(port, args.connections, args.requests, child_conn))
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        process.start()
+        conn.recv()
+        time.sleep(0.5)
+        gc.collect()
+        idle = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        conn.send('timed')
+        rate = conn.recv()
+        tracemalloc.start()
+        gc.collect()
+        tracemalloc.reset_peak()
+        blocks = sys.getallocatedblocks()
+        conn.send('traced')
+        conn.recv()
+        gc.collect()
+        blocks = sys.getallocatedblocks() - blocks
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        conn.send('done')
+        process.join()
+    print('%d bytes per idle connection' % ((idle - before) / args.connections))
+    print('%.0f requests/s on one connection' % rate)
+    print('%.2f memory blocks left per request' % (blocks / args.requests))
+    print('%d bytes of peak memory while serving requests' % (peak - current))
+
+if __name__ == '__main__':
+    main()
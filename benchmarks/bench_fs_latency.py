@@ -0,0 +1,85 @@
+'''
+Latency of small files while other requests hit a slow filesystem.
+
+    python benchmarks/bench_fs_latency.py --delay 0.05
+
+`os.stat` and `os.listdir` are slowed down by `--delay` seconds for paths
+under `slow/`. Clients fetch small files from `fast/` while others list
+`slow/`, once with `fs_threads: 0`, which blocks the event loop, and once
+with the thread pool.
+'''
+import os
+import time
+import asyncio
+import argparse
+import tempfile
+from common import serve_in_thread, fetch, percentile
+
+def slow_down(delay):
+    '''Make filesystem calls on paths containing `/slow` take `delay` seconds.'''
+    for name in ('stat', 'listdir'):
+        func = getattr(os, name)
+
+        def wrapper(path, *args, func=func, **kw):
+            if '/slow' in os.fspath(path):
+                time.sleep(delay)
+            return func(path, *args, **kw)
+
+        setattr(os, name, wrapper)
+
+async def client(port, path, count, latencies):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    request = b'GET %s HTTP/1.1\r\nHost: bench\r\n\r\n' % path.encode()
+    for _ in range(count):
+        start = time.perf_counter()
+        status, _ = await fetch(reader, writer, request)
+        assert status == 200, status
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+async def run_clients(port, clients, slow_clients, count):
+    latencies = []
+    await asyncio.gather(*(
+        [client(port, '/fast/%d.txt' % (i % 10), count, latencies) for i in range(clients)]
+        + [client(port, '/slow/', count // 10, []) for _ in range(slow_clients)]))
+    return latencies
+
+def run(root, fs_threads, args):
+    port = serve_in_thread({
+        'handler': ['file', 'dir'],
+        'options': {
+            'root': root,
+            'fs_threads': fs_threads,
+            # stat on every request
+            'file_cache_size': 0,
+            'dir_cache_size': 0,
+        },
+    })
+    latencies = asyncio.run(run_clients(port, args.clients, args.slow_clients, args.count))
+    print('fs_threads=%-3d p50 %6.1fms  p99 %6.1fms  max %6.1fms' % (
+        fs_threads,
+        percentile(latencies, 50) * 1000,
+        percentile(latencies, 99) * 1000,
+        max(latencies) * 1000))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--delay', type=float, default=0.05, help='seconds per slow call')
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--slow-clients', type=int, default=4)
+    parser.add_argument('--count', type=int, default=100, help='requests per client')
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as root:
+        for name in ('fast', 'slow'):
+            os.mkdir(os.path.join(root, name))
+        for i in range(10):
+            with open(os.path.join(root, 'fast', '%d.txt' % i), 'w') as fp:
+                fp.write('x' * 100)
+            open(os.path.join(root, 'slow', '%d.txt' % i), 'w').close()
+        slow_down(args.delay)
+        for fs_threads in (0, args.threads):
+            run(root, fs_threads, args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+'''
+Requests per second of the request parser, without any I/O.
+
+    python benchmarks/bench_parser.py
+
+Requests are parsed one at a time from the reader buffer, and pipelined
+with all of them in the buffer at once. Run it on two revisions to
+compare parsers.
+'''
+import time
+import asyncio
+import argparse
+import common  # noqa: F401, sets the import path
+from pyweb.server.request import Request
+
+SMALL = (
+    b'GET /index.html HTTP/1.1\r\n'
+    b'Host: example.com\r\n'
+    b'\r\n'
+)
+BROWSER = (
+    b'GET /static/app.js?v=3 HTTP/1.1\r\n'
+    b'Host: example.com\r\n'
+    b'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0\r\n'
+    b'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n'
+    b'Accept-Language: en-US,en;q=0.5\r\n'
+    b'Accept-Encoding: gzip, deflate, br\r\n'
+    b'Referer: https://example.com/\r\n'
+    b'Cookie: session=0123456789abcdef; theme=dark\r\n'
+    b'Connection: keep-alive\r\n'
+    b'If-None-Match: "5f3e-1a2b"\r\n'
+    b'Cache-Control: max-age=0\r\n'
+    b'\r\n'
+)
+
+async def parse(data, count, pipelined):
+    reader = asyncio.StreamReader()
+    request = Request(reader, (1, 1))
+    if pipelined:
+        reader.feed_data(data * count)
+    start = time.perf_counter()
+    for _ in range(count):
+        if not pipelined:
+            reader.feed_data(data)
+        request.reset({})
+        assert await request.parse()
+    return count / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--count', type=int, default=100000)
+    args = parser.parse_args()
+    for name, data in (('small', SMALL), ('browser', BROWSER)):
+        for pipelined in (False, True):
+            rate = asyncio.run(parse(data, args.count, pipelined))
+            print('%-8s %-10s %9.0f req/s' % (
+                name, 'pipelined' if pipelined else 'single', rate))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+'''
+Route lookups per second over a config with 1,000 rules.
+
+    python benchmarks/bench_router.py --rules 1000
+
+Lookups are measured without the result cache, and with it on a set of
+paths that fits in the cache.
+'''
+import time
+import random
+import argparse
+from types import SimpleNamespace
+import common  # noqa: F401, sets the import path
+from pyweb.server.matcher import normalize_config
+
+def make_config(rules):
+    handler = []
+    for i in range(rules):
+        kind = i % 4
+        if kind == 0:
+            match = 'h:host%d.example.com' % i
+        elif kind == 1:
+            match = 'p:/app%d/' % i
+        elif kind == 2:
+            match = 'p:=/exact%d' % i
+        else:
+            match = ['h:*.site%d.com' % i, r'p:~^/re%d/.*\.php$' % i]
+        handler.append({'match': match, 'handler': 'file'})
+    handler.extend(['file', 'dir'])
+    return {'handler': handler}
+
+def make_requests(rules, count):
+    requests = []
+    for _ in range(count):
+        i = random.randrange(rules * 2)
+        requests.append(SimpleNamespace(
+            method='GET',
+            hostname=random.choice(('host%d.example.com' % i, 'www.site%d.com' % i)),
+            port=None,
+            path=random.choice(('/app%d/index.html' % i, '/exact%d' % i, '/re%d/a.php' % i)),
+        ))
+    return requests
+
+def measure(router, requests):
+    start = time.perf_counter()
+    for request in requests:
+        router.resolve(request)
+    return len(requests) / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--rules', type=int, default=1000)
+    parser.add_argument('--count', type=int, default=20000)
+    args = parser.parse_args()
+    config = make_config(args.rules)
+    requests = make_requests(args.rules, args.count)
+    router = normalize_config(dict(config, route_cache_size=0))[0]['router']
+    print('uncached %9.0f lookups/s' % measure(router, requests))
+    router = normalize_config(config)[0]['router']
+    hot = requests[:500] * (args.count // 500)
+    measure(router, hot)
+    print('cached   %9.0f lookups/s' % measure(router, hot))
+
+if __name__ == '__main__':
+    main()
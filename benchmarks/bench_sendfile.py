@@ -0,0 +1,66 @@
+'''
+Throughput and CPU use of large static files, with and without sendfile.
+
+    python benchmarks/bench_sendfile.py --size 4G
+
+The file is sparse, so reading it costs no disk I/O and the numbers show
+the server's own overhead. Server CPU is measured on a child process,
+client CPU on this one.
+'''
+import os
+import time
+import socket
+import argparse
+import tempfile
+from common import serve_in_process, stop_process, parse_size
+
+def download(port, path, size, bufsize=1 << 20):
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    received = 0
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        sock.sendall(b'GET %s HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n' % path.encode())
+        head = b''
+        while b'\r\n\r\n' not in head:
+            head += sock.recv(4096)
+        received = len(head.split(b'\r\n\r\n', 1)[1])
+        while True:
+            count = sock.recv_into(view)
+            if not count:
+                break
+            received += count
+    assert received == size, (received, size)
+
+def run(root, size, sendfile, repeat):
+    process, port = serve_in_process({
+        'handler': ['file'],
+        'sendfile': sendfile,
+        'options': {'root': root, 'hot_cache_size': 0},
+    })
+    start = time.perf_counter()
+    client = time.process_time()
+    for _ in range(repeat):
+        download(port, '/large.bin', size)
+    elapsed = time.perf_counter() - start
+    client = time.process_time() - client
+    user, system = stop_process(process)
+    total = size * repeat
+    print('%-8s %8.0f MiB/s  server cpu %.2fs user + %.2fs sys (%.2f s/GiB)  client cpu %.2fs' % (
+        'sendfile' if sendfile else 'copy',
+        total / elapsed / (1 << 20), user, system,
+        (user + system) / (total / (1 << 30)), client))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--size', default='1G', help='file size, e.g. 512M or 4G')
+    parser.add_argument('--repeat', type=int, default=3, help='downloads per mode')
+    args = parser.parse_args()
+    size = parse_size(args.size)
+    with tempfile.TemporaryDirectory() as root:
+        with open(os.path.join(root, 'large.bin'), 'wb') as fp:
+            fp.truncate(size)
+        for sendfile in (False, True):
+            run(root, size, sendfile, args.repeat)
+
+if __name__ == '__main__':
+    main()
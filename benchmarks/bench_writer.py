@@ -0,0 +1,63 @@
+'''
+Throughput of the response writer for small and large responses.
+
+    python benchmarks/bench_writer.py
+
+Responses are written to a transport that only counts calls and bytes,
+so the numbers show the cost of framing, buffering and compression, and
+how many transport writes each response takes.
+'''
+import time
+import argparse
+import common  # noqa: F401, sets the import path
+from pyweb.utils.writers import ResponseWriter
+
+HEAD = (
+    b'HTTP/1.1 200 OK\r\n'
+    b'Content-Type: text/html; charset=utf-8\r\n'
+    b'Transfer-Encoding: chunked\r\n'
+    b'\r\n'
+)
+
+class Transport:
+    def __init__(self):
+        self.calls = 0
+        self.bytes = 0
+
+    def writelines(self, parts):
+        self.calls += 1
+        self.bytes += sum(map(len, parts))
+
+def measure(body, piece, count, **kw):
+    transport = Transport()
+    writer = ResponseWriter(transport, None)
+    pieces = [body[i:i + piece] for i in range(0, len(body), piece)]
+    start = time.perf_counter()
+    for _ in range(count):
+        writer.start(HEAD, **kw)
+        for data in pieces:
+            writer.write(data)
+        writer.close()
+    elapsed = time.perf_counter() - start
+    return count / elapsed, len(body) * count / elapsed, transport.calls / count, transport.bytes / count
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--count', type=int, default=20000)
+    args = parser.parse_args()
+    text = b'<li><a href="/item">item</a> 1024 bytes</li>\n'
+    cases = (
+        ('small', text * 20, 4096, args.count),
+        ('large', text * 100000, 4096, max(1, args.count // 1000)),
+    )
+    for name, body, piece, count in cases:
+        for mode, kw in (
+                ('plain', {}),
+                ('chunked', {'chunked': True}),
+                ('gzip', {'chunked': True, 'gzip': True})):
+            rate, throughput, calls, sent = measure(body, piece, count, **kw)
+            print('%-6s %-8s %9.0f resp/s %8.1f MiB/s %7.1f writes/resp %9.0f bytes/resp' % (
+                name, mode, rate, throughput / (1 << 20), calls, sent))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+'''
+Check that a large upload through the `fcgi` handler is streamed.
+
+    python benchmarks/check_fcgi_memory.py --size 1G --limit 64M
+
+A body of `--size` bytes is posted to a FastCGI server that discards it
+and answers with its length. The check fails if the peak memory of the
+web server grows by more than `--limit` bytes. Linux only.
+'''
+import os
+import sys
+import time
+import struct
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+from common import serve_in_process, stop_process, peak_rss, free_port, wait_port, parse_size
+from pyweb.utils import fcgi
+
+async def handle_fcgi(reader, writer):
+    '''Answer each request with the length of its STDIN.'''
+    lengths = {}
+    try:
+        while True:
+            header = await reader.readexactly(8)
+            _version, rec_type, req_id, length, padding = struct.unpack('!BBHHBx', header)
+            data = await reader.readexactly(length + padding)
+            if rec_type == fcgi.FCGI_BEGIN_REQUEST:
+                lengths[req_id] = 0
+            elif rec_type == fcgi.FCGI_STDIN and length:
+                lengths[req_id] += length
+            elif rec_type == fcgi.FCGI_STDIN:
+                body = b'Content-Type: text/plain\r\n\r\n%d' % lengths.pop(req_id)
+                writer.writelines(fcgi.build_record(req_id, fcgi.FCGI_STDOUT, body, False))
+                writer.writelines(fcgi.build_record(req_id, fcgi.FCGI_STDOUT))
+                writer.writelines(fcgi.build_record(
+                    req_id, fcgi.FCGI_END_REQUEST, struct.pack('!IB3x', 0, 0), False))
+                await writer.drain()
+    except asyncio.IncompleteReadError:
+        pass
+    finally:
+        writer.close()
+
+def serve_fcgi():
+    port = free_port()
+
+    def run():
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(asyncio.start_server(handle_fcgi, '127.0.0.1', port))
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    wait_port(port)
+    return port
+
+def upload(port, size, bufsize=1 << 16):
+    chunk = b'\0' * bufsize
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        sock.sendall(
+            b'POST /upload.php HTTP/1.0\r\nHost: bench\r\n'
+            b'Content-Length: %d\r\n\r\n' % size)
+        left = size
+        while left:
+            left -= sock.send(chunk[:min(left, bufsize)])
+        response = b''
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            response += data
+    head, _, body = response.partition(b'\r\n\r\n')
+    assert head.split()[1] == b'200', head
+    return int(body)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--size', default='1G', help='upload size, e.g. 512M or 1G')
+    parser.add_argument('--limit', default='64M', help='allowed growth of peak memory')
+    args = parser.parse_args()
+    size = parse_size(args.size)
+    limit = parse_size(args.limit)
+    fcgi_port = serve_fcgi()
+    with tempfile.TemporaryDirectory() as root:
+        open(os.path.join(root, 'upload.php'), 'w').close()
+        process, port = serve_in_process({
+            'handler': ['fcgi'],
+            'options': {
+                'root': root,
+                'fcgi_ext': ['.php'],
+                'fcgi_target': ['127.0.0.1:%d' % fcgi_port],
+            },
+        })
+        before = peak_rss(process.pid)
+        start = time.perf_counter()
+        received = upload(port, size)
+        elapsed = time.perf_counter() - start
+        growth = peak_rss(process.pid) - before
+        stop_process(process)
+    print('uploaded %d MiB in %.1fs (%.0f MiB/s), peak memory grew by %.1f MiB' % (
+        size >> 20, elapsed, size / elapsed / (1 << 20), growth / (1 << 20)))
+    if received != size:
+        sys.exit('the FastCGI server received %d bytes' % received)
+    if growth > limit:
+        sys.exit('peak memory grew by more than %d MiB' % (limit >> 20))
+
+if __name__ == '__main__':
+    main()
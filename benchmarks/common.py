@@ -0,0 +1,118 @@
+'''Helpers shared by the benchmarks.'''
+import os
+import sys
+import time
+import signal
+import socket
+import asyncio
+import logging
+import resource
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gera2ld.pyserve
+from pyweb.server import HTTPDaemon
+from pyweb.utils.httpclient import get_header, iter_chunked
+
+# keep the output of benchmarks readable
+gera2ld.pyserve.print_urls = lambda hosts: None
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+def make_config(config, port):
+    config = dict(config, bind='127.0.0.1:%d' % port)
+    config.setdefault('loglevel', logging.WARNING)
+    config.setdefault('access_log', None)
+    return config
+
+def serve_in_thread(config):
+    '''Serve `config` from a thread of this process, return the port.'''
+    port = free_port()
+    config = make_config(config, port)
+
+    def run():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        HTTPDaemon(config).serve()
+
+    threading.Thread(target=run, daemon=True).start()
+    wait_port(port)
+    return port
+
+def serve_in_process(config):
+    '''Serve `config` from a child process, return the process and the port.
+
+    Stop it with `stop_process` to get its resource usage.
+    '''
+    port = free_port()
+    config = make_config(config, port)
+    # forked, so that the config does not need to be pickled
+    process = multiprocessing.get_context('fork').Process(
+        target=lambda: HTTPDaemon(config).serve(), daemon=True)
+    process.start()
+    wait_port(port)
+    return process, port
+
+def stop_process(process):
+    '''Stop a process started by `serve_in_process`.
+
+    Return the `(user, system)` CPU seconds it used.
+    '''
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    os.kill(process.pid, signal.SIGTERM)
+    process.join()
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return after.ru_utime - before.ru_utime, after.ru_stime - before.ru_stime
+
+def peak_rss(pid):
+    '''Peak resident memory of a process in bytes, Linux only.'''
+    with open('/proc/%d/status' % pid) as fp:
+        for line in fp:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+async def fetch(reader, writer, data):
+    '''Send a request and read the response.
+
+    Return the status code and the length of the body.
+    '''
+    writer.write(data)
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split()[1])
+    headers = [line.partition(':')[::2] for line in lines[1:]]
+    if get_header(headers, 'transfer-encoding', '').strip() == 'chunked':
+        length = 0
+        async for chunk in iter_chunked(reader):
+            length += len(chunk)
+    else:
+        length = int(get_header(headers, 'content-length', 0))
+        await reader.readexactly(length)
+    return status, length
+
+def parse_size(value):
+    '''Parse sizes like `512M` or `4G`.'''
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    unit = units.get(value[-1:].upper())
+    if unit is None:
+        return int(value)
+    return int(float(value[:-1]) * unit)
@@ -12,13 +12,15 @@ from .utils import logger
 @click.command()
 @click.option('-b', '--bind', default=':4000', help='the address to bind, default as `:4000`')
 @click.option('-r', '--root', default='.', help='the root directory of documents')
-def main(bind, root):
+@click.option('-w', '--workers', default=1, help='the number of worker processes, default as 1')
+def main(bind, root, workers):
     """Start a web server with pyweb."""
     logger.info(
         'HTTP Server v%s/%s %s - by Gerald',
         __version__, platform.python_implementation(), platform.python_version())
     server = HTTPDaemon({
         'bind': bind,
+        'workers': workers,
         'match': None,
         'handler': [
             'proxy',
@@ -2,3 +2,5 @@ from .file import FileHandler
 from .directory import DirectoryHandler
 from .fcgi import FCGIHandler
 from .proxy import ProxyHandler
+from .upstream import UpstreamHandler
+from .metrics import MetricsHandler
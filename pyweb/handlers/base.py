@@ -1,14 +1,94 @@
 import os
+import stat
 import functools
 from urllib import parse
 from ..utils import errors
+from ..utils.cache import LRUCache
+from ..utils.mime import checkmime
+from ..utils.executor import get_executor, run_blocking
 
-def check_filetype(filepath):
-    if os.path.isdir(filepath):
+file_caches = {}
+
+def get_file_cache(options):
+    '''Get the cache of file entries set by `file_cache_size` and `file_cache_ttl`.
+
+    Return None if caching is disabled.
+    '''
+    size = options.get('file_cache_size', 1000)
+    ttl = options.get('file_cache_ttl', 1)
+    if not size or not ttl:
+        return
+    key = size, ttl
+    cache = file_caches.get(key)
+    if cache is None:
+        cache = file_caches[key] = LRUCache(size, ttl)
+    return cache
+
+def stat_path(path):
+    try:
+        return os.stat(path)
+    except (OSError, ValueError):
+        return None
+
+def check_filetype(st):
+    if st is None:
+        return
+    if stat.S_ISDIR(st.st_mode):
         return 'dir'
-    elif os.path.isfile(filepath):
+    elif stat.S_ISREG(st.st_mode):
         return 'file'
 
+class FileEntry:
+    '''Type and stat result of a path, with index files resolved.'''
+    __slots__ = ('filetype', 'realpath', 'stat', '_mime', '_etag')
+
+    def __init__(self, filepath, index=None):
+        st = stat_path(filepath)
+        filetype = check_filetype(st)
+        self.filetype = filetype
+        self.realpath = None if filetype is None else filepath
+        self.stat = st
+        self._mime = None
+        self._etag = None
+
+        # Check index files
+        if filetype == 'dir' and index:
+            for item in index:
+                indexpath = os.path.join(filepath, item)
+                indexstat = stat_path(indexpath)
+                if check_filetype(indexstat) == 'file':
+                    self.realpath = indexpath
+                    self.filetype = 'file'
+                    self.stat = indexstat
+                    break
+
+    @property
+    def mime(self):
+        '''`(mimetype, expire)` of a file.'''
+        if self._mime is None:
+            self._mime = checkmime(self.realpath)
+        return self._mime
+
+    @property
+    def etag(self):
+        '''Strong entity tag built from the inode, mtime and size of a file.'''
+        if self._etag is None:
+            st = self.stat
+            self._etag = '"%x-%x-%x"' % (st.st_ino, st.st_mtime_ns, st.st_size)
+        return self._etag
+
+    @classmethod
+    async def get(cls, filepath, index=None, cache=None, executor=None):
+        '''Get an entry from `cache`, or stat the path in `executor`.'''
+        if cache is None:
+            return await run_blocking(executor, cls, filepath, index)
+        key = filepath, tuple(index) if index else None
+        entry = cache.get(key)
+        if entry is None:
+            entry = await run_blocking(executor, cls, filepath, index)
+            cache.set(key, entry)
+        return entry
+
 class FileSystemInfo:
     def __init__(self, context, options):
         root = options.get('root', '.')
@@ -28,28 +108,32 @@ class FileSystemInfo:
             filepath = os.path.join(root, pathname[1:])
         if os.name == 'nt':
             filepath = filepath.replace('\\', '/')
-        filetype = check_filetype(filepath)
-        self.filetype = filetype
-        self.realpath = None if filetype is None else filepath
+        self.filepath = filepath
+        self.entry = self.filetype = self.realpath = self.stat = None
 
-        # Check index files
-        index = options.get('index')
-        if filetype == 'dir' and index:
-            for item in index:
-                indexpath = os.path.join(filepath, item)
-                indextype = check_filetype(indexpath)
-                if indextype == 'file':
-                    self.realpath = indexpath
-                    self.filetype = indextype
-                    break
+    async def load(self, options):
+        entry = await FileEntry.get(
+            self.filepath, options.get('index'),
+            get_file_cache(options), get_executor(options))
+        self.entry = entry
+        self.filetype = entry.filetype
+        self.realpath = entry.realpath
+        self.stat = entry.stat
 
     def __repr__(self):
         return f'<FileSystemInfo type={self.filetype} path={self.pathname} realpath={self.realpath}>'
 
 def prepare_fs(handle):
+    '''Set `context.fs` before calling the handler.
+
+    Handlers are shared by concurrent requests, so the result must not be
+    kept on the handler itself.
+    '''
     @functools.wraps(handle)
     async def wrapped_handle(self, context, options):
-        self.fs = FileSystemInfo(context, options)
+        fs = FileSystemInfo(context, options)
+        await fs.load(options)
+        context.fs = fs
         return await handle(self, context, options)
     return wrapped_handle
 
@@ -65,7 +149,5 @@ def allowed_methods(methods = ('HEAD', 'GET')):
     return wrapper
 
 class BaseHandler:
-    fs = None
-
     def __repr__(self):
         return '<{}>'.format(self.__class__.__name__)
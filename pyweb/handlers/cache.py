@@ -0,0 +1,278 @@
+'''
+Micro-cache of responses from FastCGI and upstream servers
+
+Concurrent misses of a key are coalesced into one backend request, and
+an expired response is served to other requests while one request gets a
+fresh one.
+'''
+import time
+import asyncio
+from ..utils import errors, metrics, time as time_utils
+from ..utils.cache import LRUCache
+from ..utils.httpclient import get_header
+
+CACHE_TTL = 1
+CACHE_STALE = 10
+CACHE_MAX_BODY = 1024 * 1024
+CACHE_LOCK_TIMEOUT = 5
+# heuristically cacheable (RFC 7231, section 6.1)
+CACHEABLE_STATUS = frozenset((200, 203, 204, 300, 301, 308, 404, 410))
+# headers describing the stored response rather than the content
+SKIP_HEADERS = frozenset(('age', 'date', 'x-cache'))
+
+cache_requests = metrics.Counter(
+    'pyweb_cache_requests_total', 'Requests to response caches by result.', ('result',))
+cache_bytes = metrics.Gauge(
+    'pyweb_cache_bytes', 'Bytes of responses in the cache.', ('size',))
+cache_entries = metrics.Gauge(
+    'pyweb_cache_entries', 'Responses in the cache.', ('size',))
+results = {
+    result: cache_requests.labels(result)
+    for result in ('hit', 'stale', 'miss', 'coalesced', 'bypass')
+}
+
+def parse_cache_control(value):
+    '''Parse a `Cache-Control` header into a dict of directives.'''
+    directives = {}
+    if value:
+        for item in value.split(','):
+            key, _, arg = item.partition('=')
+            key = key.strip().lower()
+            if key:
+                directives[key] = arg.strip().strip('"')
+    return directives
+
+def get_seconds(directives, key):
+    try:
+        return max(0, int(directives[key]))
+    except (KeyError, ValueError):
+        return
+
+class Entry:
+    '''A stored response.'''
+    __slots__ = ('status', 'headers', 'body', 'created', 'expires', 'stale_until')
+
+    def __init__(self, status, headers, body, ttl, stale):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.created = time.monotonic()
+        self.expires = self.created + ttl
+        self.stale_until = self.expires + stale
+
+    @property
+    def cost(self):
+        return len(self.body) + sum(len(key) + len(value) for key, value in self.headers)
+
+class Recorder:
+    '''Copy of a response as it is written, up to `max_body` bytes of body.
+
+    `response_headers` are marked as a miss when the response starts, so
+    that errors raised before that are not.
+    '''
+
+    def __init__(self, max_body, response_headers):
+        self.max_body = max_body
+        self.response_headers = response_headers
+        self.status = None
+        self.headers = None
+        self.body = bytearray()
+
+    def start(self, status, headers):
+        self.status = status
+        self.headers = [(key, value) for key, value in headers if key.lower() not in SKIP_HEADERS]
+        self.response_headers['X-Cache'] = 'MISS'
+
+    def write(self, data):
+        if self.body is None:
+            return
+        if len(self.body) + len(data) > self.max_body:
+            # too large to keep
+            self.body = None
+        else:
+            self.body += data
+
+class ResponseCache:
+    '''Responses limited to `max_size` bytes, and the keys being fetched.'''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = LRUCache(max_size=max_size, max_cost=max_size)
+        self.pending = {}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and entry.stale_until <= time.monotonic():
+            self.entries.pop(key)
+            return
+        return entry
+
+response_caches = {}
+
+def get_response_cache(options):
+    '''Get the response cache limited to `cache_size` bytes.
+
+    Return None if caching is disabled, which is the default.
+    '''
+    size = options.get('cache_size')
+    if not size:
+        return
+    cache = response_caches.get(size)
+    if cache is None:
+        cache = response_caches[size] = ResponseCache(size)
+    return cache
+
+def collect_metrics():
+    cache_bytes.clear()
+    cache_entries.clear()
+    for size, cache in response_caches.items():
+        cache_bytes.labels(size).set(cache.entries.cost)
+        cache_entries.labels(size).set(len(cache.entries))
+
+metrics.registry.add_collector(collect_metrics)
+
+def get_key(context, options):
+    '''Key of a GET request: host, URI and the `cache_vary` headers.'''
+    env = context.env
+    vary = tuple(
+        env.get('HTTP_' + name.upper().replace('-', '_'))
+        for name in options.get('cache_vary', ()))
+    return env.get('HTTP_HOST') or context.request.hostname, context.request.path, vary
+
+def get_freshness(status, headers, options):
+    '''Return `(ttl, stale)` in seconds of a response, or None if it must
+    not be stored.
+
+    `s-maxage`, `max-age` and `Expires` from the backend take precedence
+    over `cache_ttl`, and `stale-while-revalidate` over `cache_stale`.
+    '''
+    if status[0] not in CACHEABLE_STATUS or get_header(headers, 'set-cookie') is not None:
+        return
+    directives = parse_cache_control(get_header(headers, 'cache-control'))
+    if 'no-store' in directives or 'no-cache' in directives or 'private' in directives:
+        return
+    vary = get_header(headers, 'vary')
+    if vary:
+        allowed = set(name.lower() for name in options.get('cache_vary', ()))
+        if any(name.strip().lower() not in allowed for name in vary.split(',')):
+            return
+    ttl = get_seconds(directives, 's-maxage')
+    if ttl is None:
+        ttl = get_seconds(directives, 'max-age')
+    if ttl is None:
+        expires = get_header(headers, 'expires')
+        if expires is not None:
+            # invalid dates mean the response is already expired
+            expires = time_utils.parse_date(expires) or 0
+            date = time_utils.parse_date(get_header(headers, 'date') or '') or time.time()
+            ttl = max(0, int(expires - date))
+    if ttl is None:
+        ttl = options.get('cache_ttl', CACHE_TTL)
+    stale = get_seconds(directives, 'stale-while-revalidate')
+    if stale is None:
+        stale = options.get('cache_stale', CACHE_STALE)
+    if not ttl and not stale:
+        return
+    return ttl, stale
+
+def serve(context, entry, result):
+    context.set_status(*entry.status)
+    headers = context.headers
+    for key, value in entry.headers:
+        headers[key] = value
+    headers['Age'] = str(int(time.monotonic() - entry.created))
+    headers['X-Cache'] = result.upper()
+    context.write(entry.body)
+    results[result].inc()
+    return True
+
+async def cached(context, options, fetch):
+    '''Serve a response from the cache, or get it with `fetch` and store it.
+
+    `fetch` is an async function that returns a body like handlers do.
+    Only GET and HEAD requests without `Authorization` are cached, HEAD
+    requests are served from GET responses but do not store them.
+    '''
+    cache = get_response_cache(options)
+    request = context.request
+    if cache is None:
+        return await fetch()
+    if request.method not in ('GET', 'HEAD') or 'HTTP_AUTHORIZATION' in context.env:
+        results['bypass'].inc()
+        return await fetch()
+    key = get_key(context, options)
+    entry = cache.get(key)
+    if entry is not None:
+        if entry.expires > time.monotonic():
+            return serve(context, entry, 'hit')
+        if key in cache.pending:
+            # being revalidated by another request
+            return serve(context, entry, 'stale')
+    else:
+        pending = cache.pending.get(key)
+        if pending is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(pending), options.get('cache_lock_timeout', CACHE_LOCK_TIMEOUT))
+            except asyncio.TimeoutError:
+                pass
+            entry = cache.get(key)
+            if entry is not None:
+                return serve(context, entry, 'coalesced')
+            # not cacheable, or too slow to wait for
+            results['bypass'].inc()
+            return await fetch()
+    if request.method == 'HEAD':
+        results['miss'].inc()
+        return await fetch()
+    return await fetch_and_store(context, options, fetch, cache, key, entry)
+
+async def fetch_and_store(context, options, fetch, cache, key, stale):
+    '''Get a response as the only request for `key` and store it.
+
+    If `stale` is given and the backend fails with an `HTTPError` before
+    the response starts, it is served instead.
+    '''
+    done = cache.pending[key] = asyncio.get_event_loop().create_future()
+    recorder = context.capture = Recorder(
+        options.get('cache_max_body', CACHE_MAX_BODY), context.headers)
+    complete = False
+    try:
+        try:
+            body = await fetch()
+        except errors.HTTPError as e:
+            if stale is None or e.status_code < 500 or context.headers_sent:
+                raise
+            context.logger.warning('serving stale response: %s', e.long_msg)
+            context.capture = None
+            # drop what the failed request has set
+            context.headers.clear()
+            return serve(context, stale, 'stale')
+        if not body:
+            return body
+        results['miss'].inc()
+        await context.send_body(body)
+        complete = True
+    finally:
+        context.capture = None
+        del cache.pending[key]
+        done.set_result(None)
+        if complete:
+            if recorder.status is None:
+                # nothing has been written yet
+                recorder.start(context.status, context.headers.items())
+            store(cache, key, recorder, options)
+    return True
+
+def store(cache, key, recorder, options):
+    '''Store a recorded response.
+
+    A response that cannot be stored, like an error, leaves the current
+    entry to be served until it is too stale.
+    '''
+    if recorder.body is None:
+        return
+    freshness = get_freshness(recorder.status, recorder.headers, options)
+    if freshness is None:
+        return
+    entry = Entry(recorder.status, recorder.headers, bytes(recorder.body), *freshness)
+    cache.entries.set(key, entry, entry.cost)
@@ -1,28 +1,135 @@
 import os
-import html
+import json
 from urllib import parse
 from .base import BaseHandler, prepare_fs, allowed_methods
-from ..utils import template
+from ..utils import errors, template
+from ..utils.cache import LRUCache
+from ..utils.executor import get_executor, run_blocking
 
 __all__ = ['DirectoryHandler']
 
+DIR_CACHE_SIZE = 100000
+DIR_CACHE_TTL = 10
+# items per chunk of the response
+CHUNK_ITEMS = 256
+
+listing_caches = {}
+
+def get_listing_cache(options):
+    '''Get the cache of directory listings set by `dir_cache_size` and `dir_cache_ttl`.
+
+    The size is the total number of items in cached listings. Return None
+    if caching is disabled.
+    '''
+    size = options.get('dir_cache_size', DIR_CACHE_SIZE)
+    ttl = options.get('dir_cache_ttl', DIR_CACHE_TTL)
+    if not size or not ttl:
+        return
+    key = size, ttl
+    cache = listing_caches.get(key)
+    if cache is None:
+        cache = listing_caches[key] = LRUCache(max_size=size, ttl=ttl, max_cost=size)
+    return cache
+
+def list_dir(realpath):
+    '''List visible items as `(name, is_dir, size)`, sorted by name.'''
+    items = []
+    with os.scandir(realpath) as it:
+        for entry in it:
+            name = entry.name
+            if name.startswith('.'):
+                continue
+            try:
+                if entry.is_dir():
+                    items.append((name, True, None))
+                else:
+                    items.append((name, False, entry.stat().st_size))
+            except OSError:
+                # broken links
+                continue
+    items.sort(key = lambda item: item[0].upper())
+    return tuple(items)
+
+async def get_listing(fs, options):
+    '''Get the listing of a directory, cached until its mtime changes.
+
+    Sizes of files changed in place are refreshed after `dir_cache_ttl`
+    seconds.
+    '''
+    cache = get_listing_cache(options)
+    executor = get_executor(options)
+    if cache is None:
+        return await run_blocking(executor, list_dir, fs.realpath)
+    key = fs.realpath, fs.stat.st_mtime_ns
+    items = cache.get(key)
+    if items is None:
+        items = await run_blocking(executor, list_dir, fs.realpath)
+        cache.set(key, items, len(items) + 1)
+    return items
+
+def check_video(filename):
+    base, ext = os.path.splitext(filename)
+    return ext.lower() in ('.mp4', '.mkv', '.avi')
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if size < 1024:
+            break
+        size = size / 1024
+    if isinstance(size, float):
+        size = '%.2f' % size
+    return str(size) + unit
+
+def get_page(context):
+    '''Parse `offset`, `limit` and `format` from the query string.'''
+    query = parse.parse_qs(context.env.get('QUERY_STRING', ''))
+    try:
+        offset = max(0, int(query.get('offset', ['0'])[0]))
+        limit = query.get('limit')
+        limit = max(1, int(limit[0])) if limit else None
+    except ValueError:
+        raise errors.HTTPError(400, 'Invalid offset or limit')
+    return offset, limit, query.get('format', [None])[0]
+
 class DirectoryHandler(BaseHandler):
+    name = 'dir'
+
     @prepare_fs
     @allowed_methods()
     async def __call__(self, context, options):
-        if self.fs.filetype != 'dir':
+        fs = context.fs
+        if fs.filetype != 'dir':
             return
-        def check_video(filename):
-            base, ext = os.path.splitext(filename)
-            return ext.lower() in ('.mp4', '.mkv', '.avi')
-        realpath = self.fs.realpath
+        realpath = fs.realpath
         try:
             assert realpath.endswith('/')
-            items = sorted(os.listdir(realpath), key = str.upper)
+            items = await get_listing(fs, options)
         except:
             # not directory or not allowed to read
             return
-        dir_path = self.fs.pathname.rstrip('/')
+        offset, limit, output = get_page(context)
+        page = items[offset:] if limit is None else items[offset:offset + limit]
+        if output == 'json':
+            context.headers['Content-Type'] = 'application/json'
+            return self.iter_json(fs, items, page, offset, limit)
+        context.headers['Content-Type'] = 'text/html'
+        return self.iter_html(fs, items, page, offset, limit)
+
+    @staticmethod
+    def iter_json(fs, items, page, offset, limit):
+        yield '{"path": %s, "total": %d, "offset": %d, "limit": %s, "items": [' % (
+            json.dumps(fs.pathname), len(items), offset, json.dumps(limit))
+        for i in range(0, len(page), CHUNK_ITEMS):
+            yield (', ' if i else '') + ', '.join(json.dumps({
+                'name': name,
+                'type': 'dir' if is_dir else 'file',
+                'size': size,
+            }) for name, is_dir, size in page[i:i + CHUNK_ITEMS])
+        yield ']}'
+
+    @staticmethod
+    def iter_html(fs, items, page, offset, limit):
+        dir_path = fs.pathname.rstrip('/')
         parts = dir_path.split('/')
         pre = ''
         dirs = []
@@ -33,47 +140,25 @@ class DirectoryHandler(BaseHandler):
             pre += '../'
             dirs.append(part)
         guide = ' / '.join(reversed(dirs))
-        data_html = ['<div class="guide">', guide, '</div>']
-        data = ['<ul>']
-        has_videos = False
-        null = not items
-        files = []
-        for item in items:
-            if item.startswith('.'):
-                continue
-            path = os.path.join(realpath, item)
-            if os.path.isdir(path):
-                data.append(template.render('dir-item', {
-                    'href': item,
-                    'name': item,
-                }))
-            else:
-                size = os.path.getsize(path)
-                for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
-                    if size < 1024:
-                        break
-                    size = size / 1024
-                if isinstance(size, float):
-                    size = '%.2f' % size
-                url = parse.quote(item)
-                is_video = check_video(item)
-                has_videos = has_videos or is_video
-                files.append(''.join(template.render('file-item', {
-                    'is_video': is_video,
-                    'size': str(size) + unit,
-                    'href': url,
-                    'name': item,
-                })))
-        data.extend(files)
-        if null:
-            data.append('<li>Null</li>')
-        data.append('</ul>')
-        if has_videos:
-            data_html.append(template.render('video'))
-        data_html.extend(data)
-        context.headers['Content-Type'] = 'text/html'
-        return template.render(args={
+        prev_href = next_href = None
+        if limit is not None:
+            if offset > 0:
+                prev_href = '?offset=%d&limit=%d' % (max(0, offset - limit), limit)
+            if offset + limit < len(items):
+                next_href = '?offset=%d&limit=%d' % (offset + limit, limit)
+        # directories first, items are prepared while the page is streamed
+        return template.stream('listing', {
             'title': 'Directory Listing',
             'header': 'Directory listing',
-            'body': ''.join(data_html),
+            'guide': guide,
+            'has_videos': any(not is_dir and check_video(name) for name, is_dir, _size in page),
+            'dirs': (
+                (parse.quote(name), name)
+                for name, is_dir, _size in page if is_dir),
+            'files': (
+                (parse.quote(name), name, format_size(size), check_video(name))
+                for name, is_dir, size in page if not is_dir),
+            'empty': not page,
+            'prev_href': prev_href,
+            'next_href': next_href,
         })
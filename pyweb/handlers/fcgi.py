@@ -1,38 +1,80 @@
 import os
-from ..utils import fcgi
+import asyncio
+import functools
+from ..utils import fcgi, errors
 from .base import BaseHandler, prepare_fs
+from .cache import cached
 
 __all__ = ['FCGIHandler']
 
+MAX_HEADER_SIZE = 65536
+
+def find_header_end(data, start=0):
+    '''Return the end of the header block and the start of the body.'''
+    ends = []
+    for sep in (b'\r\n\r\n', b'\n\n'):
+        end = data.find(sep, start)
+        if end >= 0:
+            ends.append((end, end + len(sep)))
+    return min(ends) if ends else (-1, -1)
+
+def set_headers(context, data):
+    '''Apply CGI response headers to the context.'''
+    for line in bytes(data).decode().splitlines():
+        key, _, value = line.partition(':')
+        key = key.strip()
+        if not key:
+            continue
+        value = value.strip()
+        if key.upper() == 'STATUS':
+            code, _, msg = value.partition(' ')
+            context.set_status(int(code), msg)
+        else:
+            context.headers[key] = value
+
+def get_dispatcher_args(options):
+    '''Return `(targets, kw)` of the dispatcher of a section.'''
+    return options.get('fcgi_target'), dict(
+        max_connections=options.get('fcgi_max_connections'),
+        idle_timeout=options.get('fcgi_idle_timeout'),
+        timeout=options.get('fcgi_timeout'),
+        multiplex=options.get('fcgi_multiplex'),
+    )
+
 class FCGIHandler(BaseHandler):
+    name = 'fcgi'
+
     @prepare_fs
     async def __call__(self, context, options):
-        if self.fs.filetype != 'file':
+        if context.fs.filetype != 'file':
             return
-        filepath = self.fs.realpath
+        filepath = context.fs.realpath
         _, extname = os.path.splitext(filepath)
         extnames = options.get('fcgi_ext')
         target = options.get('fcgi_target')
         if not target or not extnames or extname not in extnames:
             return
+        return await cached(context, options, functools.partial(self.run, context, options, filepath))
+
+    async def run(self, context, options, filepath):
+        head = bytearray()
 
-        def _fcgi_write(data):
-            i = 0
-            while not context.headers_sent:
-                j = data.find(b'\n', i)
-                line = data[i: j].strip().decode()
-                i = j + 1
-                if not line:
-                    data = data[i:]
-                    break
-                key, value = line.split(':', 1)
-                value = value.strip()
-                if key.upper() == 'STATUS':
-                    code, _, msg = value.partition(' ')
-                    context.set_status(code, msg)
-                else:
-                    context.headers[key] = value
+        async def _fcgi_write(data):
+            nonlocal head
+            if head is not None:
+                # Collect the CGI headers, which may span several records.
+                start = max(0, len(head) - 3)
+                head += data
+                end, body = find_header_end(head, start)
+                if end < 0:
+                    if len(head) > MAX_HEADER_SIZE:
+                        raise errors.HTTPError(502, 'FastCGI response headers too large')
+                    return
+                set_headers(context, head[:end])
+                data = bytes(head[body:])
+                head = None
             context.write(data)
+            await context.drain()
 
         def _fcgi_err(data):
             if isinstance(data, bytes):
@@ -45,10 +87,26 @@ class FCGIHandler(BaseHandler):
             'SERVER_SOFTWARE': context.server_version,
             'REDIRECT_STATUS': context.status[0],
         })
-        handler = fcgi.Dispatcher.get(target)
+        target, kw = get_dispatcher_args(options)
+        handler = fcgi.Dispatcher.get(target, **kw)
         try:
             await handler.run_worker(_fcgi_write, _fcgi_err, context.reader, context.env)
-        except ConnectionRefusedError:
-            context.send_error(500, "Failed connecting to FCGI server!")
+        except ConnectionRefusedError as e:
+            if context.headers_sent:
+                # too late for an error page, the connection is closed
+                raise
+            raise errors.HTTPError(502, 'Failed connecting to FastCGI server!') from e
+        except (ConnectionResetError, asyncio.IncompleteReadError) as e:
+            if context.headers_sent:
+                raise
+            raise errors.HTTPError(502, 'FastCGI server closed the connection!') from e
+        except asyncio.TimeoutError as e:
+            if context.headers_sent:
+                raise
+            raise errors.HTTPError(504, 'FastCGI server timed out!') from e
+        else:
+            if head is not None:
+                # response ended within the headers
+                set_headers(context, head)
 
         return True
@@ -1,65 +1,315 @@
 import os
-from .base import BaseHandler, prepare_fs, allowed_methods
+import re
+import time
+import gzip
+import secrets
+from .base import BaseHandler, FileEntry, prepare_fs, allowed_methods, get_file_cache
 from ..utils import time as time_utils
+from ..utils.cache import LRUCache
+from ..utils.executor import get_executor, run_blocking
 from ..utils.producers import FileProducer
-from ..utils.mime import checkmime
 
 __all__ = ['FileHandler']
 
+HOT_CACHE_SIZE = 16 * 1024 * 1024
+HOT_CACHE_MAX_FILE = 256 * 1024
+MAX_RANGES = 16
+# ranges closer than the overhead of a part are sent as one
+RANGE_GAP = 80
+
+# preferred first when q-values are equal
+STATIC_ENCODINGS = (
+    ('br', '.br'),
+    ('gzip', '.gz'),
+)
+
+_pattern_etag = re.compile(r'\*|(?:W/)?"[^"]*"')
+
+def match_etag(value, etag, strong=False):
+    '''Check if an `If-Match` or `If-None-Match` header matches `etag`.
+
+    Weak tags never match in strong comparison.
+    '''
+    for tag in _pattern_etag.findall(value):
+        if tag == '*':
+            return True
+        if strong:
+            if tag == etag and not tag.startswith('W/'):
+                return True
+        elif tag.replace('W/', '', 1) == etag.replace('W/', '', 1):
+            return True
+    return False
+
+_pattern_range = re.compile(r'\s*(\d*)\s*-\s*(\d*)\s*', re.ASCII)
+
+def parse_range(value, size, max_ranges=MAX_RANGES):
+    '''Parse a `Range` header (RFC 7233) for a file of `size` bytes.
+
+    Return a sorted list of `(start, end)` with inclusive ends, in which
+    overlapping and nearby ranges are coalesced. It is empty if no range
+    is satisfiable. Return None if the header should be ignored, i.e. it
+    is invalid, not in bytes or has more than `max_ranges` ranges.
+    '''
+    unit, _, specs = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return
+    ranges = []
+    for spec in specs.split(','):
+        if not spec.strip():
+            continue
+        matches = _pattern_range.fullmatch(spec)
+        if matches is None:
+            return
+        first, last = matches.groups()
+        if first:
+            start = int(first)
+            if last:
+                end = int(last)
+                if end < start:
+                    return
+                end = min(end, size - 1)
+            else:
+                end = size - 1
+            if start >= size:
+                continue
+        elif last:
+            # suffix range
+            suffix = int(last)
+            # nothing to take the last bytes of an empty file from
+            if not suffix or not size:
+                continue
+            start = max(0, size - suffix)
+            end = size - 1
+        else:
+            return
+        ranges.append((start, end))
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1 + RANGE_GAP:
+            merged[-1] = merged[-1][0], max(end, merged[-1][1])
+        else:
+            merged.append((start, end))
+    if len(merged) > max_ranges:
+        return
+    return merged
+
+hot_caches = {}
+
+def get_hot_cache(options):
+    '''Get the cache of file bodies limited to `hot_cache_size` bytes.
+
+    Return None if caching is disabled.
+    '''
+    size = options.get('hot_cache_size', HOT_CACHE_SIZE)
+    if not size:
+        return
+    cache = hot_caches.get(size)
+    if cache is None:
+        cache = hot_caches[size] = LRUCache(max_size=size, max_cost=size)
+    return cache
+
+def read_file(path):
+    with open(path, 'rb') as fp:
+        return fp.read()
+
+class HotFile:
+    '''Content of a small file, with its gzipped variant once requested.'''
+    __slots__ = ('body', 'gzipped')
+
+    def __init__(self, body):
+        self.body = body
+        self.gzipped = None
+
+    @property
+    def cost(self):
+        return len(self.body) + len(self.gzipped or b'')
+
 class FileHandler(BaseHandler):
+    name = 'file'
+
     @prepare_fs
     @allowed_methods()
     async def __call__(self, context, options):
-        if self.fs.filetype != 'file':
+        fs = context.fs
+        if fs.filetype != 'file':
             return
-        filepath = self.fs.realpath
-        mimetype, expire = checkmime(filepath)
+        entry = fs.entry
+        mimetype, expire = entry.mime
+        executor = get_executor(options)
         context.headers['Content-Type'] = mimetype
         if expire is not None:
             context.headers['Cache-Control'] = 'max-age=%d, must-revalidate' % expire
-            if self.cache_control(context, filepath):
-                return True
-        if mimetype.startswith('text/'):
-            return self.send_file(context, filepath)
+        if options.get('gzip_static'):
+            encoded = await self.find_static(context, options, fs.realpath)
+            if encoded is not None:
+                encoding, entry = encoded
+                context.headers['Content-Encoding'] = encoding
+        filepath, st = entry.realpath, entry.stat
+        # answer before the file is opened
+        status = self.cache_control(context, options, entry)
+        if status == 304:
+            context.set_status(304)
+            return True
+        elif status is not None:
+            context.send_error(status)
+            return True
+        # named after the requested file, not its `.gz` or `.br` sibling
+        self.set_bin_headers(context, os.path.basename(fs.realpath) if mimetype == 'application/octet-stream' else None)
+        if ('HTTP_RANGE' in context.env and context.request.method == 'GET'
+                and self.check_if_range(context, entry)):
+            ranges = parse_range(
+                context.env['HTTP_RANGE'], st.st_size, options.get('max_ranges', MAX_RANGES))
+            if ranges is not None:
+                return self.write_range(context, filepath, st, mimetype, ranges, executor)
+        return (
+            await self.send_hot(context, options, filepath, st, mimetype)
+            or self.send_file(context, filepath, length=st.st_size, executor=executor)
+        )
+
+    @staticmethod
+    def cache_control(context, options, entry):
+        '''Set validators and evaluate the preconditions of RFC 7232.
+
+        Return 304 or 412 if the request should be answered with that
+        status instead of the content, or None.
+        '''
+        env = context.env
+        mtime = int(entry.stat.st_mtime)
+        context.headers['Last-Modified'] = time_utils.datetime_string(mtime)
+        etag = None
+        if options.get('etag', True):
+            etag = context.headers['ETag'] = entry.etag
+        value = env.get('HTTP_IF_MATCH')
+        if value is not None:
+            # `*` matches any existing file, even without entity tags
+            if not match_etag(value, etag or '', strong=True):
+                return 412
+        else:
+            since = time_utils.parse_date(env.get('HTTP_IF_UNMODIFIED_SINCE', ''))
+            if since is not None and mtime > since:
+                return 412
+        value = env.get('HTTP_IF_NONE_MATCH')
+        if value is not None:
+            if match_etag(value, etag or ''):
+                return 304
         else:
-            return self.write_bin(context, filepath, os.path.basename(filepath) if mimetype == 'application/octet-stream' else None)
+            since = time_utils.parse_date(env.get('HTTP_IF_MODIFIED_SINCE', ''))
+            # dates in the future are invalid
+            if since is not None and mtime <= since <= time.time():
+                return 304
 
     @staticmethod
-    def cache_control(context, path):
-        st = os.stat(path)
-        context.headers['Last-Modified'] = time_utils.datetime_string(st.st_mtime)
-        lm = context.env.get('HTTP_IF_MODIFIED_SINCE')
-        if lm and time_utils.datetime_compare(lm, st.st_mtime):
-            context.set_status(304)
+    def check_if_range(context, entry):
+        '''Check if the `Range` header applies according to `If-Range`.'''
+        value = context.env.get('HTTP_IF_RANGE')
+        if not value:
             return True
-        return False
+        if value.startswith(('"', 'W/')):
+            return value == context.headers.get('ETag')
+        return time_utils.parse_date(value) == int(entry.stat.st_mtime)
 
     @staticmethod
-    def send_file(context, path, start = None, length = None):
-        if not os.path.isfile(path): return
+    def send_file(context, path, start = None, length = None, executor = None):
         if length is None: length = os.path.getsize(path)
         context.headers['Content-Length'] = str(length)
-        return FileProducer(path, start, length)
+        return FileProducer(path, start, length, executor)
 
-    @classmethod
-    def write_bin(cls, context, path, filename=None):
+    @staticmethod
+    async def find_static(context, options, path):
+        '''Find a precompressed sibling of `path` that the client accepts.
+
+        Return `(encoding, entry)`, or None to send `path` itself.
+        '''
+        cache = get_file_cache(options)
+        executor = get_executor(options)
+        best = None
+        for encoding, ext in STATIC_ENCODINGS:
+            entry = await FileEntry.get(path + ext, cache=cache, executor=executor)
+            if entry.filetype != 'file':
+                continue
+            if 'Vary' not in context.headers:
+                context.headers['Vary'] = 'Accept-Encoding'
+            q = context.request.accept_encoding_q(encoding)
+            if context.request.accept_encoding(encoding) and (best is None or q > best[0]):
+                best = q, encoding, entry
+        if best is not None:
+            return best[1:]
+
+    @staticmethod
+    async def send_hot(context, options, path, st, mimetype):
+        '''Send a small file from memory as a single chunk.
+
+        Text types listed in `gzip` are kept gzipped as well so that they
+        are not compressed again for each request. Return None if the file
+        is too large to be cached.
+        '''
+        cache = get_hot_cache(options)
+        if cache is None or st.st_size > options.get('hot_cache_max_file', HOT_CACHE_MAX_FILE):
+            return
+        key = path, st.st_mtime_ns, st.st_size
+        item = cache.get(key)
+        if item is None:
+            item = HotFile(await run_blocking(get_executor(options), read_file, path))
+            cache.set(key, item, item.cost)
+        body = item.body
+        gzip_types = context.config.get('gzip')
+        if gzip_types and mimetype in gzip_types and 'Content-Encoding' not in context.headers:
+            if 'Vary' not in context.headers:
+                context.headers['Vary'] = 'Accept-Encoding'
+            if context.request.accept_encoding('gzip'):
+                if item.gzipped is None:
+                    item.gzipped = gzip.compress(body)
+                    cache.set(key, item, item.cost)
+                body = item.gzipped
+                context.headers['Content-Encoding'] = 'gzip'
+                etag = context.headers.get('ETag')
+                if etag and not etag.startswith('W/'):
+                    # the gzipped body is not byte-for-byte the file
+                    context.headers.replace_header('ETag', 'W/' + etag)
+        context.headers['Content-Length'] = str(len(body))
+        return body,
+
+    @staticmethod
+    def set_bin_headers(context, filename=None):
         if filename:
             context.headers.add_header('Content-Disposition', 'attachment', filename=filename)
         context.headers['Accept-Ranges'] = 'bytes'
-        fsize = os.path.getsize(path)
-        if 'HTTP_RANGE' in context.env:    # protocol_version>='HTTP/1.1' and request_version>='HTTP/1.1':
-            start, end = context.env['HTTP_RANGE'][6:].split('-', 1)
-            try:
-                start = int(start)
-                end = int(end) if end else fsize - 1
-                assert start <= end
-                length = end - start + 1
-            except:
-                context.send_error(400)
-            else:
-                context.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, fsize)
-                if cls.cache_control(context, path): return
-                context.set_status(206)
-                return cls.send_file(context, path, start, length)
-        else:
-            return cls.send_file(context, path, length=fsize)
+
+    @classmethod
+    def write_range(cls, context, path, st, mimetype, ranges, executor=None):
+        '''Send the ranges returned by `parse_range`.
+
+        Several ranges are sent as `multipart/byteranges`, read part by part.
+        '''
+        fsize = st.st_size
+        if not ranges:
+            context.headers['Content-Range'] = 'bytes */%d' % fsize
+            context.send_error(416)
+            return True
+        context.set_status(206)
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            context.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, fsize)
+            return cls.send_file(context, path, start, end - start + 1, executor)
+        boundary = secrets.token_hex(12)
+        parts = []
+        total = 0
+        for start, end in ranges:
+            head = '%s--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+                '\r\n' if parts else '', boundary, mimetype, start, end, fsize)
+            head = head.encode('latin-1')
+            parts.append((head, start, end - start + 1))
+            total += len(head) + end - start + 1
+        tail = ('\r\n--%s--\r\n' % boundary).encode('latin-1')
+        context.headers.replace_header('Content-Type', 'multipart/byteranges; boundary=' + boundary)
+        context.headers['Content-Length'] = str(total + len(tail))
+        return cls.iter_parts(path, parts, tail, executor)
+
+    @staticmethod
+    async def iter_parts(path, parts, tail, executor=None):
+        for head, start, length in parts:
+            yield head
+            async for chunk in FileProducer(path, start, length, executor):
+                yield chunk
+        yield tail
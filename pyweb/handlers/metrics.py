@@ -0,0 +1,18 @@
+from .base import BaseHandler
+from ..utils import errors, metrics
+
+__all__ = ['MetricsHandler']
+
+class MetricsHandler(BaseHandler):
+    '''Serve the metrics of this process at `metrics_path`.'''
+    name = 'metrics'
+
+    async def __call__(self, context, options):
+        path = context.request.path.partition('?')[0]
+        if path != options.get('metrics_path', '/metrics'):
+            return
+        if context.request.method not in ('HEAD', 'GET'):
+            raise errors.HTTPError(405)
+        context.headers['Content-Type'] = metrics.CONTENT_TYPE
+        context.headers['Cache-Control'] = 'no-store'
+        return metrics.registry.render()
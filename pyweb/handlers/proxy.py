@@ -1,27 +1,161 @@
 import asyncio
+import functools
 from urllib import parse
 from .base import BaseHandler
-from ..utils import errors
+from .cache import cached
+from ..utils import errors, httpclient
 
 __all__ = ['ProxyHandler']
 
-BUF_SIZE = 8192
+BUF_SIZE = 65536
+PROXY_TIMEOUT = 60
+TUNNEL_TIMEOUT = 300
 
-class ConnectProtocol(asyncio.Protocol):
-    def __init__(self, writer):
-        self.writer = writer
+def get_pool(options):
+    return httpclient.get_pool(
+        options.get('proxy_max_idle'),
+        options.get('proxy_idle_timeout'),
+        options.get('proxy_connect_timeout'))
 
-    def connection_made(self, transport):
-        self.transport = transport
+def request_body(context, timeout=None):
+    '''Get the body of the request as `(async iterable, chunked)`.
 
-    def connection_lost(self, exc):
-        if self.writer:
-            self.writer = None
+    `chunked` is the only transfer coding understood, and it must be the
+    last one (RFC 7230, section 3.3.3).
+    '''
+    env = context.env
+    transfer_encoding = env.get('HTTP_TRANSFER_ENCODING')
+    if transfer_encoding is not None:
+        codings = [coding.strip().lower() for coding in transfer_encoding.split(',')]
+        if codings[-1] != 'chunked':
+            raise errors.HTTPError(400, 'Invalid Transfer-Encoding')
+        if len(codings) > 1:
+            raise errors.HTTPError(501, 'Unsupported Transfer-Encoding')
+        return check_body(httpclient.iter_chunked(context.reader, timeout)), True
+    try:
+        length = int(env.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        raise errors.HTTPError(400, 'Invalid Content-Length')
+    if length > 0:
+        return httpclient.iter_length(context.reader, length, timeout), False
+    return None, False
 
-    def data_received(self, data):
-        self.writer.write(data, True)
+async def check_body(body):
+    '''Answer a request body with invalid framing with 400, it is not an
+    error of the server it is forwarded to.'''
+    try:
+        async for data in body:
+            yield data
+    except ValueError as e:
+        raise errors.HTTPError(400, 'Invalid request body: %s' % e)
+
+def track_body(context, body):
+    '''Close the client connection after the response unless `body` is
+    read to the end, otherwise the rest of it would be parsed as the next
+    request.'''
+    keep_alive = context.request.keep_alive, context.keep_alive
+    context.request.keep_alive = context.keep_alive = False
+
+    async def iter_body():
+        async for data in body:
+            yield data
+        context.request.keep_alive, context.keep_alive = keep_alive
+
+    return iter_body()
+
+def has_body(context):
+    '''Whether the request has a body, without reading it.'''
+    env = context.env
+    return 'HTTP_TRANSFER_ENCODING' in env or env.get('CONTENT_LENGTH', '') not in ('', '0')
+
+def forward_headers(context, host):
+    '''Headers of the request to pass on, with `Host` set to `host`.'''
+    headers = [
+        (key, value) for key, value in httpclient.strip_hop_by_hop(context.request.header_items)
+        if key.lower() not in ('host', 'expect')
+    ]
+    headers.insert(0, ('Host', host))
+    return headers
+
+async def forward(context, pool, host, port, target, headers, ssl=False, timeout=PROXY_TIMEOUT):
+    '''Send the request to a server and pass its response on.
+
+    Bodies are streamed both ways. Return the body of the response.
+    '''
+    method = context.request.method
+    body, chunked = request_body(context, timeout)
+    if chunked:
+        if context.env.get('CONTENT_LENGTH'):
+            # a request with both may be read differently by the server, so
+            # drop the length and close the connection (RFC 7230, section 3.3.3)
+            headers[:] = [(key, value) for key, value in headers if key.lower() != 'content-length']
+            context.request.keep_alive = False
+            context.keep_alive = False
+        headers.append(('Transfer-Encoding', 'chunked'))
+    if body is not None:
+        body = track_body(context, body)
+    if body is not None and '100-continue' in context.env.get('HTTP_EXPECT', '').lower():
+        # the client waits for this before sending the body
+        context.writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+    try:
+        response = await pool.request(host, port, method, target, headers, body, chunked, ssl, timeout)
+    except asyncio.TimeoutError:
+        raise errors.HTTPError(504, 'Upstream timed out')
+    except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+        raise errors.HTTPError(502, 'Upstream error: %s' % (e or type(e).__name__))
+    context.set_status(response.status, response.reason)
+    for key, value in httpclient.strip_hop_by_hop(response.headers):
+        context.headers[key] = value
+    return response.body
+
+async def splice(reader1, writer1, reader2, writer2, idle_timeout=TUNNEL_TIMEOUT):
+    '''Copy data between two pairs of streams in both directions.
+
+    Stop when both directions reach EOF, either side fails, or no data has
+    been moved for `idle_timeout` seconds. Return the bytes sent to
+    `writer1` and `writer2`.
+    '''
+    loop = asyncio.get_event_loop()
+    last_active = loop.time()
+    sent = [0, 0]
+
+    async def pipe(reader, writer, index):
+        nonlocal last_active
+        while True:
+            try:
+                data = await asyncio.wait_for(reader.read(BUF_SIZE), idle_timeout)
+            except asyncio.TimeoutError:
+                if loop.time() - last_active >= idle_timeout:
+                    raise
+                # the other direction is active
+                continue
+            if not data:
+                break
+            last_active = loop.time()
+            sent[index] += len(data)
+            writer.write(data)
+            await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+
+    tasks = [
+        asyncio.ensure_future(pipe(reader2, writer1, 0)),
+        asyncio.ensure_future(pipe(reader1, writer2, 1)),
+    ]
+    try:
+        done, _pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for task in tasks:
+            task.cancel()
+    for task in done:
+        if not task.cancelled():
+            # retrieve errors, a broken tunnel is just closed
+            task.exception()
+    return sent
 
 class ProxyHandler(BaseHandler):
+    name = 'proxy'
+
     async def __call__(self, context, options):
         if context.request.method == 'CONNECT':
             return await self.handle_connect(context, options)
@@ -29,18 +163,47 @@ class ProxyHandler(BaseHandler):
             return await self.handle_proxy(context, options)
 
     async def handle_connect(self, context, options):
-        context.write(None)
-        host, _, port = context.request.path.partition(':')
-        port = int(port)
-        loop = asyncio.get_event_loop()
-        transport, protocol = await loop.create_connection(lambda : ConnectProtocol(context), host, port)
-        while True:
-            data = await context.reader.read(BUF_SIZE)
-            if not data:
-                break
-            transport.write(data)
-        transport.close()
+        host, _, port = context.request.path.rpartition(':')
+        host = host.strip('[]')
+        try:
+            port = int(port)
+        except ValueError:
+            raise errors.HTTPError(400, 'Invalid CONNECT target')
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port),
+                options.get('proxy_connect_timeout', httpclient.CONNECT_TIMEOUT))
+        except asyncio.TimeoutError:
+            raise errors.HTTPError(504, 'Timed out connecting to %s' % context.request.path)
+        except OSError:
+            raise errors.HTTPError(502, 'Failed connecting to %s' % context.request.path)
+        context.set_status(200, 'Connection established')
+        context.write(None, True)
+        try:
+            sent, _ = await splice(
+                context.reader, context.writer, reader, writer,
+                options.get('proxy_tunnel_timeout', TUNNEL_TIMEOUT))
+        finally:
+            writer.close()
+        context.response_writer.written += sent
         return True
 
     async def handle_proxy(self, context, options):
-        raise errors.HTTPError(501)
+        url = parse.urlsplit(context.request.path)
+        try:
+            port = url.port
+        except ValueError:
+            port = None
+            url = None
+        if url is None or url.scheme not in ('http', 'https') or not url.hostname:
+            raise errors.HTTPError(400, 'Invalid proxy URL')
+        ssl = url.scheme == 'https'
+        if port is None:
+            port = 443 if ssl else 80
+        target = url.path or '/'
+        if url.query:
+            target += '?' + url.query
+        headers = forward_headers(context, url.netloc.rpartition('@')[2])
+        return await cached(context, options, functools.partial(
+            forward, context, get_pool(options), url.hostname, port, target, headers, ssl,
+            options.get('proxy_timeout', PROXY_TIMEOUT)))
@@ -0,0 +1,92 @@
+import functools
+from .base import BaseHandler
+from .cache import cached
+from .proxy import forward, forward_headers, has_body, PROXY_TIMEOUT
+from ..utils import errors, httpclient
+from ..utils.upstream import Balancer
+
+__all__ = ['UpstreamHandler']
+
+# methods that can be sent again after a failure (RFC 7231, section 4.2.2)
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'TRACE', 'PUT', 'DELETE'))
+
+async def release_after(body, balancer, server):
+    '''Pass a response body on and release the server once it is read.'''
+    ok = False
+    try:
+        if body is not None:
+            async for data in body:
+                yield data
+        ok = True
+    finally:
+        balancer.release(server, ok)
+
+def get_balancer_args(options):
+    '''Return `(targets, kw)` of the balancer of a section.'''
+    connections = httpclient.get_pool(
+        options.get('upstream_max_idle'),
+        options.get('upstream_idle_timeout'),
+        options.get('upstream_connect_timeout'))
+    return options.get('upstream_targets'), dict(
+        policy=options.get('upstream_policy'),
+        max_fails=options.get('upstream_max_fails'),
+        fail_timeout=options.get('upstream_fail_timeout'),
+        health_check=options.get('upstream_health_check'),
+        health_interval=options.get('upstream_health_interval'),
+        connections=connections,
+    )
+
+class UpstreamHandler(BaseHandler):
+    '''Reverse proxy to the servers in `upstream_targets`.'''
+    name = 'upstream'
+
+    async def __call__(self, context, options):
+        targets = options.get('upstream_targets')
+        if not targets:
+            return
+        return await cached(context, options, functools.partial(self.run, context, options, targets))
+
+    async def run(self, context, options, targets):
+        targets, kw = get_balancer_args(options)
+        balancer = Balancer.get(targets, **kw)
+        request = context.request
+        env = context.env
+        key = None
+        hash_header = options.get('upstream_hash_header')
+        if hash_header:
+            key = env.get('HTTP_' + hash_header.upper().replace('-', '_'))
+        if key is None:
+            key = env['REMOTE_ADDR']
+        headers = forward_headers(context, env.get('HTTP_HOST') or request.hostname or '')
+        forwarded_for = env.get('HTTP_X_FORWARDED_FOR')
+        remote_addr = env['REMOTE_ADDR'] or 'unix'
+        headers = [(k, v) for k, v in headers if k.lower() not in ('x-forwarded-for', 'x-forwarded-proto')]
+        headers.append(('X-Forwarded-For', forwarded_for + ', ' + remote_addr if forwarded_for else remote_addr))
+        headers.append(('X-Forwarded-Proto', env['REQUEST_SCHEME']))
+        # a streamed request body cannot be sent again
+        retry = request.method in IDEMPOTENT_METHODS and not has_body(context)
+        timeout = options.get('upstream_timeout', PROXY_TIMEOUT)
+        tries = options.get('upstream_tries', len(balancer.servers))
+        tried = []
+        while True:
+            server = balancer.select(key, tried)
+            if server is None:
+                raise errors.HTTPError(502, 'No upstream server available')
+            tried.append(server)
+            balancer.acquire(server)
+            host, port = server.addr
+            try:
+                result = await forward(
+                    context, balancer.connections, host, port, request.path, list(headers),
+                    timeout=timeout)
+            except errors.HTTPError as e:
+                failed = e.status_code in (502, 504)
+                balancer.release(server, not failed)
+                if failed and retry and len(tried) < tries:
+                    context.logger.warning('upstream %s:%s failed, retrying: %s', host, port, e.long_msg)
+                    continue
+                raise
+            except BaseException:
+                balancer.release(server, False)
+                raise
+            return release_after(result, balancer, server)
@@ -1,28 +1,140 @@
+import os
+import signal
 import asyncio
-from gera2ld.pyserve import start_server, serve_forever
-from ..utils import logger
-from .context import HTTPContext
-from .matcher import normalize_config
+import logging
+import threading
+from gera2ld.pyserve import serve_forever, print_urls, get_server_hosts
+from ..utils import logger, accesslog, limits, fcgi, upstream
+from ..handlers.fcgi import get_dispatcher_args
+from ..handlers.upstream import get_balancer_args
+from .matcher import normalize_config, iter_options
+from .listener import Listener
+from .workers import Supervisor
+
+# seconds to let open requests finish when stopping
+SHUTDOWN_TIMEOUT = 30
 
 class HTTPDaemon:
+    '''Serve a config, or a function returning one.
+
+    On SIGHUP, the function is called again, or the same config is read
+    again, and new connections are served with the result.
+    '''
+
     def __init__(self, config):
-        loop = asyncio.get_event_loop()
-        self.config = normalize_config(config)
-        self.servers = []
-        logger.debug('%s', self.config)
+        self.load_config = config if callable(config) else lambda: config
+        self.listeners = {}
+        self.stopping = False
+        # connections of all listeners in this process
+        self.connection_limit = limits.get_connection_limit('global')
+        self.configure(normalize_config(self.load_config()))
+
+    def configure(self, config):
+        self.config = config
+        items = [item for item in config if isinstance(item, dict)]
+        self.workers = max((item.get('workers', 1) for item in items), default=1)
+        self.shutdown_timeout = max((
+            item.get('shutdown_timeout', SHUTDOWN_TIMEOUT) for item in items
+        ), default=SHUTDOWN_TIMEOUT)
+        self.connection_limit.max_connections = max((
+            item.get('global_max_connections', 0) for item in items
+        ), default=0)
+        logger.setLevel(min((
+            item.get('loglevel', logging.INFO) for item in items
+        ), default=logging.INFO))
+        logger.debug('%s', config)
+
+    @property
+    def servers(self):
+        return [server for listener in self.listeners.values() for server in listener.servers]
+
+    async def start_server(self, config_item, socks=None):
+        listener = Listener(config_item, self.connection_limit)
+        self.listeners[listener.bind] = listener
+        await listener.start(socks)
+        return listener
+
+    async def start_servers(self, sockets=None):
+        if sockets is None:
+            sockets = [None] * len(self.config)
+        await asyncio.gather(*(
+            self.start_server(item, socks)
+            for item, socks in zip(self.config, sockets)))
+
+    def reload(self):
+        '''Load the config again and swap it in for new connections.
+
+        Listeners are started or stopped for added or removed `bind`s, and
+        the current config is kept if the new one cannot be loaded.
+        '''
+        try:
+            config = normalize_config(self.load_config())
+        except Exception:
+            logger.exception('failed to load config, keeping the current one')
+            return
+        asyncio.ensure_future(self.apply_config(config))
+
+    async def apply_config(self, config):
+        items = {item.get('bind', ':4000'): item for item in config if isinstance(item, dict)}
+        self.configure(config)
+        # route limits are created again from the new options
+        limits.route_limits.clear()
+        # close backends that only the old config used
+        options = [
+            section for item in config if isinstance(item, dict)
+            for section in iter_options(item)
+        ]
+        fcgi.Dispatcher.retain([
+            get_dispatcher_args(section) for section in options
+            if section.get('fcgi_target')])
+        upstream.Balancer.retain([
+            get_balancer_args(section) for section in options
+            if section.get('upstream_targets')])
+        for bind in list(self.listeners):
+            if bind not in items:
+                listener = self.listeners.pop(bind)
+                asyncio.ensure_future(listener.stop(self.shutdown_timeout))
+        started = []
+        for bind, item in items.items():
+            listener = self.listeners.get(bind)
+            if listener is not None:
+                listener.update(item)
+                continue
+            listener = Listener(item, self.connection_limit)
+            try:
+                await listener.start()
+            except OSError:
+                logger.exception('failed to listen on %s', bind)
+                await listener.stop(0)
+            else:
+                self.listeners[bind] = listener
+                started.extend(listener.servers)
+        print_urls(get_server_hosts(started))
+        logger.info('config reloaded')
 
-    async def start_server(self, config_item):
-        async def handle(reader, writer):
-            handler = HTTPContext(reader, writer, config_item)
-            await handler.handle()
-        bind = config_item.get('bind', ':4000')
-        server = await start_server(handle, bind)
-        self.servers.append(server)
+    def stop(self):
+        '''Stop accepting connections, and stop the loop when the open ones
+        are closed or `shutdown_timeout` has passed.'''
+        if self.stopping:
+            return
+        self.stopping = True
+        asyncio.ensure_future(self.shutdown())
 
-    async def start_servers(self):
-        await asyncio.gather(*(self.start_server(item) for item in self.config))
+    async def shutdown(self):
+        listeners = list(self.listeners.values())
+        self.listeners.clear()
+        await asyncio.gather(*(listener.stop(self.shutdown_timeout) for listener in listeners))
+        asyncio.get_event_loop().stop()
 
     def serve(self):
+        if self.workers > 1 and hasattr(os, 'fork'):
+            Supervisor(self, self.workers).run()
+            return
         loop = asyncio.get_event_loop()
         loop.run_until_complete(self.start_servers())
+        # signals can only be handled when serving from the main thread
+        if hasattr(signal, 'SIGHUP') and threading.current_thread() is threading.main_thread():
+            loop.add_signal_handler(signal.SIGHUP, self.reload)
+            loop.add_signal_handler(signal.SIGTERM, self.stop)
+            loop.add_signal_handler(signal.SIGUSR1, accesslog.reopen_all)
         serve_forever(self.servers)
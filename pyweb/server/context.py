@@ -1,79 +1,220 @@
 import sys
 import asyncio
-import http.client
+import functools
 import http.server
-import logging
+import inspect
+import time
+from time import perf_counter
+from urllib import parse
 from .. import __version__
-from ..utils import logger, writers, errors, time as time_utils, template
-from .request import Request
+from ..utils import logger, writers, errors, metrics, limits, time as time_utils, template
+from ..utils.producers import FileProducer
+from ..utils.accesslog import AccessLog, Record
+from .request import Request, MAX_HEADER_SIZE, MAX_HEADERS
 from .matcher import iter_handlers
 
 DEFAULTS = {
     'protocol_version': (1, 1),
+    'write_buffer_high': 262144,
+    'write_buffer_low': 65536,
 }
+# error pages rendered at startup
+ERROR_CODES = (400, 403, 404, 405, 408, 411, 412, 413, 416, 431, 500, 501, 502, 503, 504)
+
+REQUEST_LABELS = ('listener', 'handler', 'status')
+request_count = metrics.Counter(
+    'pyweb_requests_total', 'Requests handled.', REQUEST_LABELS)
+response_bytes = metrics.Counter(
+    'pyweb_response_bytes_total', 'Bytes of response bodies sent.', REQUEST_LABELS)
+request_time = metrics.Histogram(
+    'pyweb_request_duration_seconds',
+    'Time from receiving the request head to sending the response.', REQUEST_LABELS)
+stage_time = metrics.Histogram(
+    'pyweb_stage_duration_seconds', 'Time spent in each stage of a request.', ('stage',))
+parse_time = stage_time.labels('parse')
+route_time = stage_time.labels('route')
+handle_time = stage_time.labels('handle')
+write_time = stage_time.labels('write')
+
+@functools.lru_cache(maxsize=256)
+def status_line(version, code, message):
+    '''Encoded status line, e.g. `HTTP/1.1 200 OK\\r\\n`.'''
+    return ('HTTP/%d.%d %d %s\r\n' % (*version, code, message)).encode('latin-1', 'strict')
+
+_date_line = None, None
+
+def date_line():
+    '''Encoded `Date` header, updated once per second.'''
+    global _date_line
+    value = time_utils.datetime_string()
+    cached, line = _date_line
+    if cached != value:
+        line = ('Date: %s\r\n' % value).encode()
+        _date_line = value, line
+    return line
+
+class ResponseHeaders:
+    '''Headers of a response, in the order they are set.
+
+    Like `email.message.Message`, setting a header adds it even if it is
+    already set, and lookups are case-insensitive.
+    '''
+    __slots__ = ('_items',)
+
+    def __init__(self):
+        # (lowercase name, name, value)
+        self._items = []
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, name):
+        name = name.lower()
+        for lname, _name, _value in self._items:
+            if lname == name:
+                return True
+        return False
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __setitem__(self, name, value):
+        self._items.append((name.lower(), name, value))
+
+    def __delitem__(self, name):
+        '''Remove all headers of a name, if any.'''
+        name = name.lower()
+        self._items[:] = [item for item in self._items if item[0] != name]
+
+    def get(self, name, default=None):
+        name = name.lower()
+        for lname, _name, value in self._items:
+            if lname == name:
+                return value
+        return default
+
+    def replace_header(self, name, value):
+        '''Replace the value of the first header of a name.'''
+        lname = name.lower()
+        for i, item in enumerate(self._items):
+            if item[0] == lname:
+                self._items[i] = lname, item[1], value
+                return
+        raise KeyError(name)
+
+    def add_header(self, name, value, **params):
+        '''Add a header with parameters, e.g. `filename` in `Content-Disposition`.'''
+        parts = [value]
+        for key, param in params.items():
+            key = key.replace('_', '-')
+            if param.isascii():
+                parts.append('%s="%s"' % (key, param.replace('\\', '\\\\').replace('"', '\\"')))
+            else:
+                # RFC 2231
+                parts.append("%s*=utf-8''%s" % (key, parse.quote(param)))
+        self[name] = '; '.join(parts)
+
+    def items(self):
+        return [(name, value) for _lname, name, value in self._items]
+
+    def clear(self):
+        self._items.clear()
 
 class HTTPContext:
     server_version = 'SLHD/' + __version__
     sys_version = 'Python/' + sys.version.split()[0]
     version_string = server_version + ' ' + sys_version
+    server_line = ('Server: %s\r\n' % version_string).encode()
     protocol_version = DEFAULTS['protocol_version']
     # responses is a dict of {status_code: (short_reason, empty_str_or_long_reason)}
     responses = http.server.BaseHTTPRequestHandler.responses.copy()
+    logger = logger
     # handler_classes = [
     #     handlers.FCGIHandler,
     #     handlers.FileHandler,
     #     handlers.DirectoryHandler,
     #     handlers.NotFoundHandler,
     # ]
+    # State is kept per connection and reset for each request, so that idle
+    # connections are small and requests allocate little.
+    __slots__ = (
+        'reader', 'writer', 'config', 'keep_alive', 'listener', 'record_metrics',
+        'write_buffer_high', 'write_buffer_low', 'base_environ', 'env', 'request',
+        'status', 'fs', 'chunk_mode', 'content_encoding', 'headers', 'headers_sent',
+        'response_writer', 'handler', 'capture', 'access_log', 'idle', 'served', 'draining',
+    )
+
     def __init__(self, reader, writer, config):
         self.reader = reader
         self.writer = writer
-        self.remote_addr = writer.get_extra_info('peername')
-        self.local_addr = writer.get_extra_info('sockname')
+        local_addr = writer.get_extra_info('sockname')
+        remote_addr = writer.get_extra_info('peername')
         self.config = config
-        self.logger = logger
         self.keep_alive = True
-        self.logger.setLevel(config.get('loglevel', logging.INFO))
+        self.idle = True
+        # whether a request has been handled on this connection
+        self.served = False
+        self.draining = False
+        self.listener = config.get('bind', ':4000')
+        self.record_metrics = config.get('metrics', True)
+        self.access_log = AccessLog.get(config)
+        self.write_buffer_high = config.get('write_buffer_high', DEFAULTS['write_buffer_high'])
+        self.write_buffer_low = config.get('write_buffer_low', DEFAULTS['write_buffer_low'])
+        writer.transport.set_write_buffer_limits(self.write_buffer_high, self.write_buffer_low)
         env = self.base_environ = {}
         env['GATEWAY_INTERFACE'] = 'CGI/1.1'
-        if isinstance(self.local_addr, str):
+        if isinstance(local_addr, str):
             env['SERVER_ADDR'] = None
-            env['SERVER_PORT'] = self.local_addr
+            env['SERVER_PORT'] = local_addr
         else:
-            env['SERVER_ADDR'] = self.local_addr[0]
-            env['SERVER_PORT'] = str(self.local_addr[1])
-        if isinstance(self.remote_addr, str):
+            env['SERVER_ADDR'] = local_addr[0]
+            env['SERVER_PORT'] = str(local_addr[1])
+        if isinstance(remote_addr, str):
             env['REMOTE_ADDR'] = None
-            env['REMOTE_PORT'] = self.remote_addr
+            env['REMOTE_PORT'] = remote_addr
+        else:
+            env['REMOTE_ADDR'] = remote_addr[0]
+            env['REMOTE_PORT'] = str(remote_addr[1])
+        if writer.get_extra_info('sslcontext') is not None:
+            env['REQUEST_SCHEME'] = 'https'
+            env['HTTPS'] = 'on'
         else:
-            env['REMOTE_ADDR'] = self.remote_addr[0]
-            env['REMOTE_PORT'] = str(self.remote_addr[1])
+            env['REQUEST_SCHEME'] = 'http'
         env['CONTENT_LENGTH'] = ''
         env['SCRIPT_NAME'] = ''
+        self.request = Request(
+            reader, self.protocol_version,
+            config.get('keep_alive_timeout', 120), None,
+            config.get('max_header_size', MAX_HEADER_SIZE),
+            config.get('max_headers', MAX_HEADERS))
+        self.headers = ResponseHeaders()
+        self.response_writer = writers.ResponseWriter(writer, logger)
         self.clean()
 
     async def handle(self):
-        while self.keep_alive:
+        # a new connection is given its first request even if draining
+        while self.keep_alive and not (self.draining and self.served):
             try:
                 await self.handle_one_request()
-            except (TimeoutError, ConnectionError):
+            except (TimeoutError, ConnectionError, asyncio.IncompleteReadError):
                 self.keep_alive = False
             except:
                 import traceback
                 traceback.print_exc()
                 self.keep_alive = False
             finally:
-                if self.request and self.request.requestline:
-                    written = self.raw_writer.written if self.raw_writer else '-'
-                    self.logger.info('%s->%s "%s" %d %s',
-                        self.env['REMOTE_ADDR'], self.env.get('HTTP_HOST', '-'),
-                        self.request.requestline, self.status[0], written)
+                if self.request.requestline:
+                    self.served = True
+                    self.log_request()
                 self.clean()
         self.writer.close()
 
     async def handle_one_request(self):
-        self.request = Request(self.reader, self.protocol_version, self.config.get('keep_alive_timeout', 120), self.env)
-        self.headers = http.client.HTTPMessage()
+        self.env = self.base_environ.copy()
+        self.request.reset(self.env)
+        sending = None
+        admitted = None
+        self.idle = True
         try:
             try:
                 assert await self.request.parse()
@@ -84,41 +225,116 @@ class HTTPContext:
             except AssertionError:
                 self.keep_alive = False
                 return
+            self.idle = False
+            if self.draining:
+                self.request.keep_alive = False
             self.keep_alive = self.request.keep_alive
             if self.request.method == 'CONNECT':
                 self.keep_alive = False
-            for handle, options in iter_handlers(self.request, self.config):
+            now = self.mark(parse_time, self.request.started)
+            chain = iter_handlers(self.request, self.config)
+            now = self.mark(route_time, now)
+            for handle, options in chain:
                 self.logger.debug('get handler: %s, %s', handle, options)
+                self.handler = handle
+                limit = limits.get_route_limit(options)
+                if limit is not None:
+                    await self.admit(limit, options)
+                    admitted = limit
                 gen = await handle(self, options)
                 if gen:
-                    if gen is not True:
-                        for chunk in gen:
-                            self.write(chunk)
-                            await self.writer.drain()
+                    sending = self.mark(handle_time, now)
+                    await self.send_body(gen)
                     break
+                if admitted is not None:
+                    # the handler passed, do not hold the slot for the next ones
+                    admitted.release()
+                    admitted = None
             else:
+                self.handler = None
                 self.send_error(404)
         except errors.HTTPError as e:
             self.send_error(e.status_code, e.long_msg)
             self.keep_alive = False
+        finally:
+            if admitted is not None:
+                admitted.release()
         self.write(None)
-        self.buffer.flush()
-        self.buffer.close()
+        self.response_writer.close()
         await self.writer.drain()
+        if sending is not None:
+            self.mark(write_time, sending)
 
-    def send_response_only(self, code, message = None):
-        """Send the response header only."""
+    async def admit(self, limit, options):
+        '''Wait for a route limit, or reject the request with 503.'''
+        reason = await limit.acquire()
+        if reason is not None:
+            self.headers['Retry-After'] = str(options.get('retry_after', limits.RETRY_AFTER))
+            raise errors.HTTPError(503, 'Too many requests are being handled, please retry later.')
+
+    def shutdown(self):
+        '''Close the connection after the current request, or now if it is
+        waiting for another one.
+
+        A new connection may be sending its first request already, it is
+        answered and closed then.
+        '''
+        self.draining = True
+        if self.idle and self.served:
+            self.writer.close()
+        else:
+            # tell the client, unless the headers are sent
+            self.request.keep_alive = False
+
+    def mark(self, stage, since):
+        '''Record the time of a stage that started at `since`.
+
+        Return the current time, where the next stage starts.
+        '''
+        now = perf_counter()
+        if self.record_metrics:
+            stage.observe(now - since)
+        return now
+
+    def log_request(self):
+        '''Write the access log record and metrics of a request.'''
+        request = self.request
+        env = self.env
+        duration = perf_counter() - request.started
+        handler = getattr(self.handler, 'name', 'none')
+        code = self.status[0]
+        if self.access_log is not None:
+            self.access_log.write(Record(
+                time.time(), env['REMOTE_ADDR'], env.get('HTTP_HOST'), request.requestline,
+                code, self.response_writer.written if self.headers_sent else '-',
+                env.get('HTTP_REFERER'), env.get('HTTP_USER_AGENT'), duration, handler))
+        if self.record_metrics:
+            key = self.listener, handler, str(code)
+            request_count.labels(*key).inc()
+            if self.headers_sent:
+                response_bytes.labels(*key).inc(self.response_writer.written)
+            request_time.labels(*key).observe(duration)
+
+    def encode_head(self, code, message = None):
+        """Return the encoded status line and headers."""
         if message is None:
             if code in self.responses:
                 message = self.responses[code][0]
             else:
                 message = ''
         if self.request.protocol_version != (0, 9):
-            header_lines = ['HTTP/%d.%d %d %s\r\n' % (*self.protocol_version, code, message)]
-            for key, value in self.headers.items():
-                header_lines.append('%s: %s\r\n' % (key, value))
-            header_lines.append('\r\n')
-            self.writer.writelines(line.encode('latin-1', 'strict') for line in header_lines)
+            headers = self.headers
+            parts = [status_line(self.protocol_version, code, message)]
+            if headers:
+                parts.append(''.join(['%s: %s\r\n' % item for item in headers.items()]).encode('latin-1', 'strict'))
+            if 'server' not in headers:
+                parts.append(self.server_line)
+            if 'date' not in headers:
+                parts.append(date_line())
+            parts.append(b'\r\n')
+            head = b''.join(parts)
+        else:
+            head = None
         connection = self.headers.get('connection')
         if connection:
             connection = connection.lower();
@@ -126,14 +342,25 @@ class HTTPContext:
                 self.keep_alive = False
             elif connection == 'keep-alive':
                 self.keep_alive = True
+        return head
 
     def check_headers(self):
         if self.request.method == 'CONNECT': return
-        if self.request.accept_encoding('gzip'):
+        # handlers may send content that is already encoded
+        gzip = self.config.get('gzip')
+        if gzip and 'content-encoding' not in self.headers:
             content_type = self.headers.get('content-type', '')
-            gzip = self.config.get('gzip')
-            if gzip and content_type in gzip:
-                self.content_encoding = 'gzip'
+            if content_type in gzip:
+                if 'vary' not in self.headers:
+                    self.headers['Vary'] = 'Accept-Encoding'
+                # ranges refer to the content as it is
+                if self.request.accept_encoding('gzip') and self.status[0] != 206:
+                    etag = self.headers.get('etag')
+                    if etag and not etag.startswith('W/'):
+                        # the compressed body is not byte-for-byte the same
+                        self.headers.replace_header('ETag', 'W/' + etag)
+                    if self.status[0] not in (204, 304):
+                        self.content_encoding = 'gzip'
         if self.request.protocol_version >= (1, 1):
             if not self.request.keep_alive:
                 self.headers['connection'] = 'close'
@@ -155,19 +382,17 @@ class HTTPContext:
             self.headers['transfer-encoding'] = 'chunked'
 
     def send_headers(self):
+        if self.capture is not None:
+            self.capture.start(self.status, self.headers.items())
         self.check_headers()
-        self.headers.add_header('Server', self.version_string)
-        self.headers.add_header('Date', time_utils.datetime_string())
-        # send headers
-        self.send_response_only(*self.status)
+        # headers are sent with the first piece of the body
+        head = self.encode_head(*self.status)
         self.headers_sent = True
-        writer = self.raw_writer = writers.RawWriter(self.writer, self.logger)
-        if self.chunk_mode:
-            writer = writers.ChunkedWriter(writer, self.logger)
-        writer = writers.BufferedWriter(writer, self.logger)
-        if self.content_encoding == 'gzip':
-            writer = writers.GZipWriter(writer, self.logger)
-        self.buffer = writer
+        writer = self.response_writer
+        if self.request.method == 'HEAD':
+            writer.start(head)
+        else:
+            writer.start(head, self.chunk_mode, self.content_encoding == 'gzip')
 
     def write(self, data, flush=False):
         if not self.headers_sent:
@@ -176,23 +401,93 @@ class HTTPContext:
             if isinstance(data, str):
                 data = data.encode('utf-8', 'ignore')
             if data:
-                self.buffer.write(data)
-            if flush:
-                self.buffer.flush()
+                self.response_writer.write(data)
+                if self.capture is not None:
+                    self.capture.write(data)
+        if flush:
+            self.response_writer.flush()
+
+    async def drain(self):
+        '''Wait for the transport buffer to drain below its low-water mark.
+
+        Return at once unless the buffer is over its high-water mark, so
+        that small chunks do not cost a loop round-trip each.
+        '''
+        transport = self.writer.transport
+        if transport.is_closing():
+            raise ConnectionResetError('Connection lost')
+        if transport.get_write_buffer_size() > self.write_buffer_high:
+            await self.writer.drain()
+
+    async def send_body(self, body):
+        '''Write the body returned by a handler.
+
+        `body` may be `True` if the response is already sent, a string, an
+        awaitable that results in a body, an async iterable or an iterable
+        of chunks. Chunks of an async iterable are sent as they come, so
+        that streams such as server-sent events are not held back.
+        '''
+        while inspect.isawaitable(body):
+            body = await body
+        if not body or body is True:
+            return
+        if isinstance(body, (str, bytes, bytearray, memoryview)):
+            self.write(body)
+        elif isinstance(body, FileProducer) and await self.sendfile(body):
+            pass
+        elif hasattr(body, '__aiter__'):
+            try:
+                async for chunk in body:
+                    self.write(chunk, flush=True)
+                    await self.drain()
+            finally:
+                # release what the producer holds if the client is gone
+                if hasattr(body, 'aclose'):
+                    await body.aclose()
+        else:
+            for chunk in body:
+                self.write(chunk)
+                await self.drain()
+
+    async def sendfile(self, producer):
+        '''Send a file producer with the sendfile syscall.
+
+        Return False if the body has to go through the writers, i.e. it is
+        compressed or chunked, or the transport does not support sendfile.
+        '''
+        if not self.config.get('sendfile', True):
+            return False
+        if not self.headers_sent:
+            self.send_headers()
+        if self.request.method == 'HEAD':
+            producer.close()
+            return True
+        if self.chunk_mode or self.content_encoding != 'deflate':
+            return False
+        self.response_writer.flush()
+        try:
+            sent = await producer.sendfile(self.writer.transport)
+        except RuntimeError as e:
+            self.logger.debug('sendfile not available: %s', e)
+            return False
+        self.response_writer.written += sent
+        return True
 
     def set_status(self, code=200, message=None):
         self.status = code, message
 
     def clean(self):
         self.set_status()
-        self.env = self.base_environ.copy()
-        self.request = None
+        # the environment is copied when a request arrives
+        self.env = None
+        self.fs = None
         self.chunk_mode = False
         self.content_encoding = 'deflate'
-        self.headers = None
+        self.headers.clear()
         self.headers_sent = False
-        self.buffer = None
-        self.raw_writer = None
+        self.handler = None
+        # records the response for caches
+        self.capture = None
 
     def redirect(self, url, code = 303, message = None):
         if self.headers_sent:
@@ -203,14 +498,27 @@ class HTTPContext:
             message = 'The URL has been moved <a href="%s">here</a>.' % url
         self.write(message)
 
+    @classmethod
+    def render_error(cls, code, message = None):
+        if message is None:
+            _, message = cls.responses.get(code, (None, '???'))
+        return template.render(args={
+            'title': 'Error...',
+            'header': 'Error response',
+            'body': '<p>Error code: {}</p><p>Message: {}</p>'.format(code, message),
+        }).encode('utf-8')
+
     def send_error(self, code, message = None):
         if code >= 200 and code not in (204, 304):
-            self.headers['content-type'] = 'text/html'
-            if message is None:
-                _, message = self.responses.get(code, (None, '???'))
+            body = self.error_pages.get(code) if message is None else None
+            if body is None:
+                body = self.render_error(code, message)
+            # replace headers set for the content
+            del self.headers['content-type']
+            del self.headers['content-length']
+            self.headers['Content-Type'] = 'text/html'
+            self.headers['Content-Length'] = str(len(body))
             self.set_status(code)
-            self.write(template.render(args={
-                'title': 'Error...',
-                'header': 'Error response',
-                'body': '<p>Error code: {}</p><p>Message: {}</p>'.format(code, message),
-            }))
+            self.write(body)
+
+HTTPContext.error_pages = {code: HTTPContext.render_error(code) for code in ERROR_CODES}
@@ -0,0 +1,82 @@
+import socket
+import asyncio
+from gera2ld.pyserve import start_server
+from ..utils import logger, limits
+from .context import HTTPContext
+
+class Listener:
+    '''Serve connections on `bind` with a config item.
+
+    The config item can be replaced while serving, connections keep the
+    item they were accepted with until they are closed.
+    '''
+
+    def __init__(self, config, global_limit):
+        self.bind = config.get('bind', ':4000')
+        self.servers = []
+        self.connections = set()
+        self.drained = None
+        self.connection_limits = global_limit, limits.get_connection_limit(self.bind)
+        self.update(config)
+
+    def update(self, config):
+        '''Serve new connections with `config`, and close the others once
+        their current request is done.'''
+        self.config = config
+        limit = self.connection_limits[1]
+        limit.max_connections = config.get('max_connections', 0)
+        limit.max_per_ip = config.get('max_connections_per_ip', 0)
+        self.retry_after = config.get('retry_after', limits.RETRY_AFTER)
+        for context in list(self.connections):
+            context.shutdown()
+
+    async def start(self, socks=None):
+        if socks is None:
+            server = await start_server(self.handle, self.bind)
+            self.servers.append(server)
+            return
+        for sock in socks:
+            if sock.family == socket.AF_UNIX:
+                server = await asyncio.start_unix_server(self.handle, sock=sock)
+            else:
+                server = await asyncio.start_server(self.handle, sock=sock)
+            self.servers.append(server)
+
+    async def handle(self, reader, writer):
+        remote_addr = writer.get_extra_info('peername')
+        ip = remote_addr[0] if isinstance(remote_addr, tuple) else None
+        if limits.admit(self.connection_limits, ip) is not None:
+            await limits.reject(writer, self.retry_after)
+            return
+        context = None
+        try:
+            context = HTTPContext(reader, writer, self.config)
+            self.connections.add(context)
+            await context.handle()
+        finally:
+            self.connections.discard(context)
+            limits.release(self.connection_limits, ip)
+            if not self.connections and self.drained is not None and not self.drained.done():
+                self.drained.set_result(None)
+
+    async def stop(self, timeout):
+        '''Stop accepting connections and wait for the open ones to finish.
+
+        Connections still open after `timeout` seconds are aborted.
+        '''
+        for server in self.servers:
+            server.close()
+        for context in list(self.connections):
+            context.shutdown()
+        if self.connections:
+            self.drained = asyncio.get_event_loop().create_future()
+            try:
+                await asyncio.wait_for(self.drained, timeout)
+            except asyncio.TimeoutError:
+                logger.warning(
+                    'aborting %d connections on %s after %s seconds',
+                    len(self.connections), self.bind, timeout)
+                for context in list(self.connections):
+                    context.writer.transport.abort()
+        await asyncio.gather(*(server.wait_closed() for server in self.servers))
+        limits.remove_connection_limit(self.connection_limits[1])
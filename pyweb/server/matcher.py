@@ -1,10 +1,14 @@
 import re
+import functools
+import collections
 from ..handlers import *
 
 def error_handler(code):
     if code > 300 and code <= 999:
-        def handle(handler):
-            handler.send_error(code)
+        async def handle(context, options):
+            context.send_error(code)
+            return True
+        handle.name = 'error'
         return handle
 
 handlers = {
@@ -12,38 +16,42 @@ handlers = {
     'file': FileHandler(),
     'dir': DirectoryHandler(),
     'fcgi': FCGIHandler(),
+    'upstream': UpstreamHandler(),
+    'metrics': MetricsHandler(),
 }
 
-def test_host(rule):
-    reg = re.compile(rule.replace('.', r'\.').replace('*', '.*'))
-    def test(request):
-        hostname = request.hostname
-        return reg.search(hostname) is not None
-    return test
+def parse_host_rule(rule):
+    '''Parse `h:` rules, `*` matches any characters.'''
+    rule = rule.lower()
+    if '*' in rule:
+        return 'host~', re.compile(re.escape(rule).replace(r'\*', '.*'))
+    return 'host', rule
 
-def test_path(rule):
+def parse_path_rule(rule):
+    '''Parse `p:` rules, which are regexps (`~`), exact paths (`=`) or prefixes.'''
     if rule.startswith('~'):
-        reg = re.compile(rule[1:])
-        def test(request):
-            path = request.path
-            return reg.search(path) is not None
+        return 'path~', re.compile(rule[1:])
     elif rule.startswith('='):
-        def test(request):
-            path = request.path
-            return path == rule
+        return 'path=', rule[1:]
     elif rule.startswith('/'):
         if rule.endswith('/'):
             rule = rule[:-1]
-        rule_slash = rule + '/'
-        def test(request):
-            path = request.path
-            return path == rule or path.startswith(rule_slash)
+        return 'path', rule
     else:
         print('Invalid rule:', rule)
-        return
-    return test
 
 def normalize_config(items, parent_options=None):
+    '''Normalize config items and compile a router for each of them.
+
+    The input is not modified.
+    '''
+    nitems = normalize_items(items, parent_options)
+    for item in nitems:
+        if isinstance(item, dict):
+            item['router'] = Router(item, item.get('route_cache_size', 1024))
+    return nitems
+
+def normalize_items(items, parent_options=None):
     if not isinstance(items, list):
         items = [items]
     nitems = []
@@ -58,18 +66,18 @@ def normalize_match(match):
         return
     if isinstance(match, str):
         match = [match]
-    tests = []
+    rules = []
     for item in match:
         pre, _, rule = item.partition(':')
-        test = None
+        parsed = None
         if pre == 'h':
-            test = test_host(rule)
+            parsed = parse_host_rule(rule)
         elif pre == 'p':
-            test = test_path(rule)
-        if test:
-            tests.append(test)
-    if tests:
-        return tests
+            parsed = parse_path_rule(rule)
+        if parsed:
+            rules.append(parsed)
+    if rules:
+        return tuple(rules)
 
 def normalize_config_item(config, parent_options=None):
     if not config:
@@ -88,34 +96,140 @@ def normalize_config_item(config, parent_options=None):
         section_options = config.get('options')
         if section_options is not None:
             options.update(section_options)
+            if 'max_concurrency' in section_options:
+                # sections inheriting the limit share it
+                options['route_limit_key'] = object()
+        config = dict(config)
         config['options'] = options
-        config['handler'] = normalize_config(config.get('handler'), options)
+        config['handler'] = normalize_items(config.get('handler'), options)
         config['match'] = normalize_match(config.get('match'))
         return config
 
-def match_request(request, match):
-    if match is not None:
-        for test in match:
-            if test(request):
+def iter_options(config):
+    '''Iterate over the options of a normalized config item and its sections.'''
+    yield config['options']
+    for item in config['handler']:
+        if isinstance(item, dict):
+            yield from iter_options(item)
+
+class PathTrie:
+    '''Prefix tree of path rules, split by `/`.
+
+    A rule matches a path equal to it or starting with it followed by `/`,
+    i.e. when its segments are a prefix of the path segments.
+    '''
+    def __init__(self):
+        self.root = {}
+
+    def add(self, prefix, value):
+        node = self.root
+        for segment in prefix.split('/'):
+            node = node.setdefault(segment, {})
+        # None never collides with a path segment
+        node.setdefault(None, []).append(value)
+
+    def collect(self, path, found):
+        node = self.root
+        for segment in path.split('/'):
+            node = node.get(segment)
+            if node is None:
                 break
+            found.update(node.get(None, ()))
+
+class MatchIndex:
+    '''Index of the match rules of sibling items.
+
+    `lookup` returns the positions of the items matching a request, in
+    config order.
+    '''
+    def __init__(self, matches):
+        self.always = []
+        self.hosts = {}
+        self.host_patterns = []
+        self.paths = {}
+        self.prefixes = PathTrie()
+        self.path_patterns = []
+        for i, rules in enumerate(matches):
+            if rules is None:
+                self.always.append(i)
+                continue
+            for kind, rule in rules:
+                if kind == 'host':
+                    self.hosts.setdefault(rule, []).append(i)
+                elif kind == 'host~':
+                    self.host_patterns.append((rule, i))
+                elif kind == 'path=':
+                    self.paths.setdefault(rule, []).append(i)
+                elif kind == 'path':
+                    self.prefixes.add(rule, i)
+                elif kind == 'path~':
+                    self.path_patterns.append((rule, i))
+
+    def lookup(self, hostname, path):
+        found = set(self.always)
+        if hostname:
+            found.update(self.hosts.get(hostname, ()))
+            for reg, i in self.host_patterns:
+                if i not in found and reg.fullmatch(hostname):
+                    found.add(i)
+        found.update(self.paths.get(path, ()))
+        self.prefixes.collect(path, found)
+        for reg, i in self.path_patterns:
+            if i not in found and reg.search(path):
+                found.add(i)
+        return sorted(found)
+
+Section = collections.namedtuple('Section', 'port options children index')
+
+def compile_section(config):
+    '''Compile a normalized config item into an immutable Section.'''
+    children = []
+    matches = []
+    for item in config['handler']:
+        if isinstance(item, dict):
+            children.append(compile_section(item))
+            matches.append(item['match'])
         else:
-            return False
-    return True
-
-def iter_handlers(request, config, options={}):
-    if callable(config):
-        yield config, options
-    elif isinstance(config, list):
-        for item in config:
-            yield from iter_handlers(request, item, options)
-    elif isinstance(config, dict):
-        if request.method == 'CONNECT' or '://' in request.path:
-            host_ok = True
-        else:
-            port = config.get('port')
-            host_ok = port is None or request.port is None or request.port == port
-        match = config.get('match')
-        handler = config.get('handler')
-        options = config.get('options')
-        if host_ok and match_request(request, match):
-            yield from iter_handlers(request, handler, options)
+            children.append(item)
+            matches.append(None)
+    return Section(
+        config.get('port'), config['options'],
+        tuple(children), MatchIndex(matches))
+
+class Router:
+    '''Resolve requests to handler chains.
+
+    Results are cached by hostname, port and path.
+    '''
+    def __init__(self, config, cache_size=1024):
+        # wrap the item so that its own match rules are checked too
+        self.root = Section(
+            None, {}, (compile_section(config),), MatchIndex([config['match']]))
+        self.resolve_key = functools.lru_cache(maxsize=cache_size)(self._resolve)
+
+    def resolve(self, request):
+        '''Return a tuple of `(handle, options)` for a request.'''
+        hostname = request.hostname
+        if hostname:
+            hostname = hostname.lower()
+        # proxy requests are not bound to the port of the listener
+        any_port = request.method == 'CONNECT' or '://' in request.path
+        return self.resolve_key(hostname, request.port, request.path, any_port)
+
+    def _resolve(self, hostname, port, path, any_port):
+        chain = []
+        self._collect(self.root, hostname, port, path, any_port, chain)
+        return tuple(chain)
+
+    def _collect(self, section, hostname, port, path, any_port, chain):
+        if not any_port and section.port is not None and port is not None and port != section.port:
+            return
+        for i in section.index.lookup(hostname, path):
+            child = section.children[i]
+            if isinstance(child, Section):
+                self._collect(child, hostname, port, path, any_port, chain)
+            else:
+                chain.append((child, section.options))
+
+def iter_handlers(request, config):
+    return iter(config['router'].resolve(request))
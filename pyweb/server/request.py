@@ -1,29 +1,156 @@
-import email.parser
-import http.client
 import asyncio
+import re
+from time import perf_counter
+from types import MappingProxyType
 from ..utils import errors
 
+MAX_HEADER_SIZE = 65536
+MAX_HEADERS = 100
+
+_pattern_eol = re.compile(r'\r?\n')
+# q-values of an absent header, shared as it is never modified
+NO_VALUES = MappingProxyType({})
+
+class Headers(dict):
+    '''A case-insensitive mapping of request headers.
+
+    Repeated headers are joined with commas.
+    '''
+    __slots__ = ()
+
+    def __init__(self, items=()):
+        super().__init__()
+        for key, value in items:
+            key = key.lower()
+            oldvalue = super().get(key)
+            super().__setitem__(key, value if oldvalue is None else oldvalue + ', ' + value)
+
+    def __getitem__(self, key):
+        return super().__getitem__(key.lower())
+
+    def __contains__(self, key):
+        return super().__contains__(key.lower())
+
+    def get(self, key, default=None):
+        return super().get(key.lower(), default)
+
 class Request:
+    '''A request read from a connection.
+
+    The object is kept for the whole connection and reset before reading
+    each request.
+    '''
+    __slots__ = (
+        'reader', 'server_protocol_version', 'keep_alive_timeout', 'max_header_size',
+        'max_headers', 'protocol_version', 'keep_alive', 'requestline', 'started',
+        'method', 'path', 'hostname', 'port', 'header_items', 'env', '_headers',
+        '_accept', '_accept_encoding',
+    )
+
     def __init__(self, reader, protocol_version,
-            keep_alive_timeout=120, env={}):
+            keep_alive_timeout=120, env=None,
+            max_header_size=MAX_HEADER_SIZE, max_headers=MAX_HEADERS):
         self.reader = reader
-        self.protocol_version = protocol_version
-        self.keep_alive = False
+        self.server_protocol_version = protocol_version
         self.keep_alive_timeout = keep_alive_timeout
+        self.max_header_size = max_header_size
+        self.max_headers = max_headers
+        self.header_items = []
+        self.reset({} if env is None else env)
+
+    def reset(self, env):
+        '''Forget the last request, `env` is filled by the next one.'''
+        self.protocol_version = self.server_protocol_version
+        self.keep_alive = False
         self.requestline = None
+        # when the head has been received, for latency metrics
+        self.started = None
         self.method = None
         self.path = None
         self.hostname = None
         self.port = None
-        self.headers = None
+        self.header_items.clear()
         self.env = env
-        self._accept = None
+        self._headers = None
+        self._accept = NO_VALUES
+        self._accept_encoding = NO_VALUES
+
+    @property
+    def headers(self):
+        '''Case-insensitive header map, built on first access.'''
+        if self._headers is None:
+            self._headers = Headers(self.header_items)
+        return self._headers
+
+    async def read_head(self):
+        '''Read the request line and header block.
+
+        Empty lines before the request line are ignored. Requests pipelined
+        after this one stay in the reader's buffer.
+        '''
+        while True:
+            try:
+                head = await asyncio.wait_for(self.read_lines(), self.keep_alive_timeout)
+            except asyncio.IncompleteReadError:
+                return
+            if len(head) > self.max_header_size:
+                raise errors.HTTPError(431, 'Request header fields too large')
+            if head:
+                return head
+
+    async def read_lines(self):
+        '''Read the lines of a head, or an empty line before it.
+
+        The header block after a request line ending with CRLF is read in
+        one call. Lines ending with a bare LF are read one by one.
+        '''
+        line = await self.read_until(b'\n')
+        if line in (b'\r\n', b'\n'):
+            return b''
+        if line.endswith(b'\r\n'):
+            # no header block, or the start of its first line
+            start = await self.reader.readexactly(2)
+            if start == b'\r\n':
+                return line + start
+            if b'\r' in start or b'\n' in start:
+                raise errors.HTTPError(400, 'Bad header line')
+            return line + start + await self.read_until(b'\r\n\r\n', len(line) + 2)
+        lines = [line]
+        size = len(line)
+        while line not in (b'\r\n', b'\n'):
+            if size > self.max_header_size:
+                raise errors.HTTPError(431, 'Request header fields too large')
+            line = await self.read_until(b'\n', size)
+            lines.append(line)
+            size += len(line)
+        return b''.join(lines)
+
+    async def read_until(self, separator, size=0):
+        '''Read up to and including `separator`.
+
+        Unlike `StreamReader.readuntil`, the data is bound by
+        `max_header_size` rather than the limit of the reader, `size` being
+        the length of the head before it.
+        '''
+        parts = []
+        while True:
+            try:
+                parts.append(await self.reader.readuntil(separator))
+                return b''.join(parts)
+            except asyncio.LimitOverrunError as e:
+                # take what cannot be part of the separator and go on
+                size += e.consumed
+                if size > self.max_header_size:
+                    raise errors.HTTPError(431, 'Request header fields too large')
+                parts.append(await self.reader.readexactly(e.consumed))
 
     async def parse(self):
-        requestline = await asyncio.wait_for(self.reader.readline(), self.keep_alive_timeout)
-        if not requestline:
+        head = await self.read_head()
+        if not head:
             return
-        self.requestline = requestline.strip().decode()
+        self.started = perf_counter()
+        lines = _pattern_eol.split(head.decode())
+        self.requestline = lines[0].strip()
         if not self.requestline:
             return
         words = self.requestline.split(' ')
@@ -39,66 +166,112 @@ class Request:
             self.keep_alive = True
         if protocol_version < self.protocol_version:
             self.protocol_version = protocol_version
-        # Examine the headers and look for a Connection directive.
-        header_lines = []
-        while True:
-            line = await asyncio.wait_for(self.reader.readline(), self.keep_alive_timeout)
-            if not line.strip():
-                break
-            header_lines.append(line.decode())
-        try:
-            parser = email.parser.Parser(_class=http.client.HTTPMessage)
-            self.headers = parser.parsestr(''.join(header_lines))
-        except http.client.LineTooLong:
-            raise errors.HTTPError(400, "Line too long")
-        conntype = self.headers.get('Connection', "")
-        if conntype.lower() == 'close':
-            self.keep_alive = False
-        elif conntype.lower() == 'keep-alive' and protocol_version >= (1, 1):
-            self.keep_alive = True
-        self.env['SERVER_PROTOCOL'] = 'HTTP/%d.%d' % protocol_version
-        self.env['REQUEST_METHOD'] = self.method
-        self.env['CONTENT_TYPE'] = self.headers.get('content-type')
-        self.env['CONTENT_LENGTH'] = self.headers.get('content-length')
-        for key, value in self.headers.items():
+        items = self.header_items
+        for line in lines[1:]:
+            if not line:
+                continue
+            if line[0] in ' \t':
+                # obsolete line folding
+                if not items:
+                    raise errors.HTTPError(400, 'Bad header continuation')
+                key, value = items[-1]
+                items[-1] = key, value + ' ' + line.strip()
+                continue
+            key, sep, value = line.partition(':')
+            if not sep or not key or key != key.strip():
+                raise errors.HTTPError(400, 'Bad header line')
+            items.append((key, value.strip()))
+        if len(items) > self.max_headers:
+            raise errors.HTTPError(431, 'Too many request header fields')
+        env = self.env
+        env['SERVER_PROTOCOL'] = 'HTTP/%d.%d' % protocol_version
+        env['REQUEST_METHOD'] = self.method
+        env['REQUEST_URI'] = self.path
+        conntype = accept = accept_encoding = None
+        for key, value in items:
+            lkey = key.lower()
+            if lkey == 'content-type':
+                env['CONTENT_TYPE'] = value
+                continue
+            if lkey == 'content-length':
+                env['CONTENT_LENGTH'] = value
+                continue
+            if lkey == 'connection':
+                conntype = value
+            elif lkey == 'accept':
+                accept = value if accept is None else accept + ',' + value
+            elif lkey == 'accept-encoding':
+                accept_encoding = value if accept_encoding is None else accept_encoding + ',' + value
             key = key.replace('-', '_').upper()
-            if key in self.env:
+            if key in env:
                 continue
             key = 'HTTP_' + key
-            value = value.strip()
-            oldvalue = self.env.get(key)
+            oldvalue = env.get(key)
             if oldvalue is None:
-                self.env[key] = value
+                env[key] = value
             else:
-                self.env[key] = oldvalue + ',' + value
-        self.env['REQUEST_URI'] = self.path
-        host = self.env.get('HTTP_HOST')
-        self.port = None
+                env[key] = oldvalue + ',' + value
+        if conntype:
+            conntype = conntype.lower()
+            if conntype == 'close':
+                self.keep_alive = False
+            elif conntype == 'keep-alive' and protocol_version >= (1, 1):
+                self.keep_alive = True
+        host = env.get('HTTP_HOST')
         if host:
-            hostname, _, port = host.rpartition(':')
-            if _:
-                self.hostname = hostname
-                self.port = int(port)
-        self._accept = self.init_q(self.headers.get('accept'))
-        self._accept_encoding = self.init_q(self.headers.get('accept-encoding'))
+            self.hostname, self.port = self.parse_host(host)
+        self._accept = self.init_q(accept)
+        self._accept_encoding = self.init_q(accept_encoding)
         return True
 
+    @staticmethod
+    def parse_host(host):
+        hostname, _, port = host.rpartition(':')
+        if not _ or hostname.startswith('[') and not hostname.endswith(']'):
+            # no port, or an IPv6 address without port
+            return host, None
+        try:
+            return hostname, int(port)
+        except ValueError:
+            raise errors.HTTPError(400, 'Bad host header')
+
     def init_q(self, raw):
+        if not raw:
+            return NO_VALUES
         data = {}
-        if raw:
-            for item in raw.split(','):
-                key, _, q = item.strip().partition(';q=')
-                try:
-                    q = float(q)
-                except:
-                    q = 1.0
-                data[key] = q
+        for item in raw.split(','):
+            key, *params = item.split(';')
+            key = key.strip().lower()
+            if not key:
+                continue
+            q = 1.0
+            for param in params:
+                name, _, value = param.partition('=')
+                if name.strip().lower() == 'q':
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+                    if not 0 <= q <= 1:
+                        q = 0.0
+            data[key] = q
         return data
 
     def accept(self, key):
         q = self._accept.get(key)
         return q is not None and q > 0
 
-    def accept_encoding(self, key):
+    def accept_encoding_q(self, key):
+        '''Return the q-value of a content coding, following `*`.'''
         q = self._accept_encoding.get(key)
-        return q is not None and q > 0
+        if q is None:
+            q = self._accept_encoding.get('*')
+        if q is None:
+            q = 1.0 if key == 'identity' else 0.0
+        return q
+
+    def accept_encoding(self, key):
+        '''Whether a content coding is acceptable, and not less preferred
+        than `identity` if that is listed.'''
+        q = self.accept_encoding_q(key)
+        return q > 0 and q >= self._accept_encoding.get('identity', 0.0)
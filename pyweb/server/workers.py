@@ -0,0 +1,204 @@
+'''
+Pre-fork multi-process mode.
+
+The master binds the listening sockets, forks workers that accept on the
+inherited sockets, restarts workers that die, and stops them on SIGTERM.
+SIGUSR1 is passed on to workers, which reopen their access logs.
+
+On SIGHUP, the master loads the config again, binds the new addresses and
+replaces the workers: new ones are started with the new config before the
+old ones are asked to stop, so no connection is refused in between.
+'''
+import os
+import time
+import signal
+import socket
+import asyncio
+import traceback
+from gera2ld.pyserve import parse_addr, print_urls, get_url_items
+from ..utils import logger, fcgi, httpclient, upstream, accesslog
+from .matcher import normalize_config
+
+def bind_sockets(bind, backlog=100):
+    '''Bind listening sockets like `asyncio.start_server` does.'''
+    hostinfo = parse_addr(bind)
+    path = hostinfo.get('path')
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        os.chmod(path, 0o666)
+        socks = [sock]
+    else:
+        socks = []
+        infos = socket.getaddrinfo(
+            hostinfo['host'] or None, hostinfo['port'],
+            type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)
+        for family, type_, proto, _, addr in infos:
+            sock = socket.socket(family, type_, proto)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if family == socket.AF_INET6:
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            sock.bind(addr)
+            socks.append(sock)
+    for sock in socks:
+        sock.listen(backlog)
+        sock.setblocking(False)
+    return socks
+
+class Supervisor:
+    '''Fork and supervise `workers` processes serving `daemon`.'''
+    restart_delay = 1
+
+    def __init__(self, daemon, workers):
+        self.daemon = daemon
+        self.workers = workers
+        self.sockets = None
+        self.children = {}
+        # old workers stopping after a reload, not to be restarted
+        self.retiring = set()
+        self.stopping = False
+
+    def run(self):
+        self.sockets = [
+            bind_sockets(item.get('bind', ':4000'))
+            for item in self.daemon.config
+        ]
+        print_urls([get_url_items([
+            sock.getsockname() for sock in socks
+        ]) for socks in self.sockets])
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGUSR1, self.reopen)
+        signal.signal(signal.SIGHUP, self.reload)
+        for _ in range(self.workers):
+            self.spawn()
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self.children.pop(pid, None)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                continue
+            if started is None or self.stopping:
+                continue
+            logger.warning('worker %d exited with status %d, restarting', pid, status)
+            if time.monotonic() - started < self.restart_delay:
+                # avoid a tight loop if workers crash on start
+                time.sleep(self.restart_delay)
+                if self.stopping:
+                    continue
+            self.spawn()
+
+    def stop(self, signum, frame):
+        '''Stop workers, killing them if asked to stop twice.'''
+        sig = signal.SIGKILL if self.stopping else signal.SIGTERM
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def reopen(self, signum, frame):
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGUSR1)
+            except ProcessLookupError:
+                pass
+
+    def reload(self, signum, frame):
+        '''Start workers with the config loaded again, then stop the others.'''
+        if self.stopping:
+            return
+        try:
+            config = normalize_config(self.daemon.load_config())
+        except Exception:
+            logger.exception('failed to load config, keeping the current one')
+            return
+        current = {
+            item.get('bind', ':4000'): socks
+            for item, socks in zip(self.daemon.config, self.sockets)
+        }
+        sockets = []
+        added = []
+        try:
+            for item in config:
+                bind = item.get('bind', ':4000')
+                socks = current.get(bind)
+                if socks is None:
+                    socks = bind_sockets(bind)
+                    added.append(socks)
+                sockets.append(socks)
+        except OSError:
+            logger.exception('failed to listen on %s, keeping the current config', bind)
+            for socks in added:
+                for sock in socks:
+                    sock.close()
+            return
+        if added:
+            print_urls([get_url_items([
+                sock.getsockname() for sock in socks
+            ]) for socks in added])
+        self.daemon.configure(config)
+        self.workers = self.daemon.workers
+        # close removed sockets before forking, the old workers keep their own copies
+        for socks in self.sockets:
+            if socks not in sockets:
+                for sock in socks:
+                    sock.close()
+        self.sockets = sockets
+        old_children = list(self.children)
+        for _ in range(self.workers):
+            self.spawn()
+        self.retiring.update(old_children)
+        for pid in old_children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        logger.info('config reloaded')
+
+    def spawn(self):
+        # Write what the master has queued and stop its writer threads, so
+        # that workers neither write the records again nor inherit a thread
+        # stopped while holding a lock. They start again on the next write.
+        accesslog.close_all()
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.monotonic()
+            return
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # Ctrl-C and hangups reach the whole process group, let the master decide
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            self.serve()
+        except:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+
+    def serve(self):
+        '''Serve in a worker process until SIGTERM, then let open requests
+        finish.'''
+        # FastCGI and upstream connections must not be shared with other processes.
+        fcgi.Dispatcher.pool.clear()
+        httpclient.pools.clear()
+        upstream.Balancer.pool.clear()
+        accesslog.AccessLog.pool.clear()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self.daemon.start_servers(self.sockets))
+        loop.add_signal_handler(signal.SIGTERM, self.daemon.stop)
+        loop.add_signal_handler(signal.SIGUSR1, accesslog.reopen_all)
+        loop.run_forever()
+        # workers leave with os._exit, which skips atexit
+        accesslog.close_all()
@@ -0,0 +1,249 @@
+'''
+Access log written in batches by a background thread
+
+Records are queued by the event loop and formatted and written by a
+thread, so that a slow disk or pipe never blocks serving. When the queue
+is full, records are dropped and counted instead.
+'''
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import collections
+from . import metrics
+from .logger import logger
+
+QUEUE_SIZE = 10000
+# records that wake up the thread before the interval
+BATCH_SIZE = 1000
+# seconds between writes when the queue is not full
+FLUSH_INTERVAL = 0.5
+BACKUPS = 5
+
+Record = collections.namedtuple('Record', (
+    'time', 'remote_addr', 'host', 'requestline', 'status', 'written',
+    'referer', 'user_agent', 'duration', 'handler',
+))
+
+dropped_count = metrics.Counter(
+    'pyweb_access_log_dropped_total', 'Access log records dropped because the queue was full.')
+queued_gauge = metrics.Gauge(
+    'pyweb_access_log_queued', 'Access log records waiting to be written.')
+
+_clf_time = None, None
+
+def clf_time(timestamp):
+    '''Local time in Common Log Format, formatted once per second.'''
+    global _clf_time
+    second = int(timestamp)
+    cached, value = _clf_time
+    if cached != second:
+        value = time.strftime('%d/%b/%Y:%H:%M:%S %z', time.localtime(second))
+        _clf_time = second, value
+    return value
+
+def quote(value):
+    if not value:
+        return '-'
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+def format_common(record):
+    return '%s - - [%s] "%s" %d %s\n' % (
+        record.remote_addr or '-', clf_time(record.time), quote(record.requestline),
+        record.status, record.written)
+
+def format_combined(record):
+    return '%s - - [%s] "%s" %d %s "%s" "%s"\n' % (
+        record.remote_addr or '-', clf_time(record.time), quote(record.requestline),
+        record.status, record.written, quote(record.referer), quote(record.user_agent))
+
+def format_json(record):
+    data = record._asdict()
+    data['time'] = time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(record.time))
+    data['duration'] = round(record.duration, 6)
+    if data['written'] == '-':
+        data['written'] = None
+    return json.dumps(data, ensure_ascii=False) + '\n'
+
+FORMATS = {
+    'common': format_common,
+    'combined': format_combined,
+    'json': format_json,
+}
+
+class AccessLog:
+    '''Write records to `path`, or to stderr if it is `-`.
+
+    The file is rotated when it reaches `max_bytes`, or every
+    `rotate_interval` seconds, keeping `backups` old files as `path.1`,
+    `path.2`, etc. `reopen` opens the file again after it has been moved
+    by another program.
+    '''
+    pool = {}
+
+    def __init__(self, path='-', format='combined', queue_size=QUEUE_SIZE,
+            max_bytes=0, rotate_interval=0, backups=BACKUPS):
+        if format not in FORMATS:
+            raise ValueError('Unknown access log format: %s' % format)
+        self.path = path
+        self.format = FORMATS[format]
+        self.queue_size = queue_size
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backups = backups
+        self.records = collections.deque()
+        self.dropped = 0
+        self.reported = 0
+        self.wakeup = threading.Event()
+        self.reopen_requested = False
+        self.stopping = False
+        self.thread = None
+        self.file = None
+        self.next_rotate = None
+
+    def write(self, record):
+        '''Queue a record, dropping it if the queue is full.'''
+        records = self.records
+        if len(records) >= self.queue_size:
+            self.dropped += 1
+            self.wakeup.set()
+            return
+        records.append(record)
+        if len(records) == BATCH_SIZE:
+            self.wakeup.set()
+        if self.thread is None:
+            self.start()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='access-log', daemon=True)
+        self.thread.start()
+
+    def reopen(self):
+        '''Open the file again before the next write.'''
+        self.reopen_requested = True
+        self.wakeup.set()
+
+    def close(self):
+        '''Write the queued records and stop the thread.'''
+        if self.thread is not None:
+            self.stopping = True
+            self.wakeup.set()
+            self.thread.join()
+            self.thread = None
+            self.stopping = False
+
+    def run(self):
+        while True:
+            self.wakeup.wait(FLUSH_INTERVAL)
+            self.wakeup.clear()
+            stopping = self.stopping
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('failed writing access log')
+            if stopping:
+                break
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def flush(self):
+        records = self.records
+        lines = []
+        while records:
+            lines.append(self.format(records.popleft()))
+        if self.dropped != self.reported:
+            logger.warning('%d access log records dropped', self.dropped - self.reported)
+            self.reported = self.dropped
+        if not lines:
+            return
+        if self.path == '-':
+            sys.stderr.write(''.join(lines))
+            sys.stderr.flush()
+            return
+        if self.reopen_requested:
+            self.reopen_requested = False
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        if self.file is None:
+            self.open()
+        self.file.write(''.join(lines))
+        self.file.flush()
+        if self.max_bytes and self.file.tell() >= self.max_bytes or (
+                self.next_rotate is not None and time.time() >= self.next_rotate):
+            self.rotate()
+
+    def open(self):
+        self.file = open(self.path, 'a', encoding='utf-8')
+        if self.rotate_interval:
+            now = time.time()
+            self.next_rotate = (now // self.rotate_interval + 1) * self.rotate_interval
+
+    def rotate(self):
+        '''Move the file to `path.1` and open a new one.
+
+        Workers share the file, so it is only moved if another process has
+        not already done that.
+        '''
+        try:
+            moved = os.stat(self.path).st_ino != os.fstat(self.file.fileno()).st_ino
+        except FileNotFoundError:
+            moved = True
+        self.file.close()
+        self.file = None
+        if not moved:
+            if self.backups:
+                for i in range(self.backups - 1, 0, -1):
+                    source = '%s.%d' % (self.path, i)
+                    if os.path.exists(source):
+                        os.replace(source, '%s.%d' % (self.path, i + 1))
+                os.replace(self.path, self.path + '.1')
+            else:
+                os.remove(self.path)
+        self.open()
+
+    @classmethod
+    def get(cls, config):
+        '''Get the access log of a server config, or None if it is disabled.
+
+        Logs are shared by their settings, so that a reloaded config keeps
+        writing to the same one.
+        '''
+        path = config.get('access_log', '-')
+        if not path:
+            return
+        key = (
+            path,
+            config.get('access_log_format', 'combined'),
+            config.get('access_log_queue', QUEUE_SIZE),
+            config.get('access_log_max_bytes', 0),
+            config.get('access_log_rotate', 0),
+            config.get('access_log_backups', BACKUPS),
+        )
+        access_log = cls.pool.get(key)
+        if access_log is None:
+            access_log = cls.pool[key] = cls(*key)
+        return access_log
+
+def reopen_all():
+    for access_log in AccessLog.pool.values():
+        access_log.reopen()
+
+def close_all():
+    for access_log in AccessLog.pool.values():
+        access_log.close()
+
+atexit.register(close_all)
+
+def collect_metrics():
+    dropped = queued = 0
+    for access_log in AccessLog.pool.values():
+        dropped += access_log.dropped
+        queued += len(access_log.records)
+    dropped_count.labels().set(dropped)
+    queued_gauge.labels().set(queued)
+
+metrics.registry.add_collector(collect_metrics)
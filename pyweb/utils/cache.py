@@ -0,0 +1,72 @@
+'''Caches'''
+import time
+import collections
+
+class LRUCache:
+    '''A bounded mapping that evicts the least recently used items.
+
+    Items older than `ttl` seconds are treated as missing, `ttl=None`
+    keeps them until they are evicted. If `max_cost` is set, the total
+    cost of items, e.g. their sizes in bytes, is kept below it as well.
+    '''
+    def __init__(self, max_size=1000, ttl=None, max_cost=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_cost = max_cost
+        self.cost = 0
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        item = self.items.get(key)
+        if item is not None:
+            value, expires, _cost = item
+            if expires is None or expires > time.monotonic():
+                self.items.move_to_end(key)
+                self.hits += 1
+                return value
+            self.pop(key)
+        self.misses += 1
+        return default
+
+    def set(self, key, value, cost=1):
+        if self.max_cost is not None and cost > self.max_cost:
+            self.pop(key)
+            return
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        item = self.items.get(key)
+        if item is not None:
+            self.cost -= item[2]
+        self.items[key] = value, expires, cost
+        self.cost += cost
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size or (
+                self.max_cost is not None and self.cost > self.max_cost):
+            _key, (_value, _expires, cost) = self.items.popitem(last=False)
+            self.cost -= cost
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        item = self.items.pop(key, None)
+        if item is None:
+            return default
+        self.cost -= item[2]
+        return item[0]
+
+    def clear(self):
+        self.items.clear()
+        self.cost = 0
+
+    def stats(self):
+        return {
+            'size': len(self.items),
+            'cost': self.cost,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,26 @@
+'''Run blocking filesystem calls off the event loop.'''
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+FS_THREADS = 8
+
+executors = {}
+
+def get_executor(options):
+    '''Get the thread pool with `fs_threads` workers.
+
+    Return None if `fs_threads` is 0, in which case calls block the loop.
+    '''
+    size = options.get('fs_threads', FS_THREADS)
+    if not size:
+        return
+    executor = executors.get(size)
+    if executor is None:
+        executor = executors[size] = ThreadPoolExecutor(size, thread_name_prefix='pyweb-fs')
+    return executor
+
+async def run_blocking(executor, func, *args):
+    '''Call `func` in `executor`, or directly if there is none.'''
+    if executor is None:
+        return func(*args)
+    return await asyncio.get_event_loop().run_in_executor(executor, func, *args)
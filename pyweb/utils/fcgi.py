@@ -2,9 +2,11 @@
 FastCGI module
 '''
 import struct
-import io
+import collections
+import inspect
 import asyncio
-from .parser import parse_addr
+from .parser import parse_addr, get_pool_key
+from . import metrics
 
 # Reference:
 # http://www.fastcgi.com/drupal/node/6?q=node/22
@@ -42,17 +44,40 @@ FCGI_MAX_CONNS = 'FCGI_MAX_CONNS'
 FCGI_MAX_REQS = 'FCGI_MAX_REQS'
 FCGI_MPXS_CONNS = 'FCGI_MPXS_CONNS'
 
+pool_wait_time = metrics.Histogram(
+    'pyweb_fcgi_pool_wait_seconds',
+    'Time waiting for a FastCGI connection, including connecting.', ('target',))
+response_time = metrics.Histogram(
+    'pyweb_fcgi_response_seconds',
+    'Time from getting a FastCGI connection to the end of the response.', ('target',))
+connections_gauge = metrics.Gauge(
+    'pyweb_fcgi_connections', 'Open FastCGI connections, busy or idle.', ('target', 'state'))
+max_connections_gauge = metrics.Gauge(
+    'pyweb_fcgi_connections_max', 'Connections allowed per FastCGI target.', ('target',))
+requests_gauge = metrics.Gauge(
+    'pyweb_fcgi_requests_active', 'Requests sent to a FastCGI target.', ('target',))
+waiting_gauge = metrics.Gauge(
+    'pyweb_fcgi_requests_waiting', 'Requests waiting for a FastCGI connection.', ('targets',))
+
 def build_record(req_id, rec_type, data=None, allow_empty=True):
     '''Build record into a list of bytes'''
     if isinstance(data, tuple):
         stream, length = data
     elif data:
-        stream, length = io.BytesIO(data), len(data)
+        stream, length = None, len(data)
+        view = memoryview(data)
     else:
         stream, length = None, 0
+    offset = 0
     while True:
         buf_len = min(FCGI_MAX_LENGTH, length)
-        data = stream.read(buf_len) if buf_len else b''
+        if not buf_len:
+            data = b''
+        elif stream is None:
+            data = view[offset:offset + buf_len]
+            offset += buf_len
+        else:
+            data = stream.read(buf_len)
         pad = (8 - buf_len % 8) % 8
         if buf_len or allow_empty:
             yield struct.pack(
@@ -80,147 +105,456 @@ def build_name_value_pairs(pairs):
         data.append(value)
     return b''.join(data)
 
+def parse_name_value_pairs(data):
+    '''Parse a byte sequence into a dict of key-value pairs.'''
+    pairs = {}
+    offset = 0
+    while offset < len(data):
+        lengths = []
+        for _ in range(2):
+            if data[offset] & 0x80:
+                lengths.append(struct.unpack_from('!L', data, offset)[0] & 0x7fffffff)
+                offset += 4
+            else:
+                lengths.append(data[offset])
+                offset += 1
+        key_len, value_len = lengths
+        key = data[offset:offset + key_len].decode()
+        offset += key_len
+        pairs[key] = data[offset:offset + value_len].decode()
+        offset += value_len
+    return pairs
+
 class Worker:
-    '''FastCGI worker via a connection.'''
+    '''FastCGI connection, shared by up to `max_reqs` requests.
 
-    def __init__(self, addr, req_id):
+    Records from the server are read by a background task and dispatched
+    to the request they belong to.
+    '''
+
+    def __init__(self, addr, timeout=30, on_close=None):
         self.addr = addr
-        self.req_id = req_id
+        self.timeout = timeout
+        self.on_close = on_close
+        self.backend = None
         self.reader = self.writer = None
+        self.receiver = None
+        self.max_reqs = 1
+        self.active = 0
+        self.last_used = 0
+        self.last_read = 0
+        self.requests = {}
 
-    def close(self):
-        '''Close connection.'''
+    @property
+    def closed(self):
+        return self.writer is None
+
+    @property
+    def available(self):
+        '''Whether another request can be sent over this connection.'''
+        # aborted requests keep their ids until the server ends them
+        aborted = sum(request is None for request in self.requests.values())
+        return self.active + aborted < self.max_reqs
+
+    def close(self, exc=None):
+        '''Close connection and fail pending requests.'''
         if self.writer:
             self.writer.close()
             self.writer = None
+        if self.receiver is not None and self.receiver is not asyncio.current_task():
+            self.receiver.cancel()
+        self.receiver = None
+        requests, self.requests = self.requests, {}
+        for request in requests.values():
+            if request is None:
+                continue
+            _write_out, _write_err, done = request
+            if not done.done():
+                done.set_exception(exc or ConnectionResetError('FastCGI connection closed'))
+        if self.on_close is not None:
+            self.on_close(self)
 
-    async def connect(self):
-        '''Connect to FastCGI server.'''
+    async def connect(self, multiplex=False):
+        '''Connect to FastCGI server.
+
+        If `multiplex` is True, ask the server whether it can handle
+        concurrent requests over one connection.
+        '''
         host, port = self.addr
         self.reader, self.writer = await asyncio.wait_for(
             asyncio.open_connection(host=host, port=port), 5)
+        if multiplex:
+            values = await self.get_values(FCGI_MPXS_CONNS, FCGI_MAX_REQS)
+            if values.get(FCGI_MPXS_CONNS) == '1':
+                try:
+                    self.max_reqs = max(1, min(int(values.get(FCGI_MAX_REQS)), FCGI_MAX_LENGTH))
+                except (TypeError, ValueError):
+                    pass
+        self.receiver = asyncio.ensure_future(self.receive())
 
-    async def fcgi_parse(self, write_out, write_err, timeout):
-        '''Parse a FastCGI response and pipe to clients.'''
+    async def get_values(self, *names):
+        '''Query variables with a FCGI_GET_VALUES record.'''
+        self.writer.writelines(build_record(
+            FCGI_NULL_REQUEST_ID, FCGI_GET_VALUES,
+            build_name_value_pairs((name, '') for name in names),
+        ))
+        await self.writer.drain()
         while True:
-            header = await asyncio.wait_for(self.reader.readexactly(8), timeout)
-            version, rec_type, res_id, length, padding = struct.unpack(
-                '!BBHHBx', header)
-            data = await asyncio.wait_for(self.reader.readexactly(length), timeout)
-            await asyncio.wait_for(self.reader.readexactly(padding), timeout)
-            if version != FCGI_VERSION_1 or res_id != self.req_id:
+            rec_type, res_id, data = await self.read_record(self.timeout)
+            if res_id != FCGI_NULL_REQUEST_ID:
                 continue
-            if rec_type == FCGI_END_REQUEST:
-                #sapp, spro = struct.unpack('!IB3x', data)
-                break
-            else:
-                if rec_type == FCGI_STDOUT:
-                    write = write_out
-                # elif rec_type == FCGI_STDERR:
+            if rec_type == FCGI_GET_VALUES_RESULT:
+                return parse_name_value_pairs(data)
+            if rec_type == FCGI_UNKNOWN_TYPE:
+                return {}
+
+    async def read_record(self, timeout=None):
+        header = await asyncio.wait_for(self.reader.readexactly(8), timeout)
+        version, rec_type, res_id, length, padding = struct.unpack(
+            '!BBHHBx', header)
+        data = await asyncio.wait_for(self.reader.readexactly(length + padding), timeout)
+        if padding:
+            data = data[:length]
+        self.last_read = asyncio.get_event_loop().time()
+        if version != FCGI_VERSION_1:
+            return None, None, None
+        return rec_type, res_id, data
+
+    async def receive(self):
+        '''Parse FastCGI responses and pipe them to clients.
+
+        `write_out` and `write_err` may return awaitables, which are awaited
+        before reading the next record so that slow clients push back on
+        the server. On a multiplexed connection this holds up the other
+        requests as well.
+        '''
+        exc = None
+        try:
+            while True:
+                rec_type, res_id, data = await self.read_record()
+                request = self.requests.get(res_id)
+                if request is None:
+                    if rec_type == FCGI_END_REQUEST:
+                        self.requests.pop(res_id, None)
+                    continue
+                write_out, write_err, done = request
+                if rec_type == FCGI_END_REQUEST:
+                    del self.requests[res_id]
+                    _app_status, protocol_status = struct.unpack('!IB3x', data)
+                    if protocol_status == FCGI_REQUEST_COMPLETE:
+                        done.set_result(None)
+                    else:
+                        if protocol_status == FCGI_CANT_MPX_CONN:
+                            self.max_reqs = 1
+                        done.set_exception(ConnectionRefusedError(
+                            'FastCGI request rejected with status %d' % protocol_status))
                 else:
-                    write = write_err
-                write(data)
+                    write = write_out if rec_type == FCGI_STDOUT else write_err
+                    try:
+                        result = write(data)
+                        if inspect.isawaitable(result):
+                            await result
+                    except Exception as e:
+                        # only this request fails, the connection is fine
+                        if not done.done():
+                            done.set_exception(e)
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            exc = e
+        self.close(exc)
+
+    def next_req_id(self):
+        for req_id in range(1, self.max_reqs + 1):
+            if req_id not in self.requests:
+                return req_id
 
-    async def fcgi_run(self, write_out, write_err, reader, env, timeout):
+    def abort(self, req_id):
+        '''Stop waiting for a request, keeping the connection if it is shared.'''
+        if self.max_reqs > 1 and self.writer is not None:
+            if self.requests.get(req_id) is not None:
+                self.requests[req_id] = None
+                self.writer.writelines(build_record(req_id, FCGI_ABORT_REQUEST))
+        else:
+            self.close()
+
+    async def wait_done(self, done):
+        '''Wait for a request to end, failing if the server is silent for
+        `timeout` seconds.'''
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        while True:
+            try:
+                return await asyncio.wait_for(asyncio.shield(done), self.timeout)
+            except asyncio.TimeoutError:
+                if loop.time() - max(start, self.last_read) >= self.timeout:
+                    raise
+
+    def write_records(self, records):
+        if self.writer is None:
+            raise ConnectionResetError('FastCGI connection closed')
+        self.writer.writelines(records)
+
+    async def fcgi_run(self, write_out, write_err, reader, env):
         '''Run FastCGI
 
         - write_out
         - write_err
         - reader: wsgi.input
         - env: environment variables
-        - timeout
         '''
-        rec = []
-        rec.extend(build_record(
-            self.req_id, FCGI_BEGIN_REQUEST,
-            struct.pack('!HB5x', FCGI_RESPONDER, FCGI_KEEP_CONN),
-            False,
-        ))
-        rec.extend(build_record(
-            self.req_id, FCGI_PARAMS,
-            build_name_value_pairs((k, v) for k, v in env.items() if not k.startswith('gehttpd.')),
-        ))
-        length = 0
-        if env['REQUEST_METHOD'] == 'POST':
-            try:
-                length = int(env['CONTENT_LENGTH'])
-            except ValueError:
-                pass
-        while length > 0:
-            readlen = min(FCGI_MAX_LENGTH, length)
-            data = await asyncio.wait_for(reader.read(readlen), timeout)
-            rec.extend(build_record(self.req_id, FCGI_STDIN, data, False))
-            length -= len(data)
-        rec.extend(build_record(self.req_id, FCGI_STDIN))
-        res = b''.join(rec)
-        if self.writer is None:
-            await self.connect()
-        self.writer.write(res)
-        await self.writer.drain()
-        await self.fcgi_parse(write_out, write_err, timeout)
+        req_id = self.next_req_id()
+        done = asyncio.get_event_loop().create_future()
+        self.requests[req_id] = write_out, write_err, done
+        try:
+            self.write_records(build_record(
+                req_id, FCGI_BEGIN_REQUEST,
+                struct.pack('!HB5x', FCGI_RESPONDER, FCGI_KEEP_CONN),
+                False,
+            ))
+            self.write_records(build_record(
+                req_id, FCGI_PARAMS,
+                build_name_value_pairs((k, v) for k, v in env.items() if not k.startswith('gehttpd.')),
+            ))
+            length = 0
+            if env['REQUEST_METHOD'] == 'POST':
+                try:
+                    length = int(env['CONTENT_LENGTH'])
+                except ValueError:
+                    pass
+            # Pass the body on as it arrives, draining so that a slow
+            # server slows down the upload instead of buffering it.
+            while length > 0:
+                readlen = min(FCGI_MAX_LENGTH, length)
+                data = await asyncio.wait_for(reader.read(readlen), self.timeout)
+                if not data:
+                    raise ConnectionResetError('Client closed while sending body')
+                self.write_records(build_record(req_id, FCGI_STDIN, data, False))
+                await asyncio.wait_for(self.writer.drain(), self.timeout)
+                length -= len(data)
+            self.write_records(build_record(req_id, FCGI_STDIN))
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+            await self.wait_done(done)
+        except BaseException:
+            self.abort(req_id)
+            raise
+
+class Backend:
+    '''A FastCGI server and the connections opened to it.'''
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.name = '%s:%s' % addr
+        self.workers = []
+        self.active = 0
+        self.down_until = 0
+        self.wait_time = pool_wait_time.labels(self.name)
+        self.response_time = response_time.labels(self.name)
+
+    def __repr__(self):
+        return '<Backend %s:%s active=%d workers=%d>' % (
+            *self.addr, self.active, len(self.workers))
 
 class Dispatcher:
     '''Dispatcher of FastCGI workers.
 
-    PHP on Windows has problems with concurrency
+    Each target keeps a pool of up to `max_connections` connections, idle
+    ones are closed after `idle_timeout` seconds. Requests go to the least
+    busy healthy target, ties are broken round-robin. A target that refuses
+    connections is skipped for `fail_timeout` seconds.
+
+    PHP on Windows has problems with concurrency, set `max_connections` to 1
+    for it.
     '''
-    max_connection = 1
-    pool = {}
+    max_connections = 8
+    idle_timeout = 60
+    fail_timeout = 10
     timeout = 30
+    multiplex = False
+    pool = {}
 
-    def __init__(self, targets):
-        self.offset = 0
-        self.full = False
-        self.queue = asyncio.Queue()
+    def __init__(self, targets, max_connections=None, idle_timeout=None,
+            timeout=None, multiplex=None):
         if isinstance(targets, str):
             targets = [targets]
-        self.connections = [[parse_addr(target), 0] for target in targets]
+        if max_connections is not None:
+            self.max_connections = max_connections
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+        if timeout is not None:
+            self.timeout = timeout
+        if multiplex is not None:
+            self.multiplex = multiplex
+        self.backends = [Backend(parse_addr(target)) for target in targets]
+        self.offset = 0
+        self.waiters = collections.deque()
+        self.reaper = None
+
+    def select(self):
+        '''Find a backend with spare capacity, and a worker on it if any.'''
+        now = asyncio.get_event_loop().time()
+        count = len(self.backends)
+        backends = [self.backends[(self.offset + i) % count] for i in range(count)]
+        self.offset = (self.offset + 1) % count
+        healthy = [backend for backend in backends if backend.down_until <= now] or backends
+        # sort is stable so round-robin order is kept among ties
+        healthy.sort(key=lambda backend: backend.active)
+        for backend in healthy:
+            for worker in backend.workers:
+                if worker.available:
+                    return backend, worker
+            if len(backend.workers) < self.max_connections:
+                return backend, None
+        return None, None
 
     async def get_worker(self):
         '''Get an available worker from the pool.'''
-        worker = None
-        if not self.full:
-            try:
-                worker = self.queue.get_nowait()
-            except asyncio.queues.QueueEmpty:
-                item = self.connections[self.offset]
-                if item[1] >= self.max_connection:
-                    self.full = True
+        loop = asyncio.get_event_loop()
+        failures = 0
+        while True:
+            backend, worker = self.select()
+            if backend is None:
+                waiter = loop.create_future()
+                self.waiters.append(waiter)
+                try:
+                    await waiter
+                finally:
+                    if not waiter.done():
+                        self.waiters.remove(waiter)
+                continue
+            if worker is None:
+                worker = Worker(backend.addr, self.timeout, self.discard)
+                worker.backend = backend
+                backend.workers.append(worker)
+                self.acquire(worker)
+                try:
+                    await worker.connect(self.multiplex)
+                except (OSError, asyncio.TimeoutError) as exc:
+                    worker.close()
+                    self.release(worker)
+                    backend.down_until = loop.time() + self.fail_timeout
+                    failures += 1
+                    if failures >= len(self.backends):
+                        raise ConnectionRefusedError('No FastCGI backend available') from exc
+                    continue
+                backend.down_until = 0
+                # requests that came while connecting may share the connection
+                for _ in range(worker.max_reqs - worker.active):
+                    self.wake()
+            else:
+                self.acquire(worker)
+            return worker
+
+    def acquire(self, worker):
+        worker.active += 1
+        worker.backend.active += 1
+
+    def release(self, worker):
+        '''Put a worker back after a request and wake up a waiting request.'''
+        worker.active -= 1
+        worker.backend.active -= 1
+        worker.last_used = asyncio.get_event_loop().time()
+        if not worker.closed and not worker.active:
+            self.schedule_reap()
+        self.wake()
+
+    def discard(self, worker):
+        '''Forget a closed worker.'''
+        try:
+            worker.backend.workers.remove(worker)
+        except ValueError:
+            pass
+        self.wake()
+
+    def wake(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def schedule_reap(self):
+        if self.reaper is None:
+            self.reaper = asyncio.get_event_loop().call_later(self.idle_timeout, self.reap)
+
+    def reap(self):
+        '''Close connections that have been idle for `idle_timeout`.'''
+        self.reaper = None
+        deadline = asyncio.get_event_loop().time() - self.idle_timeout
+        pending = False
+        for backend in self.backends:
+            for worker in list(backend.workers):
+                if worker.active:
+                    continue
+                if worker.last_used <= deadline:
+                    worker.close()
                 else:
-                    worker = Worker(item[0], item[1])
-                    item[1] += 1
-                    self.offset = (self.offset + 1) % len(self.connections)
-        if worker is None:
-            worker = await self.queue.get()
-        return worker
+                    pending = True
+        if pending:
+            self.schedule_reap()
 
     async def run_worker(self, write_out, write_err, reader, env):
         '''Get an available worker and pass the arguments.'''
+        loop = asyncio.get_event_loop()
+        start = loop.time()
         worker = await self.get_worker()
+        backend = worker.backend
+        sent = loop.time()
+        backend.wait_time.observe(sent - start)
         try:
-            await worker.fcgi_run(write_out, write_err, reader, env, timeout=self.timeout)
-        except Exception as exc:
-            worker.close()
-            raise exc
+            await worker.fcgi_run(write_out, write_err, reader, env)
         finally:
-            self.queue.put_nowait(worker)
+            self.release(worker)
+            backend.response_time.observe(loop.time() - sent)
+
+    def close(self):
+        '''Close idle connections now and busy ones once they are released.'''
+        self.idle_timeout = 0
+        if self.reaper is not None:
+            self.reaper.cancel()
+        self.reap()
 
     @classmethod
-    def get(cls, targets):
-        '''Get a dispatcher based on FCGI rule.'''
-        dispatcher_id = id(targets)
-        dispatcher = cls.pool.get(dispatcher_id)
+    def get(cls, targets, **kw):
+        '''Get a dispatcher by its targets and settings.'''
+        key = get_pool_key(targets, kw)
+        dispatcher = cls.pool.get(key)
         if dispatcher is None:
-            dispatcher = cls.pool[dispatcher_id] = cls(targets)
+            dispatcher = cls.pool[key] = cls(targets, **kw)
         return dispatcher
 
+    @classmethod
+    def retain(cls, used):
+        '''Close the dispatchers not in `used`, a list of `(targets, kw)`.'''
+        keys = set(get_pool_key(targets, kw) for targets, kw in used)
+        for key in list(cls.pool):
+            if key not in keys:
+                cls.pool.pop(key).close()
+
+def collect_metrics():
+    '''Update the gauges of FastCGI connection pools.'''
+    for gauge in (connections_gauge, max_connections_gauge, requests_gauge, waiting_gauge):
+        gauge.clear()
+    for dispatcher in Dispatcher.pool.values():
+        for backend in dispatcher.backends:
+            busy = sum(1 for worker in backend.workers if worker.active)
+            connections_gauge.labels(backend.name, 'busy').inc(busy)
+            connections_gauge.labels(backend.name, 'idle').inc(len(backend.workers) - busy)
+            max_connections_gauge.labels(backend.name).inc(dispatcher.max_connections)
+            requests_gauge.labels(backend.name).inc(backend.active)
+        waiting = sum(not waiter.done() for waiter in dispatcher.waiters)
+        targets = ','.join(backend.name for backend in dispatcher.backends)
+        waiting_gauge.labels(targets).inc(waiting)
+
+metrics.registry.add_collector(collect_metrics)
+
 def main():
     '''Start a worker for test use.'''
     loop = asyncio.get_event_loop()
-    fcgi = Worker(('127.0.0.1', 9000), 1)
-    loop.run_until_complete(fcgi.fcgi_run(print, print, {
+    dispatcher = Dispatcher(['127.0.0.1:9000'])
+    loop.run_until_complete(dispatcher.run_worker(print, print, None, {
         'REQUEST_METHOD': 'GET',
-    }, None, 10))
+    }))
 
 if __name__ == '__main__':
     main()
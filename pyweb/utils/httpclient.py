@@ -0,0 +1,300 @@
+'''
+HTTP/1.1 client with persistent connections, used by proxy handlers
+'''
+import re
+import asyncio
+import collections
+
+BUF_SIZE = 65536
+MAX_HEAD_SIZE = 65536
+MAX_IDLE = 8
+IDLE_TIMEOUT = 60
+CONNECT_TIMEOUT = 10
+CHUNK_SIZE_RE = re.compile(rb'[0-9A-Fa-f]+')
+
+# headers that only apply to a single connection (RFC 7230, section 6.1)
+HOP_BY_HOP = frozenset((
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'proxy-connection', 'te', 'trailer', 'transfer-encoding', 'upgrade',
+))
+
+def strip_hop_by_hop(items):
+    '''Remove hop-by-hop headers, including those listed in `Connection`.'''
+    drop = set(HOP_BY_HOP)
+    for key, value in items:
+        if key.lower() in ('connection', 'proxy-connection'):
+            drop.update(token.strip().lower() for token in value.split(','))
+    return [(key, value) for key, value in items if key.lower() not in drop]
+
+def get_header(items, name, default=None):
+    name = name.lower()
+    for key, value in items:
+        if key.lower() == name:
+            return value
+    return default
+
+async def iter_length(reader, length, timeout=None):
+    '''Read a body of `length` bytes.'''
+    while length > 0:
+        data = await asyncio.wait_for(reader.read(min(length, BUF_SIZE)), timeout)
+        if not data:
+            raise asyncio.IncompleteReadError(b'', length)
+        length -= len(data)
+        yield data
+
+async def iter_chunked(reader, timeout=None):
+    '''Read a body in chunked transfer coding, trailers are discarded.
+
+    Raise ValueError if the framing is invalid, a lenient parser could
+    split the stream differently from another one (RFC 7230, section 4.1).
+    '''
+    while True:
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        if not line.endswith(b'\n'):
+            raise asyncio.IncompleteReadError(line, None)
+        # whitespace is only allowed before extensions
+        size = line.rstrip(b'\r\n').split(b';', 1)[0].rstrip(b' \t')
+        if not CHUNK_SIZE_RE.fullmatch(size):
+            raise ValueError('Invalid chunk size: %r' % line)
+        size = int(size, 16)
+        if not size:
+            break
+        async for data in iter_length(reader, size, timeout):
+            yield data
+        end = await asyncio.wait_for(reader.readexactly(1), timeout)
+        if end == b'\r':
+            end = await asyncio.wait_for(reader.readexactly(1), timeout)
+        if end != b'\n':
+            raise ValueError('Missing line break after chunk data')
+    while True:
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        if line in (b'\r\n', b'\n', b''):
+            break
+
+async def iter_eof(reader, timeout=None):
+    '''Read a body delimited by the end of the connection.'''
+    while True:
+        data = await asyncio.wait_for(reader.read(BUF_SIZE), timeout)
+        if not data:
+            break
+        yield data
+
+class Response:
+    '''Head of a response, with the body as an async iterator in `body`.'''
+
+    def __init__(self, version, status, reason, headers, body=None):
+        self.version = version
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def __repr__(self):
+        return '<Response %d %s>' % (self.status, self.reason)
+
+class Connection:
+    '''A connection to an HTTP server, reused while `reusable` is True.'''
+
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.reusable = True
+        self.last_used = 0
+
+    @property
+    def closed(self):
+        return self.writer is None
+
+    @property
+    def alive(self):
+        '''Whether the server has not closed an idle connection.'''
+        return not self.closed and not self.reader.at_eof() and not self.writer.transport.is_closing()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.reusable = False
+
+    async def send(self, method, target, headers, body=None, chunked=False, timeout=None):
+        '''Send a request, streaming `body` if it is an async iterable.'''
+        writer = self.writer
+        lines = ['%s %s HTTP/1.1\r\n' % (method, target)]
+        lines.extend('%s: %s\r\n' % item for item in headers)
+        lines.append('\r\n')
+        writer.write(''.join(lines).encode('latin-1'))
+        if body is not None:
+            async for data in body:
+                if chunked:
+                    writer.writelines((b'%x\r\n' % len(data), data, b'\r\n'))
+                else:
+                    writer.write(data)
+                await asyncio.wait_for(writer.drain(), timeout)
+            if chunked:
+                writer.write(b'0\r\n\r\n')
+        await asyncio.wait_for(writer.drain(), timeout)
+
+    async def read_response(self, method, timeout=None):
+        '''Read the head of the final response, skipping 1xx responses.'''
+        while True:
+            try:
+                head = await asyncio.wait_for(self.reader.readuntil(b'\r\n\r\n'), timeout)
+            except asyncio.LimitOverrunError:
+                raise ValueError('Response head too large')
+            if len(head) > MAX_HEAD_SIZE:
+                raise ValueError('Response head too large')
+            lines = head.decode('latin-1').split('\r\n')
+            version, _, rest = lines[0].partition(' ')
+            code, _, reason = rest.partition(' ')
+            if not version.startswith('HTTP/'):
+                raise ValueError('Bad status line: %r' % lines[0])
+            status = int(code)
+            if status >= 200 or status == 101:
+                break
+        headers = []
+        for line in lines[1:]:
+            if not line:
+                continue
+            key, sep, value = line.partition(':')
+            if not sep:
+                raise ValueError('Bad header line: %r' % line)
+            headers.append((key.strip(), value.strip()))
+        version = tuple(map(int, version[5:].split('.')))
+        connection = (get_header(headers, 'connection') or '').lower()
+        if version < (1, 1) and 'keep-alive' not in connection or 'close' in connection:
+            self.reusable = False
+        reader = self.reader
+        if method == 'HEAD' or status in (204, 304) or status < 200:
+            body = None
+        elif 'chunked' in (get_header(headers, 'transfer-encoding') or '').lower():
+            body = iter_chunked(reader, timeout)
+        elif get_header(headers, 'content-length') is not None:
+            body = iter_length(reader, int(get_header(headers, 'content-length')), timeout)
+        else:
+            self.reusable = False
+            body = iter_eof(reader, timeout)
+        if status == 101:
+            # the connection is taken over by another protocol
+            self.reusable = False
+        return Response(version, status, reason, headers, body)
+
+class ConnectionPool:
+    '''Idle persistent connections, keyed by host, port and TLS.
+
+    Up to `max_idle` connections are kept per origin, for `idle_timeout`
+    seconds.
+    '''
+
+    def __init__(self, max_idle=None, idle_timeout=None, connect_timeout=None):
+        self.max_idle = MAX_IDLE if max_idle is None else max_idle
+        self.idle_timeout = IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+        self.connect_timeout = CONNECT_TIMEOUT if connect_timeout is None else connect_timeout
+        self.idle = {}
+        self.reaper = None
+
+    def __len__(self):
+        return sum(map(len, self.idle.values()))
+
+    async def connect(self, host, port, ssl=False):
+        '''Get an idle connection or open a new one.
+
+        Return `(connection, reused)`.
+        '''
+        key = host, port, ssl
+        idle = self.idle.get(key)
+        deadline = asyncio.get_event_loop().time() - self.idle_timeout
+        while idle:
+            conn = idle.pop()
+            if conn.last_used > deadline and conn.alive:
+                return conn, True
+            conn.close()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl or None, limit=MAX_HEAD_SIZE),
+            self.connect_timeout)
+        return Connection(key, reader, writer), False
+
+    def release(self, conn):
+        '''Keep a connection whose response has been read for later use.'''
+        if not conn.reusable or not conn.alive:
+            conn.close()
+            return
+        conn.last_used = asyncio.get_event_loop().time()
+        idle = self.idle.setdefault(conn.key, collections.deque())
+        idle.append(conn)
+        while len(idle) > self.max_idle:
+            idle.popleft().close()
+        self.schedule_reap()
+
+    def schedule_reap(self):
+        if self.reaper is None:
+            self.reaper = asyncio.get_event_loop().call_later(self.idle_timeout, self.reap)
+
+    def reap(self):
+        '''Close connections that have been idle for `idle_timeout`.'''
+        self.reaper = None
+        deadline = asyncio.get_event_loop().time() - self.idle_timeout
+        for key, idle in list(self.idle.items()):
+            while idle and idle[0].last_used <= deadline:
+                idle.popleft().close()
+            if not idle:
+                del self.idle[key]
+        if self.idle:
+            self.schedule_reap()
+
+    def clear(self):
+        for idle in self.idle.values():
+            for conn in idle:
+                conn.close()
+        self.idle.clear()
+
+    async def request(self, host, port, method, target, headers, body=None, chunked=False, ssl=False, timeout=None):
+        '''Send a request and read the head of its response.
+
+        The connection goes back to the pool once the body of the response
+        is read. A reused connection that fails before the response starts
+        was probably closed by the server, and the request is sent again on
+        a new connection if it has no body.
+        '''
+        while True:
+            conn, reused = await self.connect(host, port, ssl)
+            try:
+                try:
+                    await conn.send(method, target, headers, body, chunked, timeout)
+                except ConnectionError:
+                    if body is None:
+                        raise
+                    # the server may have answered without reading the body
+                    conn.reusable = False
+                response = await conn.read_response(method, timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                conn.close()
+                if reused and body is None:
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            response.body = self.iter_body(conn, response.body)
+            return response
+
+    async def iter_body(self, conn, body):
+        try:
+            if body is not None:
+                async for data in body:
+                    yield data
+        except BaseException:
+            # interrupted, the rest of the body is unknown
+            conn.close()
+            raise
+        self.release(conn)
+
+pools = {}
+
+def get_pool(max_idle=None, idle_timeout=None, connect_timeout=None):
+    '''Get a shared connection pool by its settings.'''
+    key = max_idle, idle_timeout, connect_timeout
+    pool = pools.get(key)
+    if pool is None:
+        pool = pools[key] = ConnectionPool(max_idle, idle_timeout, connect_timeout)
+    return pool
@@ -0,0 +1,191 @@
+'''
+Admission control
+
+Connections are limited per process and per listener, in total and per
+client address, and requests are limited per route with a bounded queue.
+Requests over a limit are answered at once with `503` and `Retry-After`
+instead of waiting behind the others.
+'''
+import asyncio
+import collections
+from . import metrics
+
+RETRY_AFTER = 1
+QUEUE_TIMEOUT = 10
+# sent to connections that are not admitted, without reading the request
+REJECT_RESPONSE = (
+    'HTTP/1.1 503 Service Unavailable\r\n'
+    'Retry-After: %d\r\n'
+    'Content-Length: 0\r\n'
+    'Connection: close\r\n'
+    '\r\n'
+)
+
+rejected_count = metrics.Counter(
+    'pyweb_rejected_total', 'Connections and requests rejected by limits.', ('limit', 'reason'))
+connections_gauge = metrics.Gauge(
+    'pyweb_connections', 'Open connections by limit.', ('limit',))
+max_connections_gauge = metrics.Gauge(
+    'pyweb_connections_max', 'Maximum connections by limit, 0 if unlimited.', ('limit',))
+concurrency_gauge = metrics.Gauge(
+    'pyweb_route_active_requests', 'Requests being handled by route limit.', ('route',))
+max_concurrency_gauge = metrics.Gauge(
+    'pyweb_route_max_requests', 'Maximum requests being handled by route limit.', ('route',))
+queued_gauge = metrics.Gauge(
+    'pyweb_route_queued_requests', 'Requests waiting for a route limit.', ('route',))
+
+class ConnectionLimit:
+    '''Count connections, allowing up to `max_connections` in total and
+    `max_per_ip` from a client address, 0 means unlimited.'''
+
+    def __init__(self, name, max_connections=0, max_per_ip=0):
+        self.name = name
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.count = 0
+        self.per_ip = collections.Counter()
+
+    def check(self, ip):
+        '''Return the reason to reject a new connection, or None.'''
+        if self.max_connections and self.count >= self.max_connections:
+            return 'connections'
+        if self.max_per_ip and ip is not None and self.per_ip[ip] >= self.max_per_ip:
+            return 'client'
+
+    def acquire(self, ip):
+        self.count += 1
+        # counted even without `max_per_ip`, which may be set by a reload
+        if ip is not None:
+            self.per_ip[ip] += 1
+
+    def release(self, ip):
+        self.count -= 1
+        if ip is not None:
+            count = self.per_ip[ip] - 1
+            if count:
+                self.per_ip[ip] = count
+            else:
+                del self.per_ip[ip]
+
+connection_limits = []
+
+def get_connection_limit(name, max_connections=0, max_per_ip=0):
+    '''Create a connection limit reported in metrics as `name`.'''
+    limit = ConnectionLimit(name, max_connections, max_per_ip)
+    connection_limits.append(limit)
+    return limit
+
+def remove_connection_limit(limit):
+    connection_limits.remove(limit)
+
+def admit(limits, ip):
+    '''Count a new connection in all `limits` if none of them is full.
+
+    Return the rejecting limit and the reason, or None if the connection
+    is admitted.
+    '''
+    for limit in limits:
+        reason = limit.check(ip)
+        if reason is not None:
+            rejected_count.labels(limit.name, reason).inc()
+            return limit, reason
+    for limit in limits:
+        limit.acquire(ip)
+
+def release(limits, ip):
+    for limit in limits:
+        limit.release(ip)
+
+async def reject(writer, retry_after=RETRY_AFTER):
+    '''Answer a connection that is not admitted and close it.'''
+    try:
+        writer.write((REJECT_RESPONSE % retry_after).encode())
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+class RouteLimit:
+    '''Allow `max_concurrency` requests at a time, and up to `max_queue`
+    requests to wait `queue_timeout` seconds for their turn.'''
+
+    def __init__(self, name, max_concurrency, max_queue=0, queue_timeout=QUEUE_TIMEOUT):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiters = collections.deque()
+
+    async def acquire(self):
+        '''Wait for a slot, return the reason if the request is rejected.'''
+        if self.active < self.max_concurrency and not self.waiters:
+            self.active += 1
+            return
+        if len(self.waiters) >= self.max_queue:
+            return self.rejected('queue')
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                self.waiters.remove(waiter)
+                return self.rejected('timeout')
+        except asyncio.CancelledError:
+            if waiter.done():
+                # the slot was handed over, pass it on
+                self.release()
+            else:
+                self.waiters.remove(waiter)
+            raise
+
+    def rejected(self, reason):
+        rejected_count.labels(self.name, reason).inc()
+        return reason
+
+    def release(self):
+        '''Hand the slot over to the first waiting request, if any.'''
+        if self.waiters:
+            self.waiters.popleft().set_result(None)
+        else:
+            self.active -= 1
+
+route_limits = {}
+
+def get_route_limit(options):
+    '''Get the limit of a route from its `max_concurrency` option.
+
+    Routes with the same `concurrency_group` share a limit, otherwise each
+    section that sets `max_concurrency` has its own, shared with the
+    sections that inherit it. Return None if it is unlimited, which is the
+    default.
+    '''
+    max_concurrency = options.get('max_concurrency')
+    if not max_concurrency:
+        return
+    name = options.get('concurrency_group')
+    key = name or options.get('route_limit_key')
+    limit = route_limits.get(key)
+    if limit is None:
+        limit = route_limits[key] = RouteLimit(
+            name or 'route%d' % len(route_limits),
+            max_concurrency,
+            options.get('max_queue', 0),
+            options.get('queue_timeout', QUEUE_TIMEOUT))
+    return limit
+
+def collect_metrics():
+    for gauge in (connections_gauge, max_connections_gauge,
+            concurrency_gauge, max_concurrency_gauge, queued_gauge):
+        gauge.clear()
+    for limit in connection_limits:
+        connections_gauge.labels(limit.name).inc(limit.count)
+        max_connections_gauge.labels(limit.name).inc(limit.max_connections)
+    for limit in route_limits.values():
+        concurrency_gauge.labels(limit.name).set(limit.active)
+        max_concurrency_gauge.labels(limit.name).set(limit.max_concurrency)
+        queued_gauge.labels(limit.name).set(len(limit.waiters))
+
+metrics.registry.add_collector(collect_metrics)
@@ -0,0 +1,143 @@
+'''
+Counters, gauges and histograms exposed in the Prometheus text format
+
+Metrics are kept per process, so each worker reports its own.
+'''
+import bisect
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# seconds, from 100 microseconds to 10 seconds
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def format_labels(names, values):
+    return ','.join('%s="%s"' % (name, escape(value)) for name, value in zip(names, values))
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return repr(value)
+
+class Value:
+    '''Sample of a counter or a gauge.'''
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+class HistogramValue:
+    '''Observations counted in buckets, the last one is `+Inf`.'''
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        # bounds are inclusive, i.e. `le`
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+class Registry:
+    '''Metrics to expose, in the order they are created.'''
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def add_collector(self, collect):
+        '''Add a function that updates gauges before metrics are rendered.'''
+        self.collectors.append(collect)
+
+    def render(self):
+        for collect in self.collectors:
+            collect()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        lines.append('')
+        return '\n'.join(lines)
+
+registry = Registry()
+
+class Metric:
+    '''A family of samples, one per combination of label values.'''
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), registry=registry):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        registry.register(self)
+
+    def labels(self, *values):
+        '''Get the sample of a combination of label values.
+
+        Samples may be kept by callers to skip the lookup.
+        '''
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.new_child()
+        return child
+
+    def new_child(self):
+        return Value()
+
+    def clear(self):
+        self.children.clear()
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.documentation),
+            '# TYPE %s %s' % (self.name, self.type),
+        ]
+        for values, child in self.children.items():
+            lines.extend(self.render_child(format_labels(self.labelnames, values), child))
+        return lines
+
+    def render_child(self, labels, child):
+        yield '%s%s %s' % (self.name, '{%s}' % labels if labels else '', format_value(child.value))
+
+class Counter(Metric):
+    type = 'counter'
+
+class Gauge(Metric):
+    type = 'gauge'
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=registry):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def new_child(self):
+        return HistogramValue(self.buckets)
+
+    def render_child(self, labels, child):
+        prefix = labels + ',' if labels else ''
+        labels = '{%s}' % labels if labels else ''
+        total = 0
+        for bound, count in zip(child.bounds + (float('inf'),), child.counts):
+            total += count
+            yield '%s_bucket{%sle="%s"} %d' % (self.name, prefix, format_value(float(bound)), total)
+        yield '%s_sum%s %s' % (self.name, labels, format_value(child.sum))
+        yield '%s_count%s %d' % (self.name, labels, total)
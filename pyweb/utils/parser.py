@@ -1,9 +1,16 @@
-import urllib
+import urllib.parse
 
 def parse_addr(host, default=('', 80)):
     result = urllib.parse.urlparse('//' + host)
     hostname = result.hostname
     if hostname is None: hostname = default[0]
     port = result.port
-    if port is None: port = default[0]
+    if port is None: port = default[1]
     return hostname, port
+
+def get_pool_key(targets, kw):
+    '''Key of a pool of `targets` with settings `kw`, by value so that
+    equal configs share the pool.'''
+    if isinstance(targets, str):
+        targets = [targets]
+    return tuple(targets), tuple(sorted(kw.items()))
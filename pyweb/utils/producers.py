@@ -1,31 +1,113 @@
+import asyncio
+
 class FileProducer:
-    bufsize = 4096
-    fp = None
-    def __init__(self, path, start=0, length=None):
-        if length is None or length > 0:
-            self.fp = open(path, 'rb')
-            if start: self.fp.seek(start)
+    '''Produce the content of a file in chunks.
+
+    It can be iterated synchronously, or asynchronously in which case the
+    file is read in `executor` one chunk ahead of the consumer.
+
+    Chunks start at `bufsize` bytes and double on each read up to
+    `max_bufsize`, so that small files are answered quickly and large
+    ones are read in few calls.
+    '''
+    bufsize = 16384
+    max_bufsize = 262144
+
+    def __init__(self, path, start=0, length=None, executor=None):
+        self.path = path
+        self.start = start
         self.length = length
+        self.executor = executor
+        self.fp = None
+        self.done = length is not None and length <= 0
+        self.pending = None
+
+    def open(self):
+        if self.fp is None and not self.done:
+            self.fp = open(self.path, 'rb')
+            if self.start: self.fp.seek(self.start)
+
+    def read(self):
+        self.open()
+        fp = self.fp
+        if self.done or fp is None:
+            return b''
+        bufsize = self.bufsize
+        if bufsize < self.max_bufsize:
+            self.bufsize = min(bufsize * 2, self.max_bufsize)
+        length = bufsize if self.length is None else min(self.length, bufsize)
+        data = fp.read(length)
+        if self.length is not None:
+            self.length -= len(data)
+        if not data or self.length == 0:
+            self.done = True
+        return data
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        if self.fp is None:
-            raise StopIteration
-        length = min(self.length, self.bufsize) if self.length else self.bufsize
-        data = self.fp.read(length)
+        data = self.read()
         if data:
-            if self.length:
-                self.length -= len(data)
             return data
         else:
+            self.close()
             raise StopIteration
 
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.executor is None:
+            data = self.read()
+        elif self.pending is None and self.done:
+            data = None
+        else:
+            loop = asyncio.get_running_loop()
+            if self.pending is None:
+                self.pending = loop.run_in_executor(self.executor, self.read)
+            # shielded, so that a cancelled read is still seen by `close`
+            data = await asyncio.shield(self.pending)
+            self.pending = None
+            if data and not self.done:
+                self.pending = loop.run_in_executor(self.executor, self.read)
+        if data:
+            return data
+        else:
+            self.close()
+            raise StopAsyncIteration
+
+    async def sendfile(self, transport):
+        '''Send the rest of the file to `transport` with `loop.sendfile`.
+
+        Raise `RuntimeError` if the transport does not support zero-copy
+        transfer, in which case nothing is sent and the producer can still
+        be iterated.
+        '''
+        loop = asyncio.get_running_loop()
+        if self.executor is None:
+            self.open()
+        else:
+            self.pending = loop.run_in_executor(self.executor, self.open)
+            await asyncio.shield(self.pending)
+            self.pending = None
+        if self.fp is None or self.done:
+            return 0
+        sent = await loop.sendfile(
+            transport, self.fp, self.fp.tell(), self.length, fallback=False)
+        self.close()
+        return sent
+
     def __del__(self):
         self.close()
 
     def close(self):
-        if self.fp is not None:
-            self.fp.close()
-            self.fp = None
+        self.done = True
+        pending, self.pending = self.pending, None
+        if pending is not None and not pending.done():
+            # the read or open in progress may still use or open the file
+            pending.add_done_callback(lambda _: self.close())
+            return
+        fp, self.fp = self.fp, None
+        if fp is not None:
+            fp.close()
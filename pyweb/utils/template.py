@@ -1,29 +1,48 @@
 '''Render templates'''
 
 import os
-from jinja2 import Template
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, TemplateNotFound
 
 BASE_DIR = os.path.join(os.path.dirname(__file__), '../templates')
-cache = {}
+# pieces of output per chunk when streaming
+STREAM_BUFFER = 512
+environments = {}
+bytecode_cache = FileSystemBytecodeCache()
+
+def get_environment(dirname):
+    '''Get the shared environment of a template directory.
+
+    Compiled templates are kept in memory and as bytecode on disk, so that
+    worker processes and restarts do not compile them again.
+    '''
+    dirname = os.path.realpath(dirname)
+    env = environments.get(dirname)
+    if env is None:
+        env = environments[dirname] = Environment(
+            loader=FileSystemLoader(dirname),
+            bytecode_cache=bytecode_cache,
+            auto_reload=False)
+    return env
 
 def get_template(dirname, name):
-    '''Compile template based on name or filename'''
-    key = dirname, name
-    template = cache.get(key)
-    if template is None:
-        filename = os.path.join(dirname, name + '.html')
-        filename = os.path.realpath(filename)
-        template = cache.get(filename)
-        if template is None:
-            raw = open(filename, encoding='utf-8').read()
-            template = Template(raw).render
-            cache[filename] = template
-        cache[key] = template
-    return template
+    '''Get compiled template based on name or filename'''
+    try:
+        return get_environment(dirname).get_template(name + '.html')
+    except TemplateNotFound:
+        return
 
 def render(name='base', args={}, dirname=BASE_DIR):
     '''Render template based on name or filename'''
     template = get_template(dirname, name)
     if template is None:
         return 'Not found'
-    return template(**args)
+    return template.render(**args)
+
+def stream(name='base', args={}, dirname=BASE_DIR, size=STREAM_BUFFER):
+    '''Render template as an iterable of chunks'''
+    template = get_template(dirname, name)
+    if template is None:
+        return 'Not found',
+    output = template.stream(**args)
+    output.enable_buffering(size)
+    return output
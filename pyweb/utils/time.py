@@ -1,15 +1,55 @@
+'''HTTP dates (RFC 7231), always in UTC'''
 import time
+import functools
+import email.utils
 
 GMT = '%a, %d %b %Y %H:%M:%S GMT'
 
+_now = None, None
+
+@functools.lru_cache(maxsize=1024)
+def format_date(seconds):
+    return email.utils.formatdate(seconds, usegmt=True)
+
 def datetime_string(timestamp=None):
-    if timestamp is None:
-        timestamp = time.time()
-    return time.strftime(GMT, time.localtime(timestamp))
+    '''Format a timestamp, or the current time, as an IMF-fixdate.
+
+    The current date is formatted once per second.
+    '''
+    global _now
+    if timestamp is not None:
+        return format_date(int(timestamp))
+    second = int(time.time())
+    cached, value = _now
+    if cached != second:
+        value = email.utils.formatdate(second, usegmt=True)
+        _now = second, value
+    return value
+
+@functools.lru_cache(maxsize=1024)
+def parse_date(value):
+    '''Parse an HTTP date in any of the formats of RFC 7231.
+
+    Return a UTC timestamp, or None if `value` is not a valid date.
+    '''
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return
+    try:
+        return email.utils.mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return
 
 def datetime_compare(t1, t2):
+    '''Return True if `t1` is not earlier than `t2`, in whole seconds.
+
+    Invalid dates never compare as later.
+    '''
     if isinstance(t1, str):
-        t1 = time.mktime(time.strptime(t1, GMT))
+        t1 = parse_date(t1)
     if isinstance(t2, str):
-        t2 = time.mktime(time.strptime(t2, GMT))
-    return t1 >= t2
+        t2 = parse_date(t2)
+    if t1 is None or t2 is None:
+        return False
+    # HTTP dates have no fractions of a second
+    return int(t1) >= int(t2)
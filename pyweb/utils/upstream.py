@@ -0,0 +1,185 @@
+'''
+Load balancing over upstream HTTP servers
+'''
+import asyncio
+import bisect
+import hashlib
+from .parser import parse_addr, get_pool_key
+from . import httpclient
+
+# points per server on the hash ring
+RING_POINTS = 100
+
+def hash_key(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:4], 'big')
+
+class Server:
+    '''An upstream server and its health.'''
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.active = 0
+        self.fails = 0
+        self.down_until = 0
+        # result of the last active health check
+        self.healthy = True
+
+    def available(self, now):
+        return self.healthy and self.down_until <= now
+
+    def __repr__(self):
+        return '<Server %s:%s active=%d healthy=%s>' % (
+            *self.addr, self.active, self.healthy)
+
+class Balancer:
+    '''Select upstream servers for requests.
+
+    `policy` is one of:
+
+    - `round_robin`: servers take turns;
+    - `least_conn`: the server with the fewest active requests, ties are
+      broken round-robin;
+    - `hash`: consistent hashing on a key, e.g. the value of a header, so
+      that a key sticks to a server while it is available.
+
+    A server is skipped for `fail_timeout` seconds after `max_fails`
+    failed requests in a row. If `health_check` is set, each server is
+    requested at that path every `health_interval` seconds, and skipped
+    while it fails to answer or answers with a 5xx status.
+    '''
+    policy = 'round_robin'
+    max_fails = 1
+    fail_timeout = 10
+    health_check = None
+    health_interval = 5
+    health_timeout = 5
+    pool = {}
+
+    def __init__(self, targets, policy=None, max_fails=None, fail_timeout=None,
+            health_check=None, health_interval=None, connections=None):
+        if isinstance(targets, str):
+            targets = [targets]
+        if policy is not None:
+            if policy not in ('round_robin', 'least_conn', 'hash'):
+                raise ValueError('Unknown upstream policy: %s' % policy)
+            self.policy = policy
+        if max_fails is not None:
+            self.max_fails = max_fails
+        if fail_timeout is not None:
+            self.fail_timeout = fail_timeout
+        if health_check is not None:
+            self.health_check = health_check
+        if health_interval is not None:
+            self.health_interval = health_interval
+        self.connections = connections or httpclient.get_pool()
+        self.servers = [Server(parse_addr(target)) for target in targets]
+        self.offset = 0
+        self.checker = None
+        ring = []
+        for index, server in enumerate(self.servers):
+            for i in range(RING_POINTS):
+                ring.append((hash_key('%s:%s-%d' % (*server.addr, i)), index))
+        ring.sort()
+        self.ring = ring
+        self.ring_keys = [point for point, _index in ring]
+
+    def select(self, key=None, exclude=()):
+        '''Select an available server that is not in `exclude`.
+
+        If no server is available, the least recently failed one is
+        returned, so that requests are not refused while all servers
+        recover. Return None if all servers are excluded.
+        '''
+        self.start()
+        now = asyncio.get_event_loop().time()
+        if self.policy == 'hash' and key is not None:
+            candidates = self.iter_ring(key)
+        else:
+            count = len(self.servers)
+            candidates = [self.servers[(self.offset + i) % count] for i in range(count)]
+            self.offset = (self.offset + 1) % count
+            if self.policy == 'least_conn':
+                # sort is stable so round-robin order is kept among ties
+                candidates.sort(key=lambda server: server.active)
+        fallback = None
+        for server in candidates:
+            if server in exclude:
+                continue
+            if server.available(now):
+                return server
+            if fallback is None or server.down_until < fallback.down_until:
+                fallback = server
+        return fallback
+
+    def iter_ring(self, key):
+        '''Iterate over the servers from the position of `key` on the ring.'''
+        seen = set()
+        start = bisect.bisect(self.ring_keys, hash_key(key))
+        count = len(self.ring)
+        for i in range(count):
+            index = self.ring[(start + i) % count][1]
+            if index not in seen:
+                seen.add(index)
+                yield self.servers[index]
+                if len(seen) == len(self.servers):
+                    break
+
+    def acquire(self, server):
+        server.active += 1
+
+    def release(self, server, ok=True):
+        '''Put a server back after a request and record its outcome.'''
+        server.active -= 1
+        if ok:
+            server.fails = 0
+            return
+        server.fails += 1
+        if server.fails >= self.max_fails:
+            server.down_until = asyncio.get_event_loop().time() + self.fail_timeout
+            server.fails = 0
+
+    def start(self):
+        '''Start active health checks in the running loop.'''
+        if self.health_check and self.checker is None:
+            self.checker = asyncio.ensure_future(self.run_checks())
+
+    def close(self):
+        '''Stop health checks for good.'''
+        self.health_check = None
+        if self.checker is not None:
+            self.checker.cancel()
+            self.checker = None
+
+    async def run_checks(self):
+        while True:
+            await asyncio.gather(*(self.check(server) for server in self.servers))
+            await asyncio.sleep(self.health_interval)
+
+    async def check(self, server):
+        host, port = server.addr
+        try:
+            response = await self.connections.request(
+                host, port, 'GET', self.health_check, [('Host', host)],
+                timeout=self.health_timeout)
+            async for _data in response.body:
+                pass
+            server.healthy = response.status < 500
+        except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            server.healthy = False
+
+    @classmethod
+    def get(cls, targets, **kw):
+        '''Get a balancer by its targets and settings.'''
+        key = get_pool_key(targets, kw)
+        balancer = cls.pool.get(key)
+        if balancer is None:
+            balancer = cls.pool[key] = cls(targets, **kw)
+        return balancer
+
+    @classmethod
+    def retain(cls, used):
+        '''Close the balancers not in `used`, a list of `(targets, kw)`.'''
+        keys = set(get_pool_key(targets, kw) for targets, kw in used)
+        for key in list(cls.pool):
+            if key not in keys:
+                cls.pool.pop(key).close()
@@ -1,30 +1,14 @@
 '''Writers'''
-import gzip
-import io
+import zlib
 
-class BaseWriter:
-    def __init__(self, raw, logger):
-        self.raw = raw
-        self.logger = logger
-
-    def flush(self):
-        pass
-
-    def close(self):
-        pass
-
-class RawWriter(BaseWriter):
-    def __init__(self, raw, logger):
-        super().__init__(raw, logger)
-        self.written = 0
-
-    def write(self, data):
-        self.raw.write(data)
-        self.written += len(data)
-
-class ChunkedWriter(BaseWriter):
+class ResponseWriter:
     '''
-    A wrapper to write data into chunks
+    Write the head and body of a response to a stream writer.
+
+    Small pieces of data are collected in a buffer and sent when it holds
+    `bufsize` bytes, larger ones are sent as they are. The head is sent
+    along with the first piece of the body. Each piece is framed as a chunk
+    in chunked mode:
 
        Chunked-Body   = *chunk
                         last-chunk
@@ -34,65 +18,83 @@ class ChunkedWriter(BaseWriter):
                         chunk-data CRLF
        chunk-size     = 1*HEX
        last-chunk     = 1*("0") [ chunk-extension ] CRLF
-       chunk-extension= *( ";" chunk-ext-name [ "=" chunk-ext-val ] )
-       chunk-ext-name = token
-       chunk-ext-val  = token | quoted-string
-       chunk-data     = chunk-size(OCTET)
-       trailer        = *(entity-header CRLF)
     '''
-    def write(self, data):
-        if data:
-            #self.logger.debug('chunk %d', len(data))
-            self.raw.write(hex(len(data))[2:].encode() + b'\r\n')
-            self.raw.write(data)
-            self.raw.write(b'\r\n')
+    bufsize = 16384
 
-    def close(self):
-        '''write last chunk'''
-        #self.logger.debug('chunk 0')
-        self.raw.write(b'0\r\n\r\n')
-
-class BufferedWriter(BaseWriter):
-    '''
-    A wrapper to buffer data to avoid small pieces of data.
-    '''
-    bufsize = 4096
     def __init__(self, raw, logger, bufsize = None):
-        super().__init__(raw, logger)
+        self.raw = raw
+        self.logger = logger
         if bufsize:
             self.bufsize = bufsize
-        self.buffer = None
+        self.buffer = bytearray()
+        self.head = None
+        self.chunked = False
+        self.compressor = None
+        self.written = 0
+
+    def start(self, head, chunked = False, gzip = False, compresslevel = 6):
+        '''Start a response with its encoded head.'''
+        self.buffer.clear()
+        self.head = head
+        self.chunked = chunked
+        # wbits=31 produces a gzip container
+        self.compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31) if gzip else None
+        self.written = 0
 
     def write(self, data):
-        if self.buffer is None:
-            self.buffer = io.BytesIO()
-        self.buffer.write(data)
-        if self.buffer.tell() >= self.bufsize:
-            self.flush()
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        if not data:
+            return
+        if len(data) < self.bufsize:
+            self.buffer += data
+            if len(self.buffer) >= self.bufsize:
+                self.send_buffer()
+        else:
+            pending = self.take()
+            self.send((pending, data) if pending else (data,))
 
-    def flush(self):
-        #self.logger.debug('BufferedWriter:flush')
+    def take(self):
         if self.buffer:
-            data = self.buffer.getvalue()
-            if data:
-                self.raw.write(data)
-            self.buffer = None
+            # the transport may keep the object, so it must not be mutated
+            data = bytes(self.buffer)
+            self.buffer.clear()
+            return data
 
-    def close(self):
-        self.flush()
-        self.raw.close()
+    def send_buffer(self):
+        pending = self.take()
+        self.send((pending,) if pending else ())
 
-class GZipWriter(BaseWriter):
-    def __init__(self, raw, logger, compresslevel = 6):
-        super().__init__(raw, logger)
-        self.buffer = gzip.open(raw, 'wb', compresslevel = compresslevel)
+    def flush(self):
+        '''Send the buffered data, including what the compressor holds, so
+        that the client can decode everything written so far.'''
+        if self.compressor is not None:
+            self.buffer += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.send_buffer()
 
-    def write(self, data):
-        self.buffer.write(data)
+    def send(self, pieces, last = False):
+        parts = []
+        if self.head is not None:
+            parts.append(self.head)
+            self.head = None
+        if pieces:
+            size = sum(map(len, pieces))
+            if self.chunked:
+                parts.append(b'%x\r\n' % size)
+                parts.extend(pieces)
+                parts.append(b'\r\n')
+            else:
+                parts.extend(pieces)
+            self.written += size
+        if last and self.chunked:
+            parts.append(b'0\r\n\r\n')
+        if parts:
+            self.raw.writelines(parts)
 
     def close(self):
-        #self.logger.debug('GZipWriter:close')
-        #self.buffer.flush()
-        self.buffer.close()
-        self.raw.flush()
-        self.raw.close()
+        '''Send the rest of the body and the last chunk.'''
+        if self.compressor is not None:
+            self.buffer += self.compressor.flush()
+            self.compressor = None
+        pending = self.take()
+        self.send((pending,) if pending else (), last = True)
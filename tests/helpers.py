@@ -0,0 +1,173 @@
+'''Serve configs in the test's event loop and talk raw HTTP to them.'''
+import time
+import socket
+import struct
+import asyncio
+import contextlib
+import collections
+from pyweb.server.matcher import normalize_config
+from pyweb.server.listener import Listener
+from pyweb.utils import fcgi, limits
+from pyweb.utils.httpclient import get_header, iter_chunked
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_port(port, timeout=10):
+    '''Wait for a server in another process to listen on `port`.'''
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+class Response(collections.namedtuple('Response', 'status headers body')):
+    def get(self, name, default=None):
+        return get_header(self.headers, name, default)
+
+@contextlib.asynccontextmanager
+async def serve(config, ssl=None):
+    '''Serve a config item on a free local port, yield the listener.
+
+    The port is `listener.port`.
+    '''
+    config, = normalize_config(dict(config, access_log=None))
+    global_limit = limits.get_connection_limit('test')
+    listener = Listener(config, global_limit)
+    server = await asyncio.start_server(listener.handle, '127.0.0.1', 0, ssl=ssl)
+    listener.servers.append(server)
+    listener.port = server.sockets[0].getsockname()[1]
+    try:
+        yield listener
+    finally:
+        await listener.stop(1)
+        limits.remove_connection_limit(global_limit)
+
+async def read_response(reader, method='GET'):
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split()[1])
+    headers = []
+    for line in lines[1:]:
+        if line:
+            key, _, value = line.partition(':')
+            headers.append((key.strip(), value.strip()))
+    if method == 'HEAD' or status in (204, 304):
+        body = b''
+    elif 'chunked' in (get_header(headers, 'transfer-encoding') or ''):
+        body = b''.join([chunk async for chunk in iter_chunked(reader)])
+    elif get_header(headers, 'content-length') is not None:
+        body = await reader.readexactly(int(get_header(headers, 'content-length')))
+    else:
+        body = await reader.read()
+    return Response(status, headers, body)
+
+async def request(port, data, method='GET'):
+    '''Send raw request bytes on a new connection and read one response.'''
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write(data)
+        return await read_response(reader, method)
+    finally:
+        writer.close()
+
+async def get(port, path, headers=(), method='GET'):
+    lines = ['%s %s HTTP/1.1' % (method, path), 'Host: test']
+    lines.extend('%s: %s' % item for item in headers)
+    return await request(port, ('\r\n'.join(lines) + '\r\n\r\n').encode(), method)
+
+class FCGIServer:
+    '''A FastCGI server on a free local port, use it with `async with`.
+
+    Requests are answered by `respond`, the lengths of their STDIN are
+    added up in `stdin` and their params are appended to `requests`.
+    `mpxs_conns` and `max_reqs` are the answers to FCGI_GET_VALUES.
+    '''
+    response = b'Content-Type: text/plain\r\n\r\nok'
+    mpxs_conns = False
+    max_reqs = 10
+
+    def __init__(self):
+        self.connections = 0
+        self.requests = []
+        self.stdin = collections.Counter()
+        self.active = self.max_active = 0
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        self.target = '127.0.0.1:%d' % self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *args):
+        fcgi.Dispatcher.retain([])
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        params = {}
+        tasks = []
+        try:
+            while True:
+                header = await reader.readexactly(8)
+                _version, rec_type, req_id, length, padding = struct.unpack('!BBHHBx', header)
+                data = (await reader.readexactly(length + padding))[:length]
+                if rec_type == fcgi.FCGI_GET_VALUES:
+                    values = fcgi.build_name_value_pairs([
+                        (fcgi.FCGI_MPXS_CONNS, int(self.mpxs_conns)),
+                        (fcgi.FCGI_MAX_REQS, self.max_reqs)])
+                    writer.writelines(fcgi.build_record(
+                        fcgi.FCGI_NULL_REQUEST_ID, fcgi.FCGI_GET_VALUES_RESULT, values, False))
+                elif rec_type == fcgi.FCGI_BEGIN_REQUEST:
+                    params[req_id] = bytearray()
+                elif rec_type == fcgi.FCGI_PARAMS:
+                    params[req_id] += data
+                elif rec_type == fcgi.FCGI_STDIN and data:
+                    await self.receive(req_id, data)
+                elif rec_type == fcgi.FCGI_STDIN:
+                    env = fcgi.parse_name_value_pairs(bytes(params.pop(req_id)))
+                    self.requests.append(env)
+                    tasks.append(asyncio.ensure_future(self.run(writer, req_id, env)))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def receive(self, req_id, data):
+        self.stdin[req_id] += len(data)
+
+    async def run(self, writer, req_id, env):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            status = await self.respond(writer, req_id, env)
+        finally:
+            self.active -= 1
+        if status is not None:
+            writer.writelines(fcgi.build_record(
+                req_id, fcgi.FCGI_END_REQUEST, struct.pack('!IB3x', 0, status), False))
+
+    async def respond(self, writer, req_id, env):
+        '''Write the response, return the protocol status of the end of
+        the request, or None to leave the request unfinished.'''
+        writer.writelines(fcgi.build_record(req_id, fcgi.FCGI_STDOUT, self.response, False))
+        writer.writelines(fcgi.build_record(req_id, fcgi.FCGI_STDOUT))
+        return fcgi.FCGI_REQUEST_COMPLETE
+
+def fcgi_config(root, server, **options):
+    '''Config of a section passing `.php` files in `root` to `server`.'''
+    return {
+        'handler': ['fcgi'],
+        'options': dict({
+            'root': str(root),
+            'fcgi_ext': ['.php'],
+            'fcgi_target': [server.target],
+        }, **options),
+    }
@@ -0,0 +1,122 @@
+import os
+import json
+import asyncio
+import threading
+import pytest
+from helpers import serve, get
+from pyweb.utils import accesslog
+from pyweb.utils.accesslog import AccessLog, Record
+
+RECORD = Record(
+    1600000000, '127.0.0.1', 'test', 'GET /a"b HTTP/1.1', 200, 2,
+    None, 'curl/8', 0.0012345, 'file')
+
+@pytest.fixture(autouse=True)
+def clean_logs():
+    yield
+    accesslog.close_all()
+    AccessLog.pool.clear()
+
+def test_formats(monkeypatch):
+    monkeypatch.setenv('TZ', 'UTC')
+    monkeypatch.setattr(accesslog, '_clf_time', (None, None))
+    accesslog.time.tzset()
+    try:
+        assert accesslog.format_common(RECORD) == (
+            '127.0.0.1 - - [13/Sep/2020:12:26:40 +0000] "GET /a\\"b HTTP/1.1" 200 2\n')
+        assert accesslog.format_combined(RECORD) == (
+            '127.0.0.1 - - [13/Sep/2020:12:26:40 +0000] "GET /a\\"b HTTP/1.1" 200 2 "-" "curl/8"\n')
+        data = json.loads(accesslog.format_json(RECORD._replace(written='-')))
+        assert data['time'] == '2020-09-13T12:26:40+0000'
+        assert data['duration'] == 0.001234
+        assert data['written'] is None
+        assert data['handler'] == 'file'
+    finally:
+        monkeypatch.undo()
+        accesslog.time.tzset()
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        AccessLog(format='xml')
+
+def test_get():
+    assert AccessLog.get({'access_log': None}) is None
+    access_log = AccessLog.get({'access_log': 'a.log'})
+    # shared by configs with the same settings
+    assert AccessLog.get({'access_log': 'a.log', 'access_log_format': 'combined'}) is access_log
+    assert AccessLog.get({'access_log': 'a.log', 'access_log_format': 'json'}) is not access_log
+
+def test_written_by_thread(tmp_path):
+    threads = []
+
+    class Log(AccessLog):
+        def flush(self):
+            if self.records:
+                threads.append(threading.current_thread().name)
+            super().flush()
+
+    path = tmp_path / 'access.log'
+    access_log = Log(str(path), 'common')
+    for _ in range(3):
+        access_log.write(RECORD)
+    access_log.close()
+    assert threads == ['access-log']
+    assert len(path.read_text().splitlines()) == 3
+
+def test_dropped(tmp_path, monkeypatch):
+    path = tmp_path / 'access.log'
+    access_log = AccessLog.get({'access_log': str(path), 'access_log_queue': 2})
+    # the thread does not run, like a sink that does not keep up
+    monkeypatch.setattr(access_log, 'start', lambda: None)
+    for _ in range(5):
+        access_log.write(RECORD)
+    assert access_log.dropped == 3
+    accesslog.collect_metrics()
+    assert accesslog.dropped_count.labels().value == 3
+    assert accesslog.queued_gauge.labels().value == 2
+    access_log.flush()
+    access_log.file.close()
+    assert len(path.read_text().splitlines()) == 2
+
+def test_rotate(tmp_path):
+    path = tmp_path / 'access.log'
+    line = len(accesslog.format_common(RECORD))
+    access_log = AccessLog(str(path), 'common', max_bytes=line * 2, backups=2)
+    for i in range(7):
+        access_log.records.append(RECORD)
+        access_log.flush()
+    access_log.file.close()
+    assert len(path.read_text().splitlines()) == 1
+    assert len((tmp_path / 'access.log.1').read_text().splitlines()) == 2
+    assert len((tmp_path / 'access.log.2').read_text().splitlines()) == 2
+    assert not (tmp_path / 'access.log.3').exists()
+
+def test_reopen(tmp_path):
+    path = tmp_path / 'access.log'
+    access_log = AccessLog(str(path), 'common')
+    access_log.records.append(RECORD)
+    access_log.flush()
+    # moved by logrotate
+    os.rename(path, tmp_path / 'old.log')
+    access_log.reopen()
+    access_log.records.append(RECORD)
+    access_log.flush()
+    access_log.file.close()
+    assert len((tmp_path / 'old.log').read_text().splitlines()) == 1
+    assert len(path.read_text().splitlines()) == 1
+
+def test_requests_logged(tmp_path, monkeypatch):
+    path = tmp_path / 'access.log'
+    access_log = AccessLog(str(path), 'json')
+    monkeypatch.setattr(AccessLog, 'get', classmethod(lambda cls, config: access_log))
+
+    async def main():
+        async with serve({'handler': []}) as listener:
+            await get(listener.port, '/missing', [('User-Agent', 'test-agent')])
+    asyncio.run(main())
+    access_log.close()
+    data, = map(json.loads, path.read_text().splitlines())
+    assert data['requestline'] == 'GET /missing HTTP/1.1'
+    assert data['status'] == 404
+    assert data['user_agent'] == 'test-agent'
+    assert data['handler'] == 'none'
@@ -0,0 +1,203 @@
+import asyncio
+import pytest
+from helpers import serve, get, FCGIServer, fcgi_config
+from pyweb.utils import cache as cache_module, fcgi
+from pyweb.utils.cache import LRUCache
+from pyweb.handlers import cache as cache_handler
+from pyweb.handlers.cache import parse_cache_control, get_freshness
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_module.time, 'monotonic', lambda: now[0])
+    return now
+
+def test_lru_size():
+    cache = LRUCache(max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    # `b` is the least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats() == {'size': 2, 'cost': 2, 'hits': 3, 'misses': 1, 'evictions': 1}
+
+def test_lru_ttl(clock):
+    cache = LRUCache(ttl=10)
+    cache.set('a', 1)
+    clock[0] += 9
+    assert cache.get('a') == 1
+    clock[0] += 1
+    assert cache.get('a', 'missing') == 'missing'
+    assert len(cache) == 0
+    cache = LRUCache(ttl=None)
+    cache.set('a', 1)
+    clock[0] += 1e6
+    assert cache.get('a') == 1
+
+def test_lru_cost():
+    cache = LRUCache(max_cost=10)
+    cache.set('a', 'a', 4)
+    cache.set('b', 'b', 4)
+    cache.set('c', 'c', 4)
+    assert cache.get('a') is None
+    assert cache.cost == 8
+    # replacing an item updates the cost
+    cache.set('b', 'b', 1)
+    assert cache.cost == 5
+    # items larger than the cache are not stored, and replace older values
+    cache.set('c', 'C', 11)
+    assert cache.get('c') is None
+    assert cache.cost == 1
+    assert cache.pop('b') == 'b'
+    assert cache.cost == 0
+
+def test_parse_cache_control():
+    assert parse_cache_control(None) == {}
+    assert parse_cache_control('') == {}
+    assert parse_cache_control('Public, max-age=60, s-maxage="30",,no-cache') == {
+        'public': '', 'max-age': '60', 's-maxage': '30', 'no-cache': ''}
+
+OK = 200, 'OK'
+
+@pytest.mark.parametrize('status, headers, options, expected', [
+    (OK, [], {}, (1, 10)),
+    (OK, [], {'cache_ttl': 5, 'cache_stale': 0}, (5, 0)),
+    (OK, [], {'cache_ttl': 0, 'cache_stale': 0}, None),
+    (OK, [('Cache-Control', 'max-age=60')], {}, (60, 10)),
+    (OK, [('Cache-Control', 'max-age=60, s-maxage=30')], {}, (30, 10)),
+    (OK, [('Cache-Control', 'max-age=-1')], {}, (0, 10)),
+    (OK, [('Cache-Control', 'max-age=60, stale-while-revalidate=5')], {}, (60, 5)),
+    (OK, [('Cache-Control', 'max-age=60, private')], {}, None),
+    (OK, [('Cache-Control', 'no-store')], {}, None),
+    (OK, [('Cache-Control', 'no-cache')], {}, None),
+    (OK, [('Set-Cookie', 'a=1')], {}, None),
+    (OK, [('Date', 'Sun, 06 Nov 1994 08:49:37 GMT'), ('Expires', 'Sun, 06 Nov 1994 08:50:37 GMT')], {}, (60, 10)),
+    (OK, [('Expires', '0')], {'cache_stale': 0}, None),
+    (OK, [('Vary', 'Accept-Encoding')], {}, None),
+    (OK, [('Vary', 'accept-language')], {'cache_vary': ['Accept-Language']}, (1, 10)),
+    ((404, 'Not Found'), [], {}, (1, 10)),
+    ((302, 'Found'), [], {}, None),
+    ((500, 'Internal Server Error'), [('Cache-Control', 'max-age=60')], {}, None),
+])
+def test_get_freshness(status, headers, options, expected):
+    assert get_freshness(status, headers, options) == expected
+
+class CountingServer(FCGIServer):
+    '''Answers with the number of requests so far once `gate` is set,
+    and fails while `fail` is set.'''
+    headers = b''
+    fail = False
+
+    def __init__(self):
+        super().__init__()
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def respond(self, writer, req_id, env):
+        await self.gate.wait()
+        if self.fail:
+            writer.close()
+            return
+        body = str(len(self.requests)).encode()
+        writer.writelines(fcgi.build_record(
+            req_id, fcgi.FCGI_STDOUT, b'Content-Type: text/plain\r\n' + self.headers + b'\r\n' + body, False))
+        writer.writelines(fcgi.build_record(req_id, fcgi.FCGI_STDOUT))
+        return fcgi.FCGI_REQUEST_COMPLETE
+
+@pytest.fixture
+def root(tmp_path):
+    (tmp_path / 'index.php').write_bytes(b'')
+    yield tmp_path
+    cache_handler.response_caches.clear()
+
+def cache_config(root, server, **options):
+    return fcgi_config(root, server, cache_size=1 << 20, **options)
+
+def test_hit(root):
+    async def main():
+        async with CountingServer() as server, serve(cache_config(root, server)) as listener:
+            response = await get(listener.port, '/index.php')
+            assert (response.body, response.get('x-cache')) == (b'1', 'MISS')
+            response = await get(listener.port, '/index.php')
+            assert (response.body, response.get('x-cache')) == (b'1', 'HIT')
+            assert response.get('age') == '0'
+            # served from GET responses
+            response = await get(listener.port, '/index.php', method='HEAD')
+            assert response.get('x-cache') == 'HIT'
+            # another key
+            assert (await get(listener.port, '/index.php?a')).body == b'2'
+            assert len(server.requests) == 2
+    asyncio.run(main())
+
+def test_bypass(root):
+    async def main():
+        async with CountingServer() as server, serve(cache_config(root, server)) as listener:
+            await get(listener.port, '/index.php')
+            response = await get(listener.port, '/index.php', [('Authorization', 'Basic eDp4')])
+            assert response.body == b'2'
+            assert response.get('x-cache') is None
+            response = await get(listener.port, '/index.php', [('Content-Length', '0')], method='POST')
+            assert response.body == b'3'
+    asyncio.run(main())
+
+def test_not_stored(root):
+    async def main():
+        async with CountingServer() as server, serve(cache_config(root, server)) as listener:
+            server.headers = b'Cache-Control: no-store\r\n'
+            for i in range(1, 3):
+                assert (await get(listener.port, '/index.php')).body == str(i).encode()
+    asyncio.run(main())
+
+def test_vary(root):
+    async def main():
+        async with CountingServer() as server, serve(cache_config(
+                root, server, cache_vary=['Accept-Language'])) as listener:
+            server.headers = b'Vary: Accept-Language\r\n'
+            for language, body in (('en', b'1'), ('fr', b'2'), ('en', b'1')):
+                response = await get(listener.port, '/index.php', [('Accept-Language', language)])
+                assert response.body == body
+            # not cached on a header that is not in the key
+            server.headers = b'Vary: Cookie\r\n'
+            assert (await get(listener.port, '/index.php?a')).body == b'3'
+            assert (await get(listener.port, '/index.php?a')).body == b'4'
+    asyncio.run(main())
+
+def test_coalescing(root):
+    async def main():
+        async with CountingServer() as server, serve(cache_config(root, server)) as listener:
+            server.gate.clear()
+            requests = [asyncio.ensure_future(get(listener.port, '/index.php')) for _ in range(5)]
+            while not server.requests:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.1)
+            server.gate.set()
+            responses = await asyncio.gather(*requests)
+            # one backend request for concurrent misses
+            assert len(server.requests) == 1
+            assert [response.body for response in responses] == [b'1'] * 5
+            assert sorted(response.get('x-cache') for response in responses) == ['COALESCED'] * 4 + ['MISS']
+    asyncio.run(main())
+
+def test_stale_while_revalidate(root):
+    async def main():
+        async with CountingServer() as server, serve(cache_config(root, server)) as listener:
+            # expired at once, served stale for 60 seconds
+            server.headers = b'Cache-Control: max-age=0, stale-while-revalidate=60\r\n'
+            await get(listener.port, '/index.php')
+            server.gate.clear()
+            revalidate = asyncio.ensure_future(get(listener.port, '/index.php'))
+            while len(server.requests) < 2:
+                await asyncio.sleep(0.01)
+            response = await get(listener.port, '/index.php')
+            assert (response.body, response.get('x-cache')) == (b'1', 'STALE')
+            server.gate.set()
+            response = await revalidate
+            assert (response.body, response.get('x-cache')) == (b'2', 'MISS')
+            # served when the backend fails
+            server.fail = True
+            response = await get(listener.port, '/index.php')
+            assert response.status == 200
+            assert (response.body, response.get('x-cache')) == (b'2', 'STALE')
+    asyncio.run(main())
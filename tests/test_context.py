@@ -0,0 +1,163 @@
+import asyncio
+import pytest
+from helpers import serve, get, read_response
+from pyweb.server import matcher
+from pyweb.server.context import HTTPContext, ResponseHeaders
+from pyweb.server.request import Request, Headers as RequestHeaders
+from pyweb.utils.time import parse_date
+
+def add_handler(monkeypatch, func):
+    func.name = func.__name__
+    monkeypatch.setitem(matcher.handlers, func.__name__, func)
+    return {'handler': [func.__name__]}
+
+@pytest.mark.parametrize('body', [
+    'text',
+    b'text',
+    [b'te', b'', 'xt'],
+])
+def test_bodies(monkeypatch, body):
+    async def handler(context, options):
+        return body
+
+    async def awaitable_handler(context, options):
+        async def result():
+            return body
+        return result()
+
+    async def main():
+        for func in (handler, awaitable_handler):
+            async with serve(add_handler(monkeypatch, func)) as listener:
+                response = await get(listener.port, '/')
+                assert response.status == 200
+                assert response.body == b'text'
+    asyncio.run(main())
+
+def test_event_stream(monkeypatch):
+    resume = None
+
+    async def events(context, options):
+        context.headers['Content-Type'] = 'text/event-stream'
+        async def stream():
+            yield 'data: 1\n\n'
+            await resume.wait()
+            yield 'data: 2\n\n'
+        return stream()
+
+    async def main():
+        nonlocal resume
+        resume = asyncio.Event()
+        async with serve(add_handler(monkeypatch, events)) as listener:
+            reader, writer = await asyncio.open_connection('127.0.0.1', listener.port)
+            writer.write(b'GET / HTTP/1.1\r\nHost: test\r\nConnection: close\r\n\r\n')
+            # the first event arrives before the second one is produced
+            data = await asyncio.wait_for(reader.readuntil(b'data: 1\n\n\r\n'), 5)
+            assert b'text/event-stream' in data
+            resume.set()
+            await asyncio.wait_for(reader.readuntil(b'data: 2\n\n\r\n0\r\n\r\n'), 5)
+            writer.close()
+    asyncio.run(main())
+
+def test_backpressure(monkeypatch):
+    produced = 0
+    closed = None
+    chunk = b'x' * 65536
+
+    async def endless(context, options):
+        async def stream():
+            nonlocal produced
+            try:
+                while True:
+                    produced += len(chunk)
+                    yield chunk
+            finally:
+                closed.set()
+        return stream()
+
+    async def main():
+        nonlocal closed
+        closed = asyncio.Event()
+        async with serve(add_handler(monkeypatch, endless)) as listener:
+            reader, writer = await asyncio.open_connection('127.0.0.1', listener.port)
+            writer.write(b'GET / HTTP/1.1\r\nHost: test\r\n\r\n')
+            await reader.readuntil(b'\r\n\r\n')
+            await asyncio.sleep(0.5)
+            # the client does not read, the producer waits for it
+            assert produced < 32 << 20
+            # and is closed once the client is gone
+            writer.transport.abort()
+            await asyncio.wait_for(closed.wait(), 5)
+    asyncio.run(main())
+
+def test_date_header(monkeypatch):
+    async def dated(context, options):
+        if context.request.path == '/set':
+            context.headers['Date'] = 'Thu, 01 Jan 1970 00:00:00 GMT'
+        return 'ok'
+
+    async def main():
+        async with serve(add_handler(monkeypatch, dated)) as listener:
+            response = await get(listener.port, '/')
+            assert parse_date(response.get('date')) is not None
+            response = await get(listener.port, '/set')
+            # set once, by the handler
+            assert response.get('date') == 'Thu, 01 Jan 1970 00:00:00 GMT'
+            assert len([key for key, _ in response.headers if key.lower() == 'date']) == 1
+    asyncio.run(main())
+
+def test_headers():
+    headers = ResponseHeaders()
+    headers['Content-Type'] = 'text/plain'
+    headers['Set-Cookie'] = 'a=1'
+    headers['set-cookie'] = 'b=2'
+    assert len(headers) == 3
+    assert 'content-type' in headers and 'Vary' not in headers
+    assert headers['SET-COOKIE'] == 'a=1'
+    assert headers.get('vary', '-') == '-'
+    headers.replace_header('Content-Type', 'text/html')
+    with pytest.raises(KeyError):
+        headers.replace_header('Vary', 'Accept')
+    del headers['Set-Cookie']
+    del headers['Vary']
+    headers.add_header('Content-Disposition', 'attachment', filename='a "b".txt')
+    headers.add_header('Content-Disposition', 'inline', file_name='é.txt')
+    assert headers.items() == [
+        ('Content-Type', 'text/html'),
+        ('Content-Disposition', 'attachment; filename="a \\"b\\".txt"'),
+        ('Content-Disposition', "inline; file-name*=utf-8''%C3%A9.txt"),
+    ]
+    headers.clear()
+    assert len(headers) == 0
+
+def test_state_reused(monkeypatch):
+    seen = []
+
+    async def state(context, options):
+        assert 'X-Test' not in context.headers
+        context.headers['X-Test'] = '1'
+        seen.append((context, context.request, context.headers, context.response_writer, context.env))
+        return context.request.path
+
+    async def main():
+        async with serve(add_handler(monkeypatch, state)) as listener:
+            reader, writer = await asyncio.open_connection('127.0.0.1', listener.port)
+            for path in ('/a', '/b'):
+                writer.write(b'GET %s HTTP/1.1\r\nHost: test\r\n\r\n' % path.encode())
+                response = await read_response(reader)
+                assert response.body == path.encode()
+            writer.close()
+        first, second = seen
+        # reset for each request of a connection, not allocated again
+        for a, b in zip(first[:4], second[:4]):
+            assert a is b
+        # handlers may keep the environment of a request
+        assert first[4] is not second[4]
+        assert first[4]['SCRIPT_NAME'] == '' and first[4]['REQUEST_METHOD'] == 'GET'
+    asyncio.run(main())
+
+def test_slots():
+    for cls in (HTTPContext, Request, ResponseHeaders, RequestHeaders):
+        assert '__dict__' not in dir(cls), cls
+    request = Request(None, (1, 1))
+    with pytest.raises(AttributeError):
+        request.extra = 1
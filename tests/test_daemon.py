@@ -0,0 +1,194 @@
+import os
+import json
+import signal
+import asyncio
+import logging
+import multiprocessing
+import pytest
+from helpers import get, read_response, free_port, wait_port
+from pyweb.server import HTTPDaemon, matcher
+from pyweb.utils import limits
+
+class Version:
+    '''A handler answering with the `version` option, `/slow` waits for
+    `release` first.'''
+    name = 'version'
+
+    def __init__(self):
+        self.entered = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def __call__(self, context, options):
+        version = options['version']
+        if context.request.path == '/slow':
+            self.entered.set()
+            await self.release.wait()
+        return str(version)
+
+@pytest.fixture
+def version(monkeypatch):
+    handler = Version()
+    monkeypatch.setitem(matcher.handlers, 'version', handler)
+    return handler
+
+def make_config(ports, version):
+    return [{
+        'bind': '127.0.0.1:%d' % port,
+        'access_log': None,
+        'loglevel': logging.WARNING,
+        'handler': ['version'],
+        'options': {'version': version},
+    } for port in ports]
+
+async def wait_for(predicate, timeout=5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.01)
+
+async def get_version(port, path='/'):
+    response = await get(port, path)
+    assert response.status == 200
+    return int(response.body)
+
+def test_reload(version):
+    a, b = free_port(), free_port()
+    state = {'ports': [a], 'version': 1}
+
+    def load_config():
+        if state['version'] is None:
+            raise ValueError('invalid config')
+        return make_config(state['ports'], state['version'])
+
+    async def main():
+        daemon = HTTPDaemon(load_config)
+        await daemon.start_servers()
+        try:
+            slow = asyncio.ensure_future(get(a, '/slow'))
+            await version.entered.wait()
+            reader, writer = await asyncio.open_connection('127.0.0.1', a)
+            writer.write(b'GET / HTTP/1.1\r\nHost: test\r\n\r\n')
+            assert (await read_response(reader)).body == b'1'
+            fresh_reader, fresh_writer = await asyncio.open_connection('127.0.0.1', a)
+            await asyncio.sleep(0.1)
+
+            state.update(ports=[a, b], version=2)
+            daemon.reload()
+            await wait_for(lambda: '127.0.0.1:%d' % b in daemon.listeners)
+            assert await get_version(a) == 2
+            assert await get_version(b) == 2
+            # the idle connection is closed
+            assert await asyncio.wait_for(reader.read(), 5) == b''
+            writer.close()
+            # a new one is given its first request
+            fresh_writer.write(b'GET / HTTP/1.1\r\nHost: test\r\n\r\n')
+            response = await read_response(fresh_reader)
+            assert response.body == b'1'
+            assert response.get('connection') == 'close'
+            fresh_writer.close()
+            # the request in progress finishes with the old config
+            version.release.set()
+            response = await slow
+            assert response.body == b'1'
+            assert response.get('connection') == 'close'
+
+            state.update(ports=[b], version=3)
+            daemon.reload()
+            await wait_for(lambda: '127.0.0.1:%d' % a not in daemon.listeners)
+            await asyncio.sleep(0.1)
+            with pytest.raises(ConnectionRefusedError):
+                await get(a, '/')
+            assert await get_version(b) == 3
+
+            # the current config is kept
+            state['version'] = None
+            daemon.reload()
+            await asyncio.sleep(0.1)
+            assert await get_version(b) == 3
+        finally:
+            for listener in daemon.listeners.values():
+                await listener.stop(1)
+            limits.remove_connection_limit(daemon.connection_limit)
+    asyncio.run(asyncio.wait_for(main(), 10))
+
+def test_stop_timeout(version):
+    port = free_port()
+
+    async def main():
+        daemon = HTTPDaemon(make_config([port], 1))
+        await daemon.start_servers()
+        try:
+            slow = asyncio.ensure_future(get(port, '/slow'))
+            await version.entered.wait()
+            listener, = daemon.listeners.values()
+            await listener.stop(0.1)
+            # aborted after the timeout
+            with pytest.raises(asyncio.IncompleteReadError):
+                await slow
+        finally:
+            limits.remove_connection_limit(daemon.connection_limit)
+    asyncio.run(asyncio.wait_for(main(), 10))
+
+async def sleepy(context, options):
+    if context.request.path == '/slow':
+        await asyncio.sleep(0.5)
+    return str(options['version'])
+sleepy.name = 'sleepy'
+
+@pytest.fixture
+def daemon(tmp_path, monkeypatch):
+    '''Serve the config in `config.json` in another process, yield the
+    process, the port and a function to change the version.'''
+    # inherited by the forked process
+    monkeypatch.setitem(matcher.handlers, 'sleepy', sleepy)
+    port = free_port()
+    path = tmp_path / 'config.json'
+
+    def set_version(value):
+        config, = make_config([port], value)
+        config['handler'] = ['sleepy']
+        path.write_text(json.dumps(config))
+    set_version(1)
+
+    def serve():
+        # the loop of the tests is closed
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        HTTPDaemon(lambda: json.loads(path.read_text())).serve()
+    process = multiprocessing.get_context('fork').Process(target=serve, daemon=True)
+    process.start()
+    try:
+        wait_port(port)
+        yield process, port, set_version
+    finally:
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGKILL)
+        process.join(10)
+
+def test_sighup(daemon):
+    process, port, set_version = daemon
+
+    async def main():
+        assert await get_version(port) == 1
+        set_version(2)
+        os.kill(process.pid, signal.SIGHUP)
+        for _ in range(100):
+            if await get_version(port) == 2:
+                break
+            await asyncio.sleep(0.05)
+        assert await get_version(port) == 2
+    asyncio.run(asyncio.wait_for(main(), 10))
+
+def test_sigterm(daemon):
+    process, port, _ = daemon
+
+    async def main():
+        slow = asyncio.ensure_future(get(port, '/slow'))
+        await asyncio.sleep(0.2)
+        os.kill(process.pid, signal.SIGTERM)
+        # finished before the process exits
+        response = await slow
+        assert response.status == 200
+        assert response.body == b'1'
+    asyncio.run(asyncio.wait_for(main(), 10))
+    process.join(10)
+    assert process.exitcode == 0
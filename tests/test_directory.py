@@ -0,0 +1,121 @@
+import os
+import json
+import asyncio
+import pytest
+from helpers import serve, get
+from pyweb.handlers import directory
+
+@pytest.fixture
+def root(tmp_path):
+    (tmp_path / 'b.txt').write_bytes(b'x' * 2048)
+    (tmp_path / 'A.mp4').write_bytes(b'')
+    (tmp_path / 'c').mkdir()
+    (tmp_path / '.hidden').write_bytes(b'')
+    return tmp_path
+
+@pytest.fixture(autouse=True)
+def clean_caches():
+    yield
+    directory.listing_caches.clear()
+
+def dir_config(root, **options):
+    return {'handler': ['dir'], 'options': dict(root=str(root), **options)}
+
+def test_list_dir(root):
+    assert directory.list_dir(str(root)) == (
+        ('A.mp4', False, 0),
+        ('b.txt', False, 2048),
+        ('c', True, None),
+    )
+
+def test_format_size():
+    assert directory.format_size(1000) == '1000B'
+    assert directory.format_size(2048) == '2.00KB'
+    assert directory.format_size(3 << 20) == '3.00MB'
+
+def test_html(root):
+    async def main():
+        async with serve(dir_config(root)) as listener:
+            response = await get(listener.port, '/')
+            assert response.status == 200
+            assert response.get('content-type') == 'text/html'
+            body = response.body.decode()
+            # directories first
+            assert body.index('href="c/"') < body.index('href="A.mp4"') < body.index('href="b.txt"')
+            assert '[2.00KB]' in body
+            assert 'file-video' in body
+            assert '.hidden' not in body
+            assert 'class="pager"' not in body
+    asyncio.run(main())
+
+def test_json(root):
+    async def main():
+        async with serve(dir_config(root)) as listener:
+            response = await get(listener.port, '/?format=json')
+            assert response.get('content-type') == 'application/json'
+            assert json.loads(response.body) == {
+                'path': '/',
+                'total': 3,
+                'offset': 0,
+                'limit': None,
+                'items': [
+                    {'name': 'A.mp4', 'type': 'file', 'size': 0},
+                    {'name': 'b.txt', 'type': 'file', 'size': 2048},
+                    {'name': 'c', 'type': 'dir', 'size': None},
+                ],
+            }
+    asyncio.run(main())
+
+def test_pagination(tmp_path):
+    for i in range(600):
+        (tmp_path / ('%03d' % i)).write_bytes(b'')
+
+    async def main():
+        async with serve(dir_config(tmp_path)) as listener:
+            response = await get(listener.port, '/?format=json&offset=250&limit=300')
+            data = json.loads(response.body)
+            assert (data['total'], data['offset'], data['limit']) == (600, 250, 300)
+            # more than a chunk of items
+            assert [item['name'] for item in data['items']] == ['%03d' % i for i in range(250, 550)]
+            response = await get(listener.port, '/?offset=100&limit=100')
+            body = response.body.decode()
+            assert 'href="099"' not in body and 'href="100"' in body
+            assert 'href="199"' in body and 'href="200"' not in body
+            assert '?offset=0&amp;limit=100' in body
+            assert '?offset=200&amp;limit=100' in body
+            response = await get(listener.port, '/?offset=-1&limit=x')
+            assert response.status == 400
+    asyncio.run(main())
+
+def test_listing_cache(root, monkeypatch):
+    calls = []
+    list_dir = directory.list_dir
+
+    def counted(realpath):
+        calls.append(realpath)
+        return list_dir(realpath)
+    monkeypatch.setattr(directory, 'list_dir', counted)
+
+    async def main():
+        # the directory is stat'ed by each request
+        async with serve(dir_config(root, file_cache_size=0)) as listener:
+            for _ in range(3):
+                await get(listener.port, '/?format=json')
+            assert len(calls) == 1
+            (root / 'd.txt').write_bytes(b'')
+            # the mtime of the directory changes
+            os.utime(root, ns=(0, os.stat(root).st_mtime_ns + 10 ** 9))
+            response = await get(listener.port, '/?format=json')
+            assert len(calls) == 2
+            assert json.loads(response.body)['total'] == 4
+    asyncio.run(main())
+
+def test_no_cache(root):
+    async def main():
+        async with serve(dir_config(root, dir_cache_size=0, file_cache_size=0)) as listener:
+            await get(listener.port, '/')
+            (root / 'd.txt').write_bytes(b'')
+            response = await get(listener.port, '/?format=json')
+            assert json.loads(response.body)['total'] == 4
+            assert not directory.listing_caches
+    asyncio.run(main())
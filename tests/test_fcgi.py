@@ -0,0 +1,198 @@
+import asyncio
+import tracemalloc
+import pytest
+from helpers import serve, get, read_response, FCGIServer, fcgi_config
+from pyweb.utils import fcgi
+
+@pytest.fixture
+def root(tmp_path):
+    (tmp_path / 'index.php').write_bytes(b'')
+    return tmp_path
+
+def test_response(root):
+    async def main():
+        async with FCGIServer() as server, serve(fcgi_config(root, server)) as listener:
+            response = await get(listener.port, '/index.php?a=1')
+            assert response.status == 200
+            assert response.body == b'ok'
+            env, = server.requests
+            assert env['SCRIPT_FILENAME'] == str(root / 'index.php')
+            assert env['QUERY_STRING'] == 'a=1'
+    asyncio.run(main())
+
+def test_upload_is_streamed(root):
+    size = 16 << 20
+    chunk = b'\0' * 65536
+
+    async def upload(port):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            writer.write(
+                b'POST /index.php HTTP/1.1\r\nHost: test\r\nConnection: close\r\n'
+                b'Content-Length: %d\r\n\r\n' % size)
+            for _ in range(size // len(chunk)):
+                writer.write(chunk)
+                await writer.drain()
+            return await read_response(reader)
+        finally:
+            writer.close()
+
+    async def main():
+        async with FCGIServer() as server, serve(fcgi_config(root, server)) as listener:
+            tracemalloc.start()
+            try:
+                response = await upload(listener.port)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            assert response.status == 200
+            assert sum(server.stdin.values()) == size
+            # the client, the web server and the FastCGI server run here,
+            # none of them holds the body
+            assert peak < size // 4
+    asyncio.run(main())
+
+# more than the response writer buffers
+PART = b'x' * 65536
+
+def test_response_is_streamed(root):
+    class Server(FCGIServer):
+        async def respond(self, writer, req_id, env):
+            writer.writelines(fcgi.build_record(
+                req_id, fcgi.FCGI_STDOUT, b'Content-Type: text/plain\r\n\r\n' + PART, False))
+            await self.resume.wait()
+            writer.writelines(fcgi.build_record(req_id, fcgi.FCGI_STDOUT, b'second', False))
+            writer.writelines(fcgi.build_record(req_id, fcgi.FCGI_STDOUT))
+            return fcgi.FCGI_REQUEST_COMPLETE
+
+    async def main():
+        async with Server() as server, serve(fcgi_config(root, server)) as listener:
+            server.resume = asyncio.Event()
+            reader, writer = await asyncio.open_connection('127.0.0.1', listener.port)
+            writer.write(b'GET /index.php HTTP/1.1\r\nHost: test\r\n\r\n')
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+            assert b'transfer-encoding: chunked' in head.lower()
+            # the first part arrives while the FastCGI server is not done
+            await asyncio.wait_for(reader.readexactly(len(PART) // 2), 5)
+            server.resume.set()
+            await asyncio.wait_for(reader.readuntil(b'second\r\n0\r\n\r\n'), 5)
+            writer.close()
+    asyncio.run(main())
+
+@pytest.mark.parametrize('status', [fcgi.FCGI_OVERLOADED, None])
+def test_error_after_headers(root, status):
+    class Server(FCGIServer):
+        async def respond(self, writer, req_id, env):
+            writer.writelines(fcgi.build_record(
+                req_id, fcgi.FCGI_STDOUT, b'Content-Type: text/plain\r\n\r\n' + PART, False))
+            await writer.drain()
+            if status is None:
+                # the FastCGI server goes away
+                writer.close()
+            return status
+
+    async def main():
+        async with Server() as server, serve(fcgi_config(root, server)) as listener:
+            reader, writer = await asyncio.open_connection('127.0.0.1', listener.port)
+            writer.write(b'GET /index.php HTTP/1.1\r\nHost: test\r\n\r\n')
+            data = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            # no error page after the response has started
+            assert data.startswith(b'HTTP/1.1 200 ')
+            assert data.count(b'HTTP/1.1') == 1
+            assert not data.endswith(b'0\r\n\r\n')
+    asyncio.run(main())
+
+def test_error_before_headers(root):
+    class Server(FCGIServer):
+        async def respond(self, writer, req_id, env):
+            writer.close()
+
+    async def main():
+        async with Server() as server, serve(fcgi_config(root, server)) as listener:
+            response = await get(listener.port, '/index.php')
+            assert response.status == 502
+    asyncio.run(main())
+
+def test_connection_refused(root):
+    async def main():
+        async with FCGIServer() as server:
+            config = fcgi_config(root, server)
+        async with serve(config) as listener:
+            response = await get(listener.port, '/index.php')
+            assert response.status == 502
+    asyncio.run(main())
+
+class GatedServer(FCGIServer):
+    '''Answers requests once `gate` is set.'''
+
+    async def respond(self, writer, req_id, env):
+        await self.gate.wait()
+        return await super().respond(writer, req_id, env)
+
+async def wait_for(predicate, timeout=5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.01)
+
+def test_connection_reused(root):
+    async def main():
+        async with FCGIServer() as server, serve(fcgi_config(root, server)) as listener:
+            for _ in range(3):
+                assert (await get(listener.port, '/index.php')).status == 200
+            assert server.connections == 1
+    asyncio.run(main())
+
+def test_max_connections(root):
+    async def main():
+        async with GatedServer() as server, \
+                serve(fcgi_config(root, server, fcgi_max_connections=2)) as listener:
+            server.gate = asyncio.Event()
+            requests = [asyncio.ensure_future(get(listener.port, '/index.php')) for _ in range(5)]
+            await wait_for(lambda: server.active == 2)
+            # the others wait for a connection
+            await asyncio.sleep(0.1)
+            assert server.active == 2
+            server.gate.set()
+            responses = await asyncio.gather(*requests)
+            assert [response.status for response in responses] == [200] * 5
+            assert server.connections == 2
+            assert server.max_active == 2
+    asyncio.run(main())
+
+@pytest.mark.parametrize('mpxs_conns', [True, False])
+def test_multiplex(root, mpxs_conns):
+    async def main():
+        server = GatedServer()
+        server.mpxs_conns = mpxs_conns
+        server.max_reqs = 3
+        async with server, serve(fcgi_config(
+                root, server, fcgi_max_connections=1, fcgi_multiplex=True)) as listener:
+            server.gate = asyncio.Event()
+            requests = [asyncio.ensure_future(get(listener.port, '/index.php')) for _ in range(4)]
+            expected = 3 if mpxs_conns else 1
+            await wait_for(lambda: server.active == expected)
+            await asyncio.sleep(0.1)
+            assert server.active == expected
+            server.gate.set()
+            responses = await asyncio.gather(*requests)
+            assert [response.status for response in responses] == [200] * 4
+            assert server.connections == 1
+    asyncio.run(main())
+
+def test_failover(root):
+    async def main():
+        async with FCGIServer() as down:
+            pass
+        async with FCGIServer() as server:
+            config = fcgi_config(root, server)
+            config['options']['fcgi_target'] = [down.target, server.target]
+            async with serve(config) as listener:
+                for _ in range(4):
+                    assert (await get(listener.port, '/index.php')).status == 200
+                assert len(server.requests) == 4
+                dispatcher, = fcgi.Dispatcher.pool.values()
+                # skipped for `fail_timeout` seconds
+                assert dispatcher.backends[0].down_until > 0
+    asyncio.run(main())
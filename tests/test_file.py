@@ -0,0 +1,181 @@
+import os
+import time
+import types
+import asyncio
+import pytest
+from helpers import serve, get
+from pyweb.handlers.file import FileHandler, parse_range, match_etag
+from pyweb.utils.time import datetime_string, parse_date
+
+def test_parse_range():
+    assert parse_range('bytes=0-9', 100) == [(0, 9)]
+    assert parse_range('bytes=90-', 100) == [(90, 99)]
+    assert parse_range('bytes=90-200', 100) == [(90, 99)]
+    assert parse_range('bytes=-10', 100) == [(90, 99)]
+    assert parse_range('bytes=-200', 100) == [(0, 99)]
+    assert parse_range(' bytes = 0 - 0 ', 100) == [(0, 0)]
+
+def test_parse_range_unsatisfiable():
+    assert parse_range('bytes=100-', 100) == []
+    assert parse_range('bytes=-0', 100) == []
+    assert parse_range('bytes=0-0', 0) == []
+    assert parse_range('bytes=-5', 0) == []
+
+def test_parse_range_ignored():
+    assert parse_range('items=0-9', 100) is None
+    assert parse_range('bytes=9-0', 100) is None
+    assert parse_range('bytes=a-b', 100) is None
+    assert parse_range('bytes=-', 100) is None
+    assert parse_range('bytes=0-0,200-200,400-400', 1000, max_ranges=2) is None
+
+def test_parse_range_coalesce():
+    assert parse_range('bytes=500-509,0-9,5-14', 1000) == [(0, 14), (500, 509)]
+    # parts closer than their overhead are merged
+    assert parse_range('bytes=0-9,20-29', 1000) == [(0, 29)]
+    assert parse_range('bytes=0-9,500-509', 1000) == [(0, 9), (500, 509)]
+    # counted after merging
+    assert parse_range('bytes=0-0,2-2,4-4', 1000, max_ranges=2) == [(0, 4)]
+
+def test_match_etag():
+    assert match_etag('"a"', '"a"')
+    assert match_etag('"b", "a"', '"a"')
+    assert match_etag('*', '"a"')
+    assert match_etag('W/"a"', '"a"')
+    assert not match_etag('"b"', '"a"')
+    assert match_etag('"a"', '"a"', strong=True)
+    assert not match_etag('W/"a"', '"a"', strong=True)
+    assert not match_etag('"a"', 'W/"a"', strong=True)
+
+@pytest.mark.parametrize('accept, encoding', [
+    (None, None),
+    ('gzip, br', 'br'),
+    ('gzip', 'gzip'),
+    ('gzip;q=0', None),
+    ('br;q=0.5, gzip', 'gzip'),
+    ('br;q=0, *', 'gzip'),
+    ('gzip;q=0.5, identity', None),
+    ('gzip, identity;q=0.5', 'gzip'),
+    ('deflate', None),
+])
+def test_gzip_static(tmp_path, accept, encoding):
+    for name in ('a.txt', 'a.txt.gz', 'a.txt.br'):
+        (tmp_path / name).write_bytes(name.encode())
+    config = {'handler': ['file'], 'options': {'root': str(tmp_path), 'gzip_static': True}}
+
+    async def main():
+        async with serve(config) as listener:
+            headers = [('Accept-Encoding', accept)] if accept is not None else []
+            response = await get(listener.port, '/a.txt', headers)
+            assert response.status == 200
+            assert response.get('content-encoding') == encoding
+            assert response.get('vary') == 'Accept-Encoding'
+            assert response.body == b'a.txt' + {None: b'', 'gzip': b'.gz', 'br': b'.br'}[encoding]
+    asyncio.run(main())
+
+MTIME = 1600000000
+ETAG = '"1-2-3"'
+OLDER = datetime_string(MTIME - 10)
+SAME = datetime_string(MTIME)
+
+def make_context(**headers):
+    env = {'HTTP_' + key.upper(): value for key, value in headers.items()}
+    entry = types.SimpleNamespace(stat=os.stat_result((0,) * 8 + (MTIME, 0)), etag=ETAG)
+    return types.SimpleNamespace(env=env, headers={}), entry
+
+def cache_control(options=None, **headers):
+    context, entry = make_context(**headers)
+    return FileHandler.cache_control(context, options or {}, entry)
+
+def test_cache_control_headers():
+    context, entry = make_context()
+    assert FileHandler.cache_control(context, {}, entry) is None
+    assert context.headers == {'Last-Modified': SAME, 'ETag': ETAG}
+    context, entry = make_context()
+    FileHandler.cache_control(context, {'etag': False}, entry)
+    assert 'ETag' not in context.headers
+
+def test_if_match():
+    assert cache_control(if_match=ETAG) is None
+    assert cache_control(if_match='"x", ' + ETAG) is None
+    assert cache_control(if_match='*') is None
+    assert cache_control(if_match='"x"') == 412
+    # strong comparison
+    assert cache_control(if_match='W/' + ETAG) == 412
+    assert cache_control({'etag': False}, if_match=ETAG) == 412
+    assert cache_control({'etag': False}, if_match='*') is None
+
+def test_if_match_over_if_unmodified_since():
+    assert cache_control(if_match=ETAG, if_unmodified_since=OLDER) is None
+    assert cache_control(if_match='"x"', if_unmodified_since=SAME) == 412
+
+def test_if_unmodified_since():
+    assert cache_control(if_unmodified_since=SAME) is None
+    assert cache_control(if_unmodified_since=OLDER) == 412
+    assert cache_control(if_unmodified_since='invalid') is None
+
+def test_if_none_match():
+    assert cache_control(if_none_match=ETAG) == 304
+    assert cache_control(if_none_match='*') == 304
+    # weak comparison
+    assert cache_control(if_none_match='W/' + ETAG) == 304
+    assert cache_control(if_none_match='"x"') is None
+
+def test_if_none_match_over_if_modified_since():
+    assert cache_control(if_none_match='"x"', if_modified_since=SAME) is None
+    assert cache_control(if_none_match=ETAG, if_modified_since=OLDER) == 304
+
+def test_if_modified_since():
+    assert cache_control(if_modified_since=SAME) == 304
+    assert cache_control(if_modified_since=OLDER) is None
+    # dates in the future are invalid
+    assert cache_control(if_modified_since=datetime_string(time.time() + 3600)) is None
+    assert cache_control(if_modified_since='invalid') is None
+
+def test_if_match_before_if_none_match():
+    assert cache_control(if_match='"x"', if_none_match=ETAG) == 412
+
+def check_if_range(value):
+    context, entry = make_context(if_range=value)
+    context.headers['ETag'] = ETAG
+    return FileHandler.check_if_range(context, entry)
+
+def test_check_if_range():
+    assert check_if_range('')
+    assert check_if_range(ETAG)
+    assert not check_if_range('"x"')
+    # weak tags never match
+    assert not check_if_range('W/' + ETAG)
+    assert check_if_range(SAME)
+    assert not check_if_range(OLDER)
+    assert not check_if_range('invalid')
+
+def test_conditional_get(tmp_path):
+    path = tmp_path / 'a.txt'
+    path.write_bytes(b'content')
+    os.utime(path, (MTIME, MTIME))
+    config = {'handler': ['file'], 'options': {'root': str(tmp_path)}}
+
+    async def main():
+        async with serve(config) as listener:
+            response = await get(listener.port, '/a.txt')
+            assert response.status == 200
+            assert response.body == b'content'
+            assert response.get('last-modified') == SAME
+            date = parse_date(response.get('date'))
+            assert abs(date - time.time()) < 5
+            etag = response.get('etag')
+            for headers in (
+                    [('If-None-Match', etag)],
+                    [('If-Modified-Since', SAME)],
+                    [('If-Modified-Since', 'Sunday, 13-Sep-20 12:26:40 GMT')]):
+                response = await get(listener.port, '/a.txt', headers)
+                assert response.status == 304
+                assert response.get('etag') == etag
+                assert response.get('date') is not None
+                assert response.get('content-length') is None
+                assert response.get('transfer-encoding') is None
+            response = await get(listener.port, '/a.txt', [('If-Modified-Since', OLDER)])
+            assert response.status == 200
+            response = await get(listener.port, '/a.txt', [('If-Match', '"x"')])
+            assert response.status == 412
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+import asyncio
+import pytest
+from pyweb.utils.httpclient import strip_hop_by_hop, get_header, iter_chunked
+
+def test_strip_hop_by_hop():
+    items = [
+        ('Host', 'a.com'),
+        ('Connection', 'keep-alive, X-Secret'),
+        ('Keep-Alive', 'timeout=5'),
+        ('Transfer-Encoding', 'chunked'),
+        ('x-secret', '1'),
+        ('Proxy-Connection', 'X-Other'),
+        ('X-Other', '2'),
+        ('TE', 'trailers'),
+        ('Upgrade', 'websocket'),
+        ('Accept', '*/*'),
+    ]
+    assert strip_hop_by_hop(items) == [('Host', 'a.com'), ('Accept', '*/*')]
+
+def test_get_header():
+    items = [('Content-Type', 'text/plain'), ('content-type', 'text/html')]
+    assert get_header(items, 'CONTENT-TYPE') == 'text/plain'
+    assert get_header(items, 'x', 'y') == 'y'
+
+def read_chunked(data):
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        chunks = [chunk async for chunk in iter_chunked(reader, 1)]
+        return chunks, await reader.read()
+    return asyncio.run(run())
+
+def test_iter_chunked():
+    chunks, rest = read_chunked(
+        b'5\r\nhello\r\n'
+        b'6;ext=1\r\n world\r\n'
+        b'A \r\n0123456789\r\n'
+        b'0\r\nX-Trailer: 1\r\n\r\n'
+        b'NEXT')
+    assert b''.join(chunks) == b'hello world0123456789'
+    # the body ends after the trailers
+    assert rest == b'NEXT'
+
+def test_iter_chunked_bare_lf():
+    chunks, rest = read_chunked(b'3\nabc\n0\n\n')
+    assert chunks == [b'abc'] and rest == b''
+
+@pytest.mark.parametrize('data', [
+    b'5\r\nhel',
+    b'5\r\nhello\r\n',
+    b'5',
+])
+def test_iter_chunked_incomplete(data):
+    with pytest.raises(asyncio.IncompleteReadError):
+        read_chunked(data)
+
+@pytest.mark.parametrize('data', [
+    b'x\r\n',
+    b'\r\n',
+    b'0x3\r\nabc\r\n0\r\n\r\n',
+    b'-1\r\nXY0\r\n\r\nREST',
+    b'+3\r\nabc\r\n0\r\n\r\n',
+    b'1_0\r\n0123456789abcdef\r\n0\r\n\r\n',
+    b' 3\r\nabc\r\n0\r\n\r\n',
+    b'3 x\r\nabc\r\n0\r\n\r\n',
+    # data not followed by a line break
+    b'3\r\nabcZZ0\r\n\r\nREST',
+    b'3\r\nabc\rZ0\r\n\r\n',
+    b'3\r\nabcd\r\n0\r\n\r\n',
+])
+def test_iter_chunked_invalid(data):
+    with pytest.raises(ValueError):
+        read_chunked(data)
@@ -0,0 +1,182 @@
+import asyncio
+import pytest
+from helpers import serve, get, read_response
+from pyweb.server import matcher
+from pyweb.utils import limits
+
+class Blocking:
+    '''A handler that answers once `release` is set.'''
+    name = 'blocking'
+
+    def __init__(self):
+        self.entered = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def __call__(self, context, options):
+        self.entered.set()
+        await self.release.wait()
+        context.headers['Content-Length'] = '2'
+        return [b'ok']
+
+async def passing(context, options):
+    return None
+passing.name = 'passing'
+
+@pytest.fixture
+def blocking(monkeypatch):
+    handler = Blocking()
+    monkeypatch.setitem(matcher.handlers, 'blocking', handler)
+    monkeypatch.setitem(matcher.handlers, 'passing', passing)
+    yield handler
+    limits.route_limits.clear()
+
+def test_inherited_limit_is_shared(blocking):
+    config = {
+        'options': {'max_concurrency': 1},
+        'handler': [
+            {'match': 'p:/a', 'handler': ['blocking']},
+            {'match': 'p:/b', 'handler': ['blocking']},
+        ],
+    }
+
+    async def main():
+        async with serve(config) as listener:
+            first = asyncio.ensure_future(get(listener.port, '/a'))
+            await blocking.entered.wait()
+            response = await get(listener.port, '/b')
+            assert response.status == 503
+            assert response.get('retry-after') == '1'
+            blocking.release.set()
+            assert (await first).status == 200
+            assert (await get(listener.port, '/b')).status == 200
+    asyncio.run(asyncio.wait_for(main(), 5))
+
+def test_child_limit_is_its_own(blocking):
+    config = {
+        'options': {'max_concurrency': 1},
+        'handler': [
+            {'match': 'p:/a', 'handler': ['blocking']},
+            {'match': 'p:/b', 'handler': ['blocking'], 'options': {'max_concurrency': 1}},
+        ],
+    }
+
+    async def main():
+        async with serve(config) as listener:
+            first = asyncio.ensure_future(get(listener.port, '/a'))
+            await blocking.entered.wait()
+            second = asyncio.ensure_future(get(listener.port, '/b'))
+            await asyncio.sleep(0.1)
+            blocking.release.set()
+            assert (await first).status == 200
+            assert (await second).status == 200
+    asyncio.run(asyncio.wait_for(main(), 5))
+
+def test_slot_released_when_handler_passes(blocking):
+    config = {
+        'handler': [
+            {'options': {'max_concurrency': 1}, 'handler': ['passing']},
+            'blocking',
+        ],
+    }
+
+    async def main():
+        async with serve(config) as listener:
+            first = asyncio.ensure_future(get(listener.port, '/'))
+            await blocking.entered.wait()
+            second = asyncio.ensure_future(get(listener.port, '/'))
+            await asyncio.sleep(0.1)
+            assert not second.done()
+            blocking.release.set()
+            assert (await first).status == 200
+            assert (await second).status == 200
+    asyncio.run(asyncio.wait_for(main(), 5))
+
+def test_queued_request_waits_for_slot(blocking):
+    config = {
+        'options': {'max_concurrency': 1, 'max_queue': 1},
+        'handler': ['blocking'],
+    }
+
+    async def main():
+        async with serve(config) as listener:
+            first = asyncio.ensure_future(get(listener.port, '/'))
+            await blocking.entered.wait()
+            second = asyncio.ensure_future(get(listener.port, '/'))
+            await asyncio.sleep(0.1)
+            third = await get(listener.port, '/')
+            assert third.status == 503
+            assert not second.done()
+            blocking.release.set()
+            assert (await first).status == 200
+            assert (await second).status == 200
+    asyncio.run(asyncio.wait_for(main(), 5))
+
+def test_queue_timeout(blocking):
+    config = {
+        'options': {'max_concurrency': 1, 'max_queue': 1, 'queue_timeout': 0.1},
+        'handler': ['blocking'],
+    }
+
+    async def main():
+        async with serve(config) as listener:
+            first = asyncio.ensure_future(get(listener.port, '/'))
+            await blocking.entered.wait()
+            second = await get(listener.port, '/')
+            assert second.status == 503
+            blocking.release.set()
+            assert (await first).status == 200
+            limit, = limits.route_limits.values()
+            assert (limit.active, len(limit.waiters)) == (0, 0)
+    asyncio.run(asyncio.wait_for(main(), 5))
+
+def test_concurrency_group(blocking):
+    config = {'handler': [
+        {'match': 'p:/a', 'options': {'max_concurrency': 1, 'concurrency_group': 'php'}, 'handler': ['blocking']},
+        {'match': 'p:/b', 'options': {'max_concurrency': 1, 'concurrency_group': 'php'}, 'handler': ['blocking']},
+    ]}
+
+    async def main():
+        async with serve(config) as listener:
+            first = asyncio.ensure_future(get(listener.port, '/a'))
+            await blocking.entered.wait()
+            assert (await get(listener.port, '/b')).status == 503
+            blocking.release.set()
+            assert (await first).status == 200
+            assert list(limits.route_limits) == ['php']
+    asyncio.run(asyncio.wait_for(main(), 5))
+
+def test_connection_limit():
+    limit = limits.ConnectionLimit('test', max_connections=2, max_per_ip=1)
+    assert limits.admit([limit], 'a') is None
+    assert limits.admit([limit], 'a') == (limit, 'client')
+    assert limits.admit([limit], 'b') is None
+    assert limits.admit([limit], 'c') == (limit, 'connections')
+    limits.release([limit], 'a')
+    assert limit.per_ip == {'b': 1}
+    assert limits.admit([limit], 'c') is None
+
+@pytest.mark.parametrize('options', [
+    {'max_connections': 1},
+    {'max_connections_per_ip': 1},
+])
+def test_connections_rejected(blocking, options):
+    config = dict(options, retry_after=7, handler=['blocking'])
+
+    async def main():
+        async with serve(config) as listener:
+            first = asyncio.ensure_future(get(listener.port, '/'))
+            await blocking.entered.wait()
+            # answered without reading the request
+            reader, writer = await asyncio.open_connection('127.0.0.1', listener.port)
+            response = await read_response(reader)
+            writer.close()
+            assert response.status == 503
+            assert response.get('retry-after') == '7'
+            assert response.get('connection') == 'close'
+            blocking.release.set()
+            assert (await first).status == 200
+            # the connection is closed after the response, freeing its slot
+            while listener.connections:
+                await asyncio.sleep(0.01)
+            assert (await get(listener.port, '/')).status == 200
+    asyncio.run(asyncio.wait_for(main(), 5))
@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+from pyweb.server.matcher import PathTrie, normalize_config, handlers
+
+def make_request(path, hostname='a.com', port=4000, method='GET'):
+    return SimpleNamespace(path=path, hostname=hostname, port=port, method=method)
+
+def test_path_trie():
+    trie = PathTrie()
+    trie.add('', 0)
+    trie.add('/static', 1)
+    trie.add('/static/img', 2)
+    trie.add('/api', 3)
+
+    def collect(path):
+        found = set()
+        trie.collect(path, found)
+        return found
+
+    assert collect('/') == {0}
+    assert collect('/static') == {0, 1}
+    assert collect('/static/') == {0, 1}
+    assert collect('/static/img/a.png') == {0, 1, 2}
+    # prefixes match whole segments only
+    assert collect('/statics') == {0}
+    assert collect('/api/v1') == {0, 3}
+
+def resolve(config, *args, **kw):
+    router = config['router']
+    return [handle.name for handle, _options in router.resolve(make_request(*args, **kw))]
+
+def test_router():
+    config, = normalize_config({
+        'port': 4000,
+        'handler': [
+            {'match': 'p:/api/', 'handler': 'upstream'},
+            {'match': 'p:=/metrics', 'handler': 'metrics'},
+            {'match': r'p:~\.php$', 'handler': 'fcgi'},
+            {'match': 'h:*.b.com', 'handler': 404},
+            'file',
+            'dir',
+        ],
+    })
+    assert resolve(config, '/') == ['file', 'dir']
+    assert resolve(config, '/api') == ['upstream', 'file', 'dir']
+    assert resolve(config, '/api/v1') == ['upstream', 'file', 'dir']
+    assert resolve(config, '/apis') == ['file', 'dir']
+    assert resolve(config, '/metrics') == ['metrics', 'file', 'dir']
+    assert resolve(config, '/metrics/') == ['file', 'dir']
+    assert resolve(config, '/index.php') == ['fcgi', 'file', 'dir']
+    assert resolve(config, '/', hostname='x.b.com') == ['error', 'file', 'dir']
+    assert resolve(config, '/', hostname='b.com') == ['file', 'dir']
+    # sections bound to another port
+    assert resolve(config, '/', port=4001) == []
+    assert resolve(config, 'http://a.com/', port=4001) == ['file', 'dir']
+
+def test_router_options():
+    config, = normalize_config({
+        'match': 'h:a.com',
+        'options': {'root': '/a', 'index': ['index.html']},
+        'handler': [
+            {'match': 'p:/b', 'options': {'root': '/b'}, 'handler': 'file'},
+            'file',
+        ],
+    })
+    chain = config['router'].resolve(make_request('/b/c'))
+    assert [handle for handle, _ in chain] == [handlers['file']] * 2
+    assert chain[0][1] == {'root': '/b', 'index': ['index.html']}
+    assert chain[1][1] == {'root': '/a', 'index': ['index.html']}
+    assert config['router'].resolve(make_request('/', hostname='b.com')) == ()
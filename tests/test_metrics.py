@@ -0,0 +1,107 @@
+import asyncio
+from helpers import serve, get, FCGIServer, fcgi_config
+from pyweb.server import context
+from pyweb.utils import metrics
+
+def test_render():
+    registry = metrics.Registry()
+    counter = metrics.Counter('requests_total', 'Requests.', ('path',), registry=registry)
+    gauge = metrics.Gauge('queued', 'Queued.', registry=registry)
+    histogram = metrics.Histogram('seconds', 'Time.', ('path',), (0.1, 1), registry=registry)
+    counter.labels('/a"b\n').inc()
+    counter.labels('/a"b\n').inc(2)
+    gauge.labels().set(1.5)
+    for value in (0.1, 0.5, 3):
+        histogram.labels('/').observe(value)
+    collected = []
+    registry.add_collector(lambda: collected.append(True))
+    assert registry.render() == '\n'.join([
+        '# HELP requests_total Requests.',
+        '# TYPE requests_total counter',
+        'requests_total{path="/a\\"b\\n"} 3',
+        '# HELP queued Queued.',
+        '# TYPE queued gauge',
+        'queued 1.5',
+        '# HELP seconds Time.',
+        '# TYPE seconds histogram',
+        # bounds are inclusive
+        'seconds_bucket{path="/",le="0.1"} 1',
+        'seconds_bucket{path="/",le="1"} 2',
+        'seconds_bucket{path="/",le="+Inf"} 3',
+        'seconds_sum{path="/"} 3.6',
+        'seconds_count{path="/"} 3',
+        '',
+    ])
+    assert collected == [True]
+
+def get_samples(body):
+    samples = {}
+    for line in body.decode().splitlines():
+        if line and not line.startswith('#'):
+            name, _, value = line.rpartition(' ')
+            samples[name] = float(value)
+    return samples
+
+def test_endpoint():
+    config = {'bind': 'test', 'handler': ['metrics'], 'options': {'metrics_path': '/_metrics'}}
+
+    async def main():
+        async with serve(config) as listener:
+            writes = sum(context.write_time.counts)
+            assert (await get(listener.port, '/missing')).status == 404
+            response = await get(listener.port, '/_metrics')
+            assert response.status == 200
+            assert response.get('content-type') == metrics.CONTENT_TYPE
+            assert response.get('cache-control') == 'no-store'
+            samples = get_samples(response.body)
+            assert samples['pyweb_requests_total{listener="test",handler="none",status="404"}'] >= 1
+            assert samples['pyweb_request_duration_seconds_count{listener="test",handler="none",status="404"}'] >= 1
+            assert samples['pyweb_stage_duration_seconds_count{stage="parse"}'] >= 2
+            assert (await get(listener.port, '/_metrics', method='POST')).status == 405
+            # the metrics request itself is recorded after it is sent
+            response = await get(listener.port, '/_metrics')
+            samples = get_samples(response.body)
+            assert samples['pyweb_requests_total{listener="test",handler="metrics",status="200"}'] >= 1
+            assert samples['pyweb_response_bytes_total{listener="test",handler="metrics",status="200"}'] > 0
+            assert sum(context.write_time.counts) > writes
+    asyncio.run(main())
+
+def test_disabled():
+    config = {'bind': 'off', 'metrics': False, 'handler': ['metrics']}
+
+    async def main():
+        async with serve(config) as listener:
+            await get(listener.port, '/missing')
+            response = await get(listener.port, '/metrics')
+            assert b'listener="off"' not in response.body
+    asyncio.run(main())
+
+def test_fcgi_pool(tmp_path):
+    (tmp_path / 'index.php').write_bytes(b'')
+
+    class Server(FCGIServer):
+        async def respond(self, writer, req_id, env):
+            await self.gate.wait()
+            return await super().respond(writer, req_id, env)
+
+    async def main():
+        async with Server() as server, serve(fcgi_config(
+                tmp_path, server, fcgi_max_connections=1)) as listener:
+            server.gate = asyncio.Event()
+            requests = [asyncio.ensure_future(get(listener.port, '/index.php')) for _ in range(3)]
+            while server.active < 1:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.05)
+            samples = get_samples(metrics.registry.render().encode())
+            target = server.target
+            assert samples['pyweb_fcgi_connections{target="%s",state="busy"}' % target] == 1
+            assert samples['pyweb_fcgi_connections_max{target="%s"}' % target] == 1
+            assert samples['pyweb_fcgi_requests_active{target="%s"}' % target] == 1
+            assert samples['pyweb_fcgi_requests_waiting{targets="%s"}' % target] == 2
+            server.gate.set()
+            await asyncio.gather(*requests)
+            samples = get_samples(metrics.registry.render().encode())
+            assert samples['pyweb_fcgi_connections{target="%s",state="idle"}' % target] == 1
+            assert samples['pyweb_fcgi_pool_wait_seconds_count{target="%s"}' % target] == 3
+            assert samples['pyweb_fcgi_response_seconds_count{target="%s"}' % target] == 3
+    asyncio.run(main())
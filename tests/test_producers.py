@@ -0,0 +1,99 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from pyweb.utils import producers
+from pyweb.utils.producers import FileProducer
+
+DATA = bytes(range(256)) * 1024
+
+@pytest.fixture
+def path(tmp_path):
+    path = tmp_path / 'data'
+    path.write_bytes(DATA)
+    return str(path)
+
+@pytest.fixture
+def executor():
+    executor = ThreadPoolExecutor(1)
+    yield executor
+    executor.shutdown()
+
+def test_iterate(path):
+    producer = FileProducer(path)
+    chunks = list(producer)
+    assert b''.join(chunks) == DATA
+    # chunks double up to `max_bufsize`
+    assert [len(chunk) for chunk in chunks[:3]] == [16384, 32768, 65536]
+    assert producer.fp is None
+
+def test_range(path):
+    producer = FileProducer(path, 1000, 50000)
+    assert b''.join(producer) == DATA[1000:51000]
+
+def test_empty_range(path):
+    producer = FileProducer(path, 0, 0)
+    assert list(producer) == []
+    assert producer.fp is None
+
+def test_read_ahead(path, executor):
+    reads = []
+
+    class Producer(FileProducer):
+        def read(self):
+            data = super().read()
+            reads.append(len(data))
+            return data
+
+    async def main():
+        producer = Producer(path, 0, 100000, executor)
+        first = await producer.__anext__()
+        # the next chunk is read while the first one is sent
+        await asyncio.wrap_future(executor.submit(lambda: None))
+        assert reads == [16384, 32768]
+        rest = [chunk async for chunk in producer]
+        assert first + b''.join(rest) == DATA[:100000]
+        assert producer.fp is None
+    asyncio.run(main())
+
+def test_close_during_read_ahead(path, executor):
+    async def main():
+        producer = FileProducer(path, executor=executor)
+        await producer.__anext__()
+        fp = producer.fp
+        producer.close()
+        # closed once the read in progress is done
+        await asyncio.wrap_future(executor.submit(lambda: None))
+        await asyncio.sleep(0)
+        assert fp.closed
+        assert producer.fp is None
+    asyncio.run(main())
+
+def test_close_during_open(path, executor, monkeypatch):
+    started = threading.Event()
+    resume = threading.Event()
+    opened = []
+
+    def slow_open(*args):
+        started.set()
+        resume.wait()
+        fp = open(*args)
+        opened.append(fp)
+        return fp
+    monkeypatch.setattr(producers, 'open', slow_open, raising=False)
+
+    async def main():
+        producer = FileProducer(path, executor=executor)
+        task = asyncio.ensure_future(producer.__anext__())
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        # the client is gone while the file is being opened
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        producer.close()
+        resume.set()
+        await asyncio.wrap_future(executor.submit(lambda: None))
+        await asyncio.sleep(0)
+        assert producer.fp is None
+        assert opened and opened[0].closed
+    asyncio.run(main())
@@ -0,0 +1,108 @@
+import asyncio
+import pytest
+from pyweb.handlers import proxy
+from pyweb.utils import httpclient
+from helpers import serve, request, read_response
+
+class Pool:
+    '''Answer forwarded requests with `ok`, reading `read` chunks of their bodies.'''
+
+    def __init__(self, read=None):
+        self.read = read
+        self.bodies = []
+
+    async def request(self, host, port, method, target, headers, body=None, chunked=False, ssl=False, timeout=None):
+        received = []
+        self.bodies.append(received)
+        if body is not None:
+            async for data in body:
+                received.append(data)
+                if self.read is not None and len(received) >= self.read:
+                    break
+
+        async def iter_body():
+            yield b'ok'
+
+        return httpclient.Response((1, 1), 200, 'OK', [('Content-Length', '2')], iter_body())
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = Pool()
+    monkeypatch.setattr(proxy, 'get_pool', lambda options: pool)
+    return pool
+
+def proxy_request(body, headers):
+    return (
+        b'POST http://origin.test/ HTTP/1.1\r\nHost: origin.test\r\n'
+        + headers + b'\r\n' + body)
+
+async def send(data):
+    async with serve({'handler': ['proxy']}) as listener:
+        return await request(listener.port, data)
+
+def test_chunked_body(pool):
+    response = asyncio.run(send(proxy_request(
+        b'3\r\nabc\r\n0\r\n\r\n', b'Transfer-Encoding: chunked\r\n')))
+    assert response.status == 200 and response.body == b'ok'
+    assert pool.bodies == [[b'abc']]
+
+@pytest.mark.parametrize('body', [
+    b'3\r\nabcZZ0\r\n\r\n',
+    b'-1\r\nXY0\r\n\r\n',
+    b'0x3\r\nabc\r\n0\r\n\r\n',
+    b'1_0\r\n0123456789abcdef\r\n0\r\n\r\n',
+])
+def test_invalid_chunked_body(pool, body):
+    response = asyncio.run(send(proxy_request(body, b'Transfer-Encoding: chunked\r\n')))
+    assert response.status == 400
+
+@pytest.mark.parametrize('value, status', [
+    ('gzip', 400),
+    ('chunked, gzip', 400),
+    ('gzip, chunked', 501),
+])
+def test_transfer_encoding(pool, value, status):
+    response = asyncio.run(send(proxy_request(
+        b'0\r\n\r\n', b'Transfer-Encoding: %s\r\n' % value.encode())))
+    assert response.status == status
+    assert pool.bodies == []
+
+def test_chunked_with_content_length(pool):
+    response = asyncio.run(send(proxy_request(
+        b'3\r\nabc\r\n0\r\n\r\n', b'Transfer-Encoding: chunked\r\nContent-Length: 3\r\n')))
+    assert response.status == 200
+    assert response.get('connection') == 'close'
+    assert pool.bodies == [[b'abc']]
+
+async def send_pipelined(data):
+    '''Send requests on one connection, return the responses until it is closed.'''
+    async with serve({'handler': ['proxy']}) as listener:
+        reader, writer = await asyncio.open_connection('127.0.0.1', listener.port)
+        writer.write(data)
+        responses = []
+        try:
+            while True:
+                responses.append(await read_response(reader))
+        except asyncio.IncompleteReadError:
+            pass
+        writer.close()
+        return responses
+
+NEXT = b'GET http://origin.test/next HTTP/1.1\r\nHost: origin.test\r\nConnection: close\r\n\r\n'
+
+def test_keep_alive_after_body(pool):
+    responses = asyncio.run(send_pipelined(
+        proxy_request(b'abc', b'Content-Length: 3\r\n') + NEXT))
+    assert [response.status for response in responses] == [200, 200]
+    assert pool.bodies == [[b'abc'], []]
+
+@pytest.mark.parametrize('read', [0, 1])
+def test_close_after_unread_body(monkeypatch, read):
+    # the server answers before reading all of the body
+    pool = Pool(read)
+    monkeypatch.setattr(proxy, 'get_pool', lambda options: pool)
+    body = b'3\r\nabc\r\n3\r\ndef\r\n0\r\n\r\n' + NEXT
+    responses = asyncio.run(send_pipelined(
+        proxy_request(body, b'Transfer-Encoding: chunked\r\n') + NEXT))
+    assert [response.status for response in responses] == [200]
+    assert responses[0].get('connection') == 'close'
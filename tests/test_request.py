@@ -0,0 +1,144 @@
+import asyncio
+import pytest
+from pyweb.server.request import Request, Headers
+from pyweb.utils import errors
+
+def parse_all(data, count=1, **kw):
+    '''Parse `count` requests from `data`, return them as
+    `(result, method, path, header_items, env)`.'''
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        request = Request(reader, (1, 1), keep_alive_timeout=1, **kw)
+        results = []
+        for _ in range(count):
+            env = {}
+            request.reset(env)
+            result = await request.parse()
+            results.append((result, request.method, request.path, list(request.header_items), env))
+        return results
+    return asyncio.run(run())
+
+def parse_request(data):
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        request = Request(reader, (1, 1), keep_alive_timeout=1)
+        request.reset({})
+        assert await request.parse()
+        return request
+    return asyncio.run(run())
+
+def test_parse():
+    (result, method, path, items, env), = parse_all(
+        b'GET /a?b HTTP/1.1\r\nHost: example.com:8080\r\nX-A: 1\r\nx-a: 2\r\n\r\n')
+    assert result
+    assert (method, path) == ('GET', '/a?b')
+    assert items == [('Host', 'example.com:8080'), ('X-A', '1'), ('x-a', '2')]
+    assert env['HTTP_X_A'] == '1,2'
+    assert env['SERVER_PROTOCOL'] == 'HTTP/1.1'
+
+def test_parse_without_headers():
+    (result, method, path, items, env), = parse_all(b'GET / HTTP/1.0\r\n\r\n')
+    assert result and items == []
+
+def test_parse_bare_lf():
+    (result, method, path, items, env), = parse_all(b'GET / HTTP/1.1\nHost: a\nX-B: 1\n\n')
+    assert result
+    assert items == [('Host', 'a'), ('X-B', '1')]
+    (result, _, _, items, _), = parse_all(b'GET / HTTP/1.0\n\n')
+    assert result and items == []
+
+def test_parse_pipelined():
+    data = (
+        b'\r\n'
+        b'GET /1 HTTP/1.1\r\nHost: a\r\n\r\n'
+        b'GET /2 HTTP/1.1\nHost: b\n\n'
+        b'GET /3 HTTP/1.1\r\n\r\n'
+    )
+    results = parse_all(data, 4)
+    assert [path for _, _, path, _, _ in results[:3]] == ['/1', '/2', '/3']
+    assert results[1][3] == [('Host', 'b')]
+    # end of stream
+    assert results[3][0] is None
+
+def test_parse_folding():
+    (_, _, _, items, _), = parse_all(b'GET / HTTP/1.1\r\nX-A: 1\r\n  2\r\n\r\n')
+    assert items == [('X-A', '1 2')]
+
+def test_parse_keep_alive():
+    async def run(data):
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        request = Request(reader, (1, 1))
+        await request.parse()
+        return request.keep_alive
+    assert asyncio.run(run(b'GET / HTTP/1.1\r\n\r\n'))
+    assert not asyncio.run(run(b'GET / HTTP/1.1\r\nConnection: close\r\n\r\n'))
+    assert not asyncio.run(run(b'GET / HTTP/1.0\r\n\r\n'))
+    assert asyncio.run(run(b'GET / HTTP/1.0\r\nConnection: keep-alive\r\n\r\n')) is False
+
+@pytest.mark.parametrize('data, status', [
+    (b'GET / HTTP/1.1\r\nbad\r\n\r\n', 400),
+    (b'GET / HTTP/1.1\r\n\n\r\n', 400),
+    (b'GET / HTTP/2.0\r\n\r\n', 505),
+    (b'GET / HTTP/1.1\r\n' + b'X-A: 1\r\n' * 3 + b'\r\n', 431),
+    (b'GET / HTTP/1.1\r\nX-A: ' + b'a' * 200 + b'\r\n\r\n', 431),
+    (b'GET / HTTP/1.1\nX-A: ' + b'a' * 200 + b'\nX-B: 1\n\n', 431),
+])
+def test_parse_errors(data, status):
+    with pytest.raises(errors.HTTPError) as info:
+        parse_all(data, max_headers=2, max_header_size=100)
+    assert info.value.status_code == status
+
+@pytest.mark.parametrize('eol', [b'\r\n', b'\n'])
+def test_parse_large_head(eol):
+    # more than the 64 KiB limit of the stream reader
+    value = b'a' * 100000
+    data = eol.join([b'GET / HTTP/1.1', b'X-A: ' + value, b'X-B: 1', b'', b''])
+    (result, _, _, items, _), = parse_all(data, max_header_size=200000)
+    assert result
+    assert items == [('X-A', value.decode()), ('X-B', '1')]
+    with pytest.raises(errors.HTTPError) as info:
+        parse_all(data)
+    assert info.value.status_code == 431
+
+def test_parse_host():
+    assert Request.parse_host('a.com') == ('a.com', None)
+    assert Request.parse_host('a.com:81') == ('a.com', 81)
+    assert Request.parse_host('[::1]') == ('[::1]', None)
+    assert Request.parse_host('[::1]:81') == ('[::1]', 81)
+    with pytest.raises(errors.HTTPError):
+        Request.parse_host('a.com:x')
+
+def test_headers():
+    headers = Headers([('Accept', 'a'), ('ACCEPT', 'b'), ('Host', 'h')])
+    assert headers['accept'] == 'a, b'
+    assert 'HOST' in headers
+    assert headers.get('x') is None
+
+@pytest.mark.parametrize('value, gzip, q', [
+    (None, False, 0.0),
+    ('gzip', True, 1.0),
+    ('GZIP;q=0.5', True, 0.5),
+    ('gzip; q=0', False, 0.0),
+    ('gzip;q=0.5, identity', False, 0.5),
+    ('gzip;q=0.5, identity;q=0.5', True, 0.5),
+    ('identity;q=0', False, 0.0),
+    ('gzip, identity;q=0.5', True, 1.0),
+    ('*', True, 1.0),
+    ('*, gzip;q=0', False, 0.0),
+    ('br, *;q=0.1', True, 0.1),
+    ('gzip;q=2', False, 0.0),
+    ('gzip;q=x', False, 0.0),
+])
+def test_accept_encoding(value, gzip, q):
+    head = b'GET / HTTP/1.1\r\n'
+    if value is not None:
+        head += b'Accept-Encoding: %s\r\n' % value.encode()
+    request = parse_request(head + b'\r\n')
+    assert request.accept_encoding_q('gzip') == q
+    assert request.accept_encoding('gzip') == gzip
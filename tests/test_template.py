@@ -0,0 +1,63 @@
+import asyncio
+from helpers import serve, get
+from pyweb.server.context import HTTPContext, ERROR_CODES
+from pyweb.server import matcher
+from pyweb.utils import template, errors
+
+def test_shared_environment(tmp_path):
+    (tmp_path / 'page.html').write_text('<p>{{name}}</p>')
+    env = template.get_environment(str(tmp_path))
+    assert template.get_environment(str(tmp_path) + '/') is env
+    page = template.get_template(str(tmp_path), 'page')
+    # compiled once
+    assert template.get_template(str(tmp_path), 'page') is page
+    assert template.get_template(str(tmp_path), 'missing') is None
+    assert template.render('page', {'name': 'a'}, str(tmp_path)) == '<p>a</p>'
+    assert template.render('missing', dirname=str(tmp_path)) == 'Not found'
+    assert list(template.stream('missing', dirname=str(tmp_path))) == ['Not found']
+
+def test_stream(tmp_path):
+    (tmp_path / 'items.html').write_text('{% for item in items %}<li>{{item}}</li>{% endfor %}')
+    items = range(100)
+    chunks = list(template.stream('items', {'items': items}, str(tmp_path), size=10))
+    expected = template.render('items', {'items': items}, str(tmp_path))
+    assert ''.join(chunks) == expected
+    # buffered into chunks, not a string per item
+    assert 1 < len(chunks) < 100
+
+def test_error_pages():
+    for code in ERROR_CODES:
+        page = HTTPContext.error_pages[code]
+        assert isinstance(page, bytes)
+        assert page == HTTPContext.render_error(code)
+        assert ('Error code: %d' % code).encode() in page
+
+def test_error_response(monkeypatch):
+    rendered = []
+    render_error = HTTPContext.render_error.__func__
+
+    def counted(cls, code, message=None):
+        rendered.append(code)
+        return render_error(cls, code, message)
+    monkeypatch.setattr(HTTPContext, 'render_error', classmethod(counted))
+
+    async def forbidden(context, options):
+        raise errors.HTTPError(403, 'Go away')
+    forbidden.name = 'forbidden'
+    monkeypatch.setitem(matcher.handlers, 'forbidden', forbidden)
+
+    async def main():
+        async with serve({'handler': []}) as listener:
+            response = await get(listener.port, '/')
+            assert response.status == 404
+            assert response.get('content-type') == 'text/html'
+            assert response.body == HTTPContext.error_pages[404]
+            assert int(response.get('content-length')) == len(response.body)
+            # pre-rendered
+            assert rendered == []
+        async with serve({'handler': ['forbidden']}) as listener:
+            response = await get(listener.port, '/')
+            assert response.status == 403
+            assert b'Message: Go away' in response.body
+            assert rendered == [403]
+    asyncio.run(main())
@@ -0,0 +1,37 @@
+import time
+import pytest
+from pyweb.utils import time as time_utils
+from pyweb.utils.time import datetime_string, parse_date, datetime_compare
+
+def test_datetime_string():
+    assert datetime_string(0) == 'Thu, 01 Jan 1970 00:00:00 GMT'
+    assert datetime_string(1600000000.9) == 'Sun, 13 Sep 2020 12:26:40 GMT'
+
+def test_datetime_string_now(monkeypatch):
+    now = [1600000000.1]
+    monkeypatch.setattr(time_utils.time, 'time', lambda: now[0])
+    value = datetime_string()
+    assert value == 'Sun, 13 Sep 2020 12:26:40 GMT'
+    now[0] = 1600000000.9
+    # formatted once per second
+    assert datetime_string() is value
+    now[0] = 1600000001
+    assert datetime_string() == 'Sun, 13 Sep 2020 12:26:41 GMT'
+
+@pytest.mark.parametrize('value', [
+    'Sun, 13 Sep 2020 12:26:40 GMT',
+    'Sunday, 13-Sep-20 12:26:40 GMT',
+    'Sun Sep 13 12:26:40 2020',
+])
+def test_parse_date(value):
+    assert parse_date(value) == 1600000000
+
+@pytest.mark.parametrize('value', ['', 'invalid', 'Sun, 13 Sep 2020'])
+def test_parse_date_invalid(value):
+    assert parse_date(value) is None
+
+def test_datetime_compare():
+    assert datetime_compare(1600000000.5, 'Sun, 13 Sep 2020 12:26:40 GMT')
+    assert datetime_compare('Sun, 13 Sep 2020 12:26:41 GMT', 1600000000)
+    assert not datetime_compare(1599999999, 'Sun, 13 Sep 2020 12:26:40 GMT')
+    assert not datetime_compare(1600000000, 'invalid')
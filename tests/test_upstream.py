@@ -0,0 +1,203 @@
+import ssl
+import shutil
+import asyncio
+import subprocess
+import pytest
+from helpers import serve, get, request, read_response
+from pyweb.utils import upstream
+
+class Backend:
+    '''An HTTP server answering with its name, use it with `async with`.
+
+    The requests it gets are appended to `requests` as
+    `(method, path, headers)`. Requests are answered with `status`.
+    '''
+    status = 200
+
+    def __init__(self, name):
+        self.name = name
+        self.requests = []
+        self.connections = 0
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        self.target = '127.0.0.1:%d' % self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *args):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                lines = head.decode('latin-1').split('\r\n')
+                method, path, _ = lines[0].split(' ')
+                headers = {}
+                for line in lines[1:]:
+                    if line:
+                        key, _, value = line.partition(':')
+                        headers[key.strip().lower()] = value.strip()
+                self.requests.append((method, path, headers))
+                length = int(headers.get('content-length', 0))
+                if length:
+                    await reader.readexactly(length)
+                body = self.name.encode()
+                writer.write(b'HTTP/1.1 %d X\r\nContent-Length: %d\r\n\r\n%s' % (
+                    self.status, len(body), body))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+@pytest.fixture(autouse=True)
+def clean_balancers():
+    yield
+    upstream.Balancer.retain([])
+
+def upstream_config(*backends, **options):
+    return {
+        'handler': ['upstream'],
+        'options': dict({
+            'upstream_targets': [backend.target for backend in backends],
+        }, **options),
+    }
+
+def test_forwarded_headers():
+    async def main():
+        async with Backend('a') as backend, serve(upstream_config(backend)) as listener:
+            response = await get(listener.port, '/path?q', [
+                ('X-Forwarded-For', '10.0.0.1'),
+                ('X-Forwarded-Proto', 'https'),
+            ])
+            assert response.status == 200
+            assert response.body == b'a'
+            (method, path, headers), = backend.requests
+            assert (method, path) == ('GET', '/path?q')
+            assert headers['host'] == 'test'
+            assert headers['x-forwarded-for'] == '10.0.0.1, 127.0.0.1'
+            # set by the listener, not by the client
+            assert headers['x-forwarded-proto'] == 'http'
+    asyncio.run(main())
+
+@pytest.fixture
+def tls_context(tmp_path):
+    if shutil.which('openssl') is None:
+        pytest.skip('openssl is not available')
+    cert, key = tmp_path / 'cert.pem', tmp_path / 'key.pem'
+    subprocess.run([
+        'openssl', 'req', '-x509', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+        '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+        '-keyout', str(key), '-out', str(cert),
+    ], check=True, capture_output=True)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    return context
+
+def test_forwarded_proto_https(tls_context):
+    client_context = ssl.create_default_context()
+    client_context.check_hostname = False
+    client_context.verify_mode = ssl.CERT_NONE
+
+    async def main():
+        async with Backend('a') as backend, serve(upstream_config(backend), tls_context) as listener:
+            reader, writer = await asyncio.open_connection(
+                '127.0.0.1', listener.port, ssl=client_context)
+            writer.write(b'GET / HTTP/1.1\r\nHost: test\r\nConnection: close\r\n\r\n')
+            response = await read_response(reader)
+            writer.close()
+            assert response.status == 200
+            (_, _, headers), = backend.requests
+            assert headers['x-forwarded-proto'] == 'https'
+    asyncio.run(main())
+
+def test_round_robin():
+    async def main():
+        async with Backend('a') as a, Backend('b') as b, serve(upstream_config(a, b)) as listener:
+            bodies = [(await get(listener.port, '/')).body for _ in range(4)]
+            assert bodies == [b'a', b'b', b'a', b'b']
+            # persistent connections are reused
+            assert a.connections == b.connections == 1
+    asyncio.run(main())
+
+def test_least_conn():
+    async def main():
+        balancer = upstream.Balancer(['127.0.0.1:1', '127.0.0.1:2'], policy='least_conn')
+        first = balancer.select()
+        balancer.acquire(first)
+        # the busy server is skipped until it is released
+        assert balancer.select() is not first
+        assert balancer.select() is not first
+        second = balancer.select()
+        balancer.acquire(second)
+        balancer.acquire(second)
+        balancer.release(first)
+        assert balancer.select() is first
+        assert balancer.select() is first
+    asyncio.run(main())
+
+def test_hash():
+    async def main():
+        async with Backend('a') as a, Backend('b') as b, Backend('c') as c, \
+                serve(upstream_config(a, b, c, upstream_policy='hash',
+                    upstream_hash_header='X-User')) as listener:
+            picked = {}
+            for user in map(str, range(20)):
+                for _ in range(2):
+                    response = await get(listener.port, '/', [('X-User', user)])
+                    assert picked.setdefault(user, response.body) == response.body
+            # keys are spread over the servers
+            assert set(picked.values()) == {b'a', b'b', b'c'}
+    asyncio.run(main())
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        upstream.Balancer(['127.0.0.1:1'], policy='random')
+
+def test_retry():
+    async def main():
+        async with Backend('down') as down:
+            pass
+        async with Backend('a') as a, serve(upstream_config(
+                down, a, upstream_fail_timeout=60)) as listener:
+            response = await get(listener.port, '/')
+            assert response.body == b'a'
+            balancer, = upstream.Balancer.pool.values()
+            # skipped for `fail_timeout` seconds
+            assert balancer.servers[0].down_until > 0
+            for _ in range(3):
+                assert (await get(listener.port, '/')).body == b'a'
+    asyncio.run(main())
+
+def test_no_retry_with_body():
+    async def main():
+        async with Backend('down') as down:
+            pass
+        async with Backend('a') as a, serve(upstream_config(down, a)) as listener:
+            data = b'POST / HTTP/1.1\r\nHost: test\r\nContent-Length: 1\r\n\r\nx'
+            # tried first, the body cannot be sent again
+            response = await request(listener.port, data)
+            assert response.status == 502
+            assert a.requests == []
+            response = await request(listener.port, data)
+            assert response.body == b'a'
+    asyncio.run(main())
+
+def test_health_check():
+    async def main():
+        async with Backend('a') as a, Backend('b') as b, serve(upstream_config(
+                a, b, upstream_health_check='/health',
+                upstream_health_interval=0.05)) as listener:
+            await get(listener.port, '/')
+            a.status = 500
+            await asyncio.sleep(0.2)
+            assert any(path == '/health' for _, path, _ in a.requests)
+            # the unhealthy server is skipped
+            assert [(await get(listener.port, '/')).body for _ in range(3)] == [b'b'] * 3
+            a.status = 200
+            await asyncio.sleep(0.2)
+            bodies = {(await get(listener.port, '/')).body for _ in range(2)}
+            assert bodies == {b'a', b'b'}
+    asyncio.run(main())
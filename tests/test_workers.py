@@ -0,0 +1,109 @@
+import os
+import time
+import signal
+import socket
+import asyncio
+import logging
+import multiprocessing
+import pytest
+from helpers import get, free_port, wait_port
+from pyweb.server import HTTPDaemon, matcher
+from pyweb.server.workers import bind_sockets
+
+async def whoami(context, options):
+    return '%d %d' % (os.getpid(), os.getppid())
+whoami.name = 'whoami'
+
+@pytest.fixture
+def master(monkeypatch):
+    '''Start a master process with 3 workers, yield it and its port.'''
+    # inherited by the forked processes
+    monkeypatch.setitem(matcher.handlers, 'whoami', whoami)
+    port = free_port()
+    config = {
+        'bind': '127.0.0.1:%d' % port,
+        'workers': 3,
+        'handler': ['whoami'],
+        'access_log': None,
+        'loglevel': logging.WARNING,
+    }
+    process = multiprocessing.get_context('fork').Process(
+        target=lambda: HTTPDaemon(config).serve(), daemon=True)
+    process.start()
+    try:
+        wait_port(port)
+        yield process, port
+    finally:
+        # the master stops its workers
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGTERM)
+        process.join(10)
+
+def whoami_request(port):
+    response = asyncio.run(get(port, '/'))
+    assert response.status == 200
+    return tuple(map(int, response.body.split()))
+
+def test_bind_sockets(tmp_path):
+    sock, = bind_sockets('127.0.0.1:0')
+    with sock:
+        assert sock.getsockname()[0] == '127.0.0.1'
+        assert not sock.getblocking()
+    path = tmp_path / 'sock'
+    path.write_bytes(b'stale')
+    sock, = bind_sockets(str(path))
+    with sock:
+        assert sock.family == socket.AF_UNIX
+        assert path.stat().st_mode & 0o777 == 0o666
+
+def test_workers_serve(master):
+    process, port = master
+    for _ in range(10):
+        pid, ppid = whoami_request(port)
+        # served by a worker, not by the master
+        assert ppid == process.pid != pid
+
+def children(pid):
+    '''Pids of the child processes of `pid`, Linux only.'''
+    pids = set()
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as fp:
+                stat = fp.read()
+        except OSError:
+            continue
+        # the command name before may contain spaces
+        if int(stat.rpartition(')')[2].split()[1]) == pid:
+            pids.add(int(name))
+    return pids
+
+def test_worker_restarted(master):
+    process, port = master
+    pids = children(process.pid)
+    assert len(pids) == 3
+    pid, _ = whoami_request(port)
+    os.kill(pid, signal.SIGKILL)
+    deadline = time.monotonic() + 10
+    while True:
+        current = children(process.pid)
+        if len(current) == 3 and pid not in current:
+            break
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    new_pid, = current - pids
+    while whoami_request(port)[0] != new_pid:
+        assert time.monotonic() < deadline
+
+def test_stop(master):
+    process, port = master
+    pid, _ = whoami_request(port)
+    os.kill(process.pid, signal.SIGTERM)
+    process.join(10)
+    assert process.exitcode == 0
+    # the workers are gone with the master
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)
+    with pytest.raises(ConnectionRefusedError):
+        socket.create_connection(('127.0.0.1', port), 1)
@@ -0,0 +1,102 @@
+import gzip
+import zlib
+from pyweb.utils.writers import ResponseWriter
+
+class Transport:
+    def __init__(self):
+        self.writes = []
+
+    def writelines(self, parts):
+        self.writes.append(b''.join(parts))
+
+    @property
+    def data(self):
+        return b''.join(self.writes)
+
+def make_writer(bufsize=None):
+    raw = Transport()
+    return raw, ResponseWriter(raw, None, bufsize)
+
+def decode_chunked(body):
+    chunks = []
+    while True:
+        size, _, body = body.partition(b'\r\n')
+        size = int(size, 16)
+        if not size:
+            assert body == b'\r\n'
+            return chunks
+        chunks.append(body[:size])
+        assert body[size:size + 2] == b'\r\n'
+        body = body[size + 2:]
+
+def test_plain():
+    raw, writer = make_writer(8)
+    writer.start(b'HEAD\r\n\r\n')
+    writer.write(b'abc')
+    # buffered with the head until `bufsize` bytes are collected
+    assert raw.writes == []
+    writer.write(b'defgh')
+    assert raw.writes == [b'HEAD\r\n\r\nabcdefgh']
+    writer.write(b'0123456789')
+    writer.close()
+    assert raw.data == b'HEAD\r\n\r\nabcdefgh0123456789'
+    assert writer.written == 18
+
+def test_large_write_flushes_buffer():
+    raw, writer = make_writer(8)
+    writer.start(b'H|')
+    writer.write(b'ab')
+    writer.write(b'0123456789')
+    assert raw.writes == [b'H|ab0123456789']
+
+def test_chunked():
+    raw, writer = make_writer(8)
+    writer.start(b'H|', chunked=True)
+    writer.write(b'abc')
+    writer.write(b'0123456789abcdef')
+    writer.write(b'x')
+    writer.close()
+    head, body = raw.data.split(b'|', 1)
+    assert decode_chunked(body) == [b'abc0123456789abcdef', b'x']
+    assert writer.written == 20
+
+def test_chunked_empty():
+    raw, writer = make_writer()
+    writer.start(b'H|', chunked=True)
+    writer.write(b'')
+    writer.close()
+    assert raw.data == b'H|0\r\n\r\n'
+
+def test_gzip():
+    raw, writer = make_writer(8)
+    data = b'hello world ' * 1000
+    writer.start(b'H|', chunked=True, gzip=True)
+    for i in range(0, len(data), 100):
+        writer.write(data[i:i + 100])
+    writer.close()
+    body = b''.join(decode_chunked(raw.data.split(b'|', 1)[1]))
+    assert gzip.decompress(body) == data
+    # `written` counts the bytes sent
+    assert writer.written == len(body) < len(data)
+
+def test_gzip_flush():
+    raw, writer = make_writer()
+    writer.start(b'H|', chunked=True, gzip=True)
+    writer.write(b'data: hello\n\n')
+    writer.flush()
+    decompressor = zlib.decompressobj(31)
+    body = b''.join(decode_chunked(raw.data.split(b'|', 1)[1] + b'0\r\n\r\n'))
+    assert decompressor.decompress(body) == b'data: hello\n\n'
+    writer.write(b'data: world\n\n')
+    writer.close()
+    body = b''.join(decode_chunked(raw.data.split(b'|', 1)[1]))
+    assert gzip.decompress(body) == b'data: hello\n\ndata: world\n\n'
+
+def test_restart():
+    raw, writer = make_writer()
+    writer.start(b'A|', gzip=True)
+    writer.write(b'pending')
+    writer.start(b'B|')
+    writer.write(b'b')
+    writer.close()
+    assert raw.data == b'B|b'